@@ -36,6 +36,9 @@ setup(
         "Programming Language :: Python :: 3.7",
     ],
     entry_points={
-        "console_scripts": ["satosa-saml-metadata=satosa.scripts.satosa_saml_metadata:construct_saml_metadata"]
+        "console_scripts": [
+            "satosa-saml-metadata=satosa.scripts.satosa_saml_metadata:construct_saml_metadata",
+            "satosa-metadata-index=satosa.scripts.satosa_metadata_index:construct_metadata_index",
+        ]
     }
 )
@@ -1,4 +1,6 @@
+import hashlib
 import logging
+import os
 from collections import defaultdict
 from itertools import chain
 
@@ -6,6 +8,11 @@ from mako.template import Template
 
 logger = logging.getLogger(__name__)
 
+TEMPLATE_IMPORTS = ["from satosa.attribute_mapping import scope"]
+
+# compiled templates by template text, shared by all attribute mappers
+_TEMPLATE_CACHE = {}
+
 
 def scope(s):
     """
@@ -19,6 +26,45 @@ def scope(s):
     return domain_part
 
 
+def compile_template(template, module_directory=None):
+    """
+    Compiles a template attribute, or returns it from the cache if it was
+    already compiled.
+
+    With a module directory the template is compiled through a file in that
+    directory, where mako also keeps the compiled module, so that other
+    processes load the module instead of compiling the template again.
+
+    :type template: str
+    :type module_directory: str | None
+    :rtype: mako.template.Template
+
+    :param template: The template text
+    :param module_directory: Directory for the compiled template modules
+    :return: The compiled template
+    """
+    compiled = _TEMPLATE_CACHE.get(template)
+    if compiled is not None:
+        return compiled
+
+    if module_directory:
+        name = hashlib.sha256(template.encode("utf-8")).hexdigest()
+        filename = os.path.join(module_directory, "{}.mako".format(name))
+        if not os.path.exists(filename):
+            os.makedirs(module_directory, exist_ok=True)
+            tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+            with open(tmp_filename, "w", encoding="utf-8") as f:
+                f.write(template)
+            os.replace(tmp_filename, filename)
+        compiled = Template(filename=filename, module_directory=module_directory, uri=name,
+                            cache_enabled=True, imports=TEMPLATE_IMPORTS)
+    else:
+        compiled = Template(template, cache_enabled=True, imports=TEMPLATE_IMPORTS)
+
+    _TEMPLATE_CACHE[template] = compiled
+    return compiled
+
+
 class AttributeMapper(object):
     """
     Converts between internal and external data format
@@ -34,6 +80,8 @@ class AttributeMapper(object):
         self.multivalue_separator = ";"  # separates multiple values, e.g. when using templates
         self.from_internal_attributes = internal_attributes["attributes"]
         self.template_attributes = internal_attributes.get("template_attributes", None)
+        self.template_module_directory = internal_attributes.get("template_module_directory", None)
+        self._compile_templates()
 
         self.to_internal_attributes = defaultdict(dict)
         for internal_attribute_name, mappings in self.from_internal_attributes.items():
@@ -41,6 +89,43 @@ class AttributeMapper(object):
                 for external_attribute_name in external_attribute_names:
                     self.to_internal_attributes[profile][external_attribute_name] = internal_attribute_name
 
+        self._to_internal_plans = {}
+        self._from_internal_plans = {}
+        for profile in self.to_internal_attributes:
+            self._build_plans(profile)
+
+    def _build_plans(self, attribute_profile):
+        """
+        Prepares the conversions from and to an attribute profile.
+
+        The plan to convert to the internal format holds the internal attributes mapped in the
+        profile, in the configured order, with the key paths of their external attributes, and an
+        index from the top level external attribute names to those internal attributes. The plan
+        to convert from the internal format holds the key path of the external attribute of each
+        internal attribute.
+
+        :type attribute_profile: str
+        :param attribute_profile: The attribute profile (ex: oidc, saml, ...)
+        """
+        to_internal = []
+        index = defaultdict(list)
+        from_internal = {}
+        for internal_attribute_name, mapping in self.from_internal_attributes.items():
+            if attribute_profile not in mapping:
+                continue
+
+            external_attribute_names = mapping[attribute_profile]
+            paths = [tuple(name.split(self.separator)) for name in external_attribute_names]
+            for path in paths:
+                index[path[0]].append(len(to_internal))
+            to_internal.append((internal_attribute_name, external_attribute_names, paths))
+            if paths:
+                # select the first attribute name
+                from_internal[internal_attribute_name] = (external_attribute_names[0], paths[0])
+
+        self._to_internal_plans[attribute_profile] = (to_internal, dict(index))
+        self._from_internal_plans[attribute_profile] = from_internal
+
     def to_internal_filter(self, attribute_profile, external_attribute_names):
         """
         Converts attribute names from external "type" to internal
@@ -86,26 +171,33 @@ class AttributeMapper(object):
         :return: Attributes in the internal format
         """
         internal_dict = {}
+        debug = logger.isEnabledFor(logging.DEBUG)
 
-        for internal_attribute_name, mapping in self.from_internal_attributes.items():
-            if attribute_profile not in mapping:
-                logline = "no attribute mapping found for internal attribute {internal} the attribute profile {attribute}".format(
-                    internal=internal_attribute_name, attribute=attribute_profile
-                )
-                logger.debug(logline)
-                # skip this internal attribute if we have no mapping in the specified profile
-                continue
-
-            external_attribute_name = mapping[attribute_profile]
-            attribute_values = self._collate_attribute_values_by_priority_order(external_attribute_name,
-                                                                                external_dict)
+        try:
+            attributes, index = self._to_internal_plans[attribute_profile]
+        except KeyError:
+            if debug:
+                logger.debug("no attribute mapping found for the attribute profile {}".format(attribute_profile))
+            attributes, index = [], {}
+
+        # only consider the internal attributes mapped from the external attributes present, in
+        # the configured order
+        positions = sorted({
+            position
+            for external_attribute_name in external_dict
+            for position in index.get(external_attribute_name, ())
+        })
+        for position in positions:
+            internal_attribute_name, external_attribute_name, paths = attributes[position]
+            attribute_values = self._collate_attribute_values_by_path(paths, external_dict)
             if attribute_values:  # Only insert key if it has some values
-                logline = "backend attribute {external} mapped to {internal}".format(
-                    external=external_attribute_name, internal=internal_attribute_name
-                )
-                logger.debug(logline)
+                if debug:
+                    logline = "backend attribute {external} mapped to {internal}".format(
+                        external=external_attribute_name, internal=internal_attribute_name
+                    )
+                    logger.debug(logline)
                 internal_dict[internal_attribute_name] = attribute_values
-            else:
+            elif debug:
                 logline = "skipped backend attribute {}: no value found".format(
                     external_attribute_name
                 )
@@ -113,10 +205,14 @@ class AttributeMapper(object):
         internal_dict = self._handle_template_attributes(attribute_profile, internal_dict)
         return internal_dict
 
-    def _collate_attribute_values_by_priority_order(self, attribute_names, data):
+    def _collate_attribute_values_by_path(self, paths, data):
         result = []
-        for attr_name in attribute_names:
-            attr_val = self._get_nested_attribute_value(attr_name, data)
+        for path in paths:
+            attr_val = data
+            for key in path:
+                attr_val = attr_val.get(key)
+                if attr_val is None:
+                    break
 
             if isinstance(attr_val, list):
                 result.extend(attr_val)
@@ -125,8 +221,18 @@ class AttributeMapper(object):
 
         return result
 
+    def _compile_templates(self):
+        if not self.template_attributes:
+            return
+
+        for mapping in self.template_attributes.values():
+            for external_attribute_names in mapping.values():
+                for template in external_attribute_names:
+                    if "$" in template:
+                        compile_template(template, self.template_module_directory)
+
     def _render_attribute_template(self, template, data):
-        t = Template(template, cache_enabled=True, imports=["from satosa.attribute_mapping import scope"])
+        t = compile_template(template, self.template_module_directory)
         try:
             return t.render(**data).split(self.multivalue_separator)
         except (NameError, TypeError):
@@ -152,25 +258,6 @@ class AttributeMapper(object):
 
         return internal_dict
 
-    def _get_nested_attribute_value(self, nested_key, data):
-        keys = nested_key.split(self.separator)
-
-        d = data
-        for key in keys:
-            d = d.get(key)
-            if d is None:
-                return None
-        return d
-
-    def _create_nested_attribute_value(self, nested_attribute_names, value):
-        if len(nested_attribute_names) == 1:
-            # we've reached the inner-most attribute name, set value here
-            return {nested_attribute_names[0]: value}
-
-        # keep digging further into the nested attribute names
-        child_dict = self._create_nested_attribute_value(nested_attribute_names[1:], value)
-        return {nested_attribute_names[0]: child_dict}
-
     def from_internal(self, attribute_profile, internal_dict):
         """
         Converts the internal data to "type"
@@ -184,38 +271,33 @@ class AttributeMapper(object):
         :return: attribute values and names in the specified "profile"
         """
         external_dict = {}
-        for internal_attribute_name in internal_dict:
+        debug = logger.isEnabledFor(logging.DEBUG)
+        plan = self._from_internal_plans.get(attribute_profile, {})
+        for internal_attribute_name, value in internal_dict.items():
             try:
-                attribute_mapping = self.from_internal_attributes[internal_attribute_name]
+                external_attribute_name, path = plan[internal_attribute_name]
             except KeyError:
-                logline = "no attribute mapping found for the internal attribute {}".format(
-                    internal_attribute_name
-                )
-                logger.debug(logline)
+                # skip this internal attribute if we have no mapping in the specified profile
+                if debug:
+                    logline = "no mapping found for '{internal}' in attribute profile '{attribute}'".format(
+                        internal=internal_attribute_name, attribute=attribute_profile
+                    )
+                    logger.debug(logline)
                 continue
 
-            if attribute_profile not in attribute_mapping:
-                # skip this internal attribute if we have no mapping in the specified profile
-                logline = "no mapping found for '{internal}' in attribute profile '{attribute}'".format(
-                    internal=internal_attribute_name, attribute=attribute_profile
+            if debug:
+                logline = "frontend attribute {external} mapped from {internal}".format(
+                    external=external_attribute_name, internal=internal_attribute_name
                 )
                 logger.debug(logline)
-                continue
 
-            external_attribute_names = self.from_internal_attributes[internal_attribute_name][attribute_profile]
-            # select the first attribute name
-            external_attribute_name = external_attribute_names[0]
-            logline = "frontend attribute {external} mapped from {internal}".format(
-                external=external_attribute_name, internal=internal_attribute_name
-            )
-            logger.debug(logline)
-
-            if self.separator in external_attribute_name:
-                nested_attribute_names = external_attribute_name.split(self.separator)
-                nested_dict = self._create_nested_attribute_value(nested_attribute_names[1:],
-                                                                  internal_dict[internal_attribute_name])
-                external_dict[nested_attribute_names[0]] = nested_dict
-            else:
-                external_dict[external_attribute_name] = internal_dict[internal_attribute_name]
+            # merge nested attributes sharing a parent, e.g. address.locality and address.country
+            parent = external_dict
+            for key in path[:-1]:
+                child = parent.get(key)
+                if not isinstance(child, dict):
+                    child = parent[key] = {}
+                parent = child
+            parent[path[-1]] = value
 
         return external_dict
@@ -5,6 +5,9 @@ import copy
 import functools
 import json
 import logging
+import os
+import threading
+import time
 import warnings as _warnings
 from base64 import urlsafe_b64encode
 from urllib.parse import urlparse
@@ -24,8 +27,19 @@ from satosa.internal import AuthenticationInformation
 from satosa.internal import InternalData
 from satosa.exception import SATOSAAuthenticationError
 from satosa.logging_util import satosa_logging
+from satosa.metadata_index import IndexedMetaData
+from satosa.metadata_index import MetadataIndexSource
+from satosa.metadata_index import add_metadata_index
+from satosa.metadata_index import close_replaced_indexes
+from satosa.metadata_refresh import create_metadata_sources
+from satosa.metadata_refresh import metadata_store_lock
+from satosa.metadata_refresh import create_metadata_refreshers
+from satosa.metadata_refresh import start_metadata_refreshers
+from satosa.plugin_loader import load_store
 from satosa.response import SeeOther, Response
 from satosa.saml_util import make_saml_response
+from satosa.state import STATE_COOKIE_MAX_AGE
+from satosa.state_store import MemoryStateStore
 from satosa.metadata_creation.description import (
     MetadataDescription, OrganizationDesc, ContactPersonDesc, UIInfoDesc
 )
@@ -73,6 +87,182 @@ def get_force_authn(context, config, sp_config):
     return value
 
 
+class OutstandingQueries(object):
+    """
+    The ids of the sent authentication requests which are waiting for a
+    response, kept in a store.
+
+    Provides the dict operations pysaml2 uses on the outstanding queries.
+    """
+
+    def __init__(self, store):
+        """
+        :type store: satosa.state_store.StateStore
+        :param store: The store of the requests
+        """
+        self.store = store
+
+    def __contains__(self, req_id):
+        return self.store.get(req_id) is not None
+
+    def __getitem__(self, req_id):
+        req = self.store.get(req_id)
+        if req is None:
+            raise KeyError(req_id)
+        return req
+
+    def __setitem__(self, req_id, req):
+        self.store.set(req_id, str(req))
+
+    def __delitem__(self, req_id):
+        self.store.delete(req_id)
+
+    def __bool__(self):
+        # pysaml2 replaces empty outstanding queries, don't count the requests for that
+        return True
+
+    def __len__(self):
+        return len(self.store)
+
+    def keys(self):
+        return self.store.keys()
+
+
+class IdPBlacklist(object):
+    """
+    The entity ids of the blacklisted IdPs, from a JSON file of the form
+    {"blacklist": [entity ids]}.
+
+    The file is checked for changes at most every `check_interval` seconds
+    and reloaded when its modification time changed. If the reloaded file
+    can't be read the previous blacklist is kept.
+    """
+
+    def __init__(self, path, check_interval=5):
+        """
+        :type path: str
+        :type check_interval: float
+
+        :param path: Path of the blacklist file
+        :param check_interval: Minimum number of seconds between two checks of the file
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._version = self._file_version()
+        self.entity_ids = self._load()
+        self._checked_at = time.monotonic()
+
+    def _file_version(self):
+        # also changes when the file is replaced within the resolution of the modification time
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _load(self):
+        with open(self.path) as blacklist_file:
+            return frozenset(json.load(blacklist_file)['blacklist'])
+
+    def _reload_if_modified(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval or not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = now
+            version = self._file_version()
+            if version != self._version:
+                self.entity_ids = self._load()
+                self._version = version
+                logger.info("Reloaded IdP blacklist {} with {} entries".format(self.path, len(self.entity_ids)))
+        except Exception as err:
+            logger.error("Keeping the previous IdP blacklist, could not reload {}: {}".format(self.path, err))
+        finally:
+            self._lock.release()
+
+    def __contains__(self, entity_id):
+        self._reload_if_modified()
+        return entity_id in self.entity_ids
+
+    def __len__(self):
+        return len(self.entity_ids)
+
+
+class IdPIndex(object):
+    """
+    The IdPs in the loaded metadata, with their single sign-on endpoints.
+
+    The index is built when the metadata is loaded so that the IdPs are not
+    enumerated for every request. The endpoints of the IdPs of a metadata
+    index are only read when they are used, so that the entities of the index
+    are not all decoded. IdPs which are only looked up on demand, e.g. through
+    MDQ, are not included.
+    """
+
+    def __init__(self, metadata):
+        """
+        :type metadata: saml2.mdstore.MetadataStore
+        :param metadata: The loaded metadata
+        """
+        self.metadata = metadata
+        # only the endpoints are kept, the entities stay in the metadata store
+        self.sso_endpoints = {}
+        entity_ids = {}
+        for md in metadata.metadata.values():
+            if isinstance(md, IndexedMetaData):
+                entity_ids.update(dict.fromkeys(md.entity_ids_with_descriptor("idpsso")))
+                continue
+            for entity_id, entity in md.with_descriptor("idpsso").items():
+                self.sso_endpoints[entity_id] = self._endpoints(entity)
+                entity_ids[entity_id] = None
+        self._entity_ids = tuple(entity_ids)
+        self.entity_ids = frozenset(entity_ids)
+
+    @staticmethod
+    def _endpoints(entity):
+        return tuple(
+            (service["binding"], service["location"])
+            for descriptor in entity["idpsso_descriptor"]
+            for service in descriptor.get("single_sign_on_service", [])
+        )
+
+    def endpoints(self, entity_id):
+        """
+        :type entity_id: str
+        :rtype: tuple[(str, str)]
+
+        :param entity_id: The entity id of an IdP
+        :return: The binding and location of the single sign-on endpoints of the IdP, none if
+        it is not in the index
+        """
+        if entity_id in self.sso_endpoints:
+            return self.sso_endpoints[entity_id]
+        if entity_id not in self.entity_ids:
+            return ()
+        try:
+            return self._endpoints(self.metadata[entity_id])
+        except KeyError:
+            # the metadata was refreshed meanwhile
+            return ()
+
+    def __iter__(self):
+        return iter(self._entity_ids)
+
+    def __len__(self):
+        return len(self.entity_ids)
+
+    def __contains__(self, entity_id):
+        return entity_id in self.entity_ids
+
+    @property
+    def only_entity_id(self):
+        """
+        :rtype: str | None
+        :return: The entity id of the IdP if there is exactly one IdP
+        """
+        if len(self.entity_ids) != 1:
+            return None
+        return next(iter(self.entity_ids))
+
+
 class SAMLBackend(BackendModule, SAMLBaseModule):
     """
     A saml2 backend module (acting as a SP).
@@ -84,6 +274,11 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
     KEY_MIRROR_FORCE_AUTHN = 'mirror_force_authn'
     KEY_MEMORIZE_IDP = 'memorize_idp'
     KEY_USE_MEMORIZED_IDP_WHEN_FORCE_AUTHN = 'use_memorized_idp_when_force_authn'
+    KEY_OUTSTANDING_QUERIES_STORE = 'outstanding_queries_store'
+    KEY_IDP_BLACKLIST_FILE = 'idp_blacklist_file'
+    KEY_IDP_BLACKLIST_CHECK_INTERVAL = 'idp_blacklist_check_interval'
+    KEY_METADATA_REFRESH = 'metadata_refresh'
+    KEY_METADATA_INDEX = 'metadata_index'
 
     VALUE_ACR_COMPARISON_DEFAULT = 'exact'
 
@@ -110,11 +305,30 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
             config[SAMLBackend.KEY_SP_CONFIG]), False
         )
         self.sp = Base(sp_config)
+        self.dynamic_metadata = "mdq" in config[SAMLBackend.KEY_SP_CONFIG]["metadata"]
+        self.metadata_index_conf = config.get(SAMLBackend.KEY_METADATA_INDEX)
+        if self.metadata_index_conf:
+            add_metadata_index(self.sp.metadata, **self.metadata_index_conf)
+            self.sp.sourceid = self.sp.metadata.construct_source_id()
+        self.idp_index = IdPIndex(self.sp.metadata)
+        self.metadata_refreshers = []
+        refresh_conf = config.get(SAMLBackend.KEY_METADATA_REFRESH)
+        if refresh_conf:
+            sources = create_metadata_sources(self.sp.metadata, config[SAMLBackend.KEY_SP_CONFIG]["metadata"])
+            if self.metadata_index_conf:
+                sources.append(MetadataIndexSource(self.sp.metadata, **self.metadata_index_conf))
+            self.metadata_refreshers = create_metadata_refreshers(sources, refresh_conf, self._metadata_refreshed)
 
         self.discosrv = config.get(SAMLBackend.KEY_DISCO_SRV)
         self.encryption_keys = []
-        self.outstanding_queries = {}
-        self.idp_blacklist_file = config.get('idp_blacklist_file', None)
+        self.outstanding_queries = OutstandingQueries(self._load_outstanding_queries_store(config))
+        self.idp_blacklist_file = config.get(SAMLBackend.KEY_IDP_BLACKLIST_FILE, None)
+        self.idp_blacklist = None
+        if self.idp_blacklist_file:
+            self.idp_blacklist = IdPBlacklist(
+                self.idp_blacklist_file,
+                config.get(SAMLBackend.KEY_IDP_BLACKLIST_CHECK_INTERVAL, 5),
+            )
 
         sp_keypairs = sp_config.getattr('encryption_keypairs', '')
         sp_key_file = sp_config.getattr('key_file', '')
@@ -129,6 +343,64 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
             with open(p) as key_file:
                 self.encryption_keys.append(key_file.read())
 
+    def _load_outstanding_queries_store(self, config):
+        """
+        Loads the store of the outstanding requests, by default a store in
+        memory. The requests expire with the state cookie, unless another
+        ttl is configured.
+
+        :type config: dict[str, Any]
+        :rtype: satosa.state_store.StateStore
+        """
+        store_config = config.get(SAMLBackend.KEY_OUTSTANDING_QUERIES_STORE)
+        if not store_config:
+            return MemoryStateStore(ttl=STATE_COOKIE_MAX_AGE)
+        return load_store(store_config, STATE_COOKIE_MAX_AGE, "outstanding queries store")
+
+    @property
+    def outstanding_queries_stats(self):
+        """
+        :rtype: dict[str, int]
+        :return: The number of outstanding requests, and of the requests which expired or were
+        dropped without a response
+        """
+        store = self.outstanding_queries.store
+        return {
+            "size": len(store),
+            "expired": store.stats["expired"],
+            "dropped": store.stats["dropped"],
+        }
+
+    def reload_metadata(self):
+        """
+        Reloads the metadata of the identity providers from the configured sources.
+
+        :rtype: bool
+        :return: True if the metadata was reloaded
+        """
+        with metadata_store_lock(self.sp.metadata):
+            previous_metadata = self.sp.metadata.metadata
+            reloaded = self.sp.reload_metadata(self.config[SAMLBackend.KEY_SP_CONFIG]["metadata"])
+            if reloaded:
+                if self.metadata_index_conf:
+                    add_metadata_index(self.sp.metadata, **self.metadata_index_conf)
+                    self.sp.sourceid = self.sp.metadata.construct_source_id()
+                    close_replaced_indexes(previous_metadata, self.sp.metadata)
+                self.idp_index = IdPIndex(self.sp.metadata)
+        return reloaded
+
+    def _metadata_refreshed(self):
+        self.sp.sourceid = self.sp.metadata.construct_source_id()
+        self.idp_index = IdPIndex(self.sp.metadata)
+
+    @property
+    def metadata_refresh_stats(self):
+        """
+        :rtype: dict[str, dict[str, int]]
+        :return: The refresh counters, duration and entity count of each refreshed metadata source
+        """
+        return {refresher.source.key: dict(refresher.stats) for refresher in self.metadata_refreshers}
+
     def get_idp_entity_id(self, context):
         """
         :type context: satosa.context.Context
@@ -138,13 +410,7 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
         :return: the entity_id of the idp or None
         """
 
-        idps = self.sp.metadata.identity_providers()
-        only_one_idp_in_metadata = (
-            "mdq" not in self.config["sp_config"]["metadata"]
-            and len(idps) == 1
-        )
-
-        only_idp = only_one_idp_in_metadata and idps[0]
+        only_idp = not self.dynamic_metadata and self.idp_index.only_entity_id
         target_entity_id = context.get_decoration(Context.KEY_TARGET_ENTITYID)
         force_authn = get_force_authn(context, self.config, self.sp.config)
         memorized_idp = get_memorized_idp(context, self.config, force_authn)
@@ -172,7 +438,7 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
         :type internal_req: satosa.internal.InternalData
         :rtype: satosa.response.Response
         """
-
+        start_metadata_refreshers(self.metadata_refreshers)
         entity_id = self.get_idp_entity_id(context)
         if entity_id is None:
             # since context is not passed to disco_query
@@ -252,12 +518,9 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
 
         # If IDP blacklisting is enabled and the selected IDP is blacklisted,
         # stop here
-        if self.idp_blacklist_file:
-            with open(self.idp_blacklist_file) as blacklist_file:
-                blacklist_array = json.load(blacklist_file)['blacklist']
-                if entity_id in blacklist_array:
-                    satosa_logging(logger, logging.DEBUG, "IdP with EntityID {} is blacklisted".format(entity_id), context.state, exc_info=False)
-                    raise SATOSAAuthenticationError(context.state, "Selected IdP is blacklisted for this backend")
+        if self.idp_blacklist is not None and entity_id in self.idp_blacklist:
+            satosa_logging(logger, logging.DEBUG, "IdP with EntityID {} is blacklisted".format(entity_id), context.state, exc_info=False)
+            raise SATOSAAuthenticationError(context.state, "Selected IdP is blacklisted for this backend")
 
         kwargs = {}
         authn_context = self.construct_requested_authn_context(entity_id)
@@ -305,6 +568,7 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
         :param binding: The saml binding type
         :return: response
         """
+        start_metadata_refreshers(self.metadata_refreshers)
         if not context.request["SAMLResponse"]:
             satosa_logging(logger, logging.DEBUG, "Missing Response for state", context.state)
             raise SATOSAAuthenticationError(context.state, "Missing Response")
@@ -359,6 +623,11 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
             satosa_logging(logger, logging.DEBUG, "No IDP chosen for state", state, exc_info=True)
             raise SATOSAAuthenticationError(state, "No IDP chosen") from err
 
+        if not self.dynamic_metadata and not self.idp_index.endpoints(entity_id):
+            satosa_logging(logger, logging.DEBUG,
+                           "IdP with EntityID {} chosen but not in the metadata".format(entity_id), state)
+            raise SATOSAAuthenticationError(state, "Unknown IDP chosen")
+
         return self.authn_request(context, entity_id)
 
     def _translate_response(self, response, state):
@@ -466,8 +735,8 @@ class SAMLBackend(BackendModule, SAMLBaseModule):
         """
         entity_descriptions = []
 
-        idp_entities = self.sp.metadata.with_descriptor("idpsso")
-        for entity_id, entity in idp_entities.items():
+        for entity_id in self.idp_index:
+            entity = self.sp.metadata[entity_id]
             description = MetadataDescription(urlsafe_b64encode(entity_id.encode("utf-8")).decode("utf-8"))
 
             # Add organization info
@@ -18,8 +18,9 @@ from .micro_services.account_linking import AccountLinking
 from .micro_services.consent import Consent
 from .plugin_loader import load_backends, load_frontends
 from .plugin_loader import load_request_microservices, load_response_microservices
+from .plugin_loader import load_state_store
 from .routing import ModuleRouter, SATOSANoBoundEndpointError
-from .state import cookie_to_state, SATOSAStateError, State, state_to_cookie
+from .state import cookie_to_state, SATOSAStateError, State, STATE_STATS, state_to_cookie
 
 from satosa.deprecated import hash_attributes
 
@@ -60,6 +61,7 @@ class SATOSABase(object):
                     " Use the hasher microservice instead."
                 ).format(opt=option)
                 _warnings.warn(msg, DeprecationWarning)
+        self.hash_attributes = self.config["INTERNAL_ATTRIBUTES"].get("hash", [])
 
         logger.info("Loading backend modules...")
         backends = load_backends(self.config, self._auth_resp_callback_func,
@@ -90,6 +92,8 @@ class SATOSABase(object):
         self.module_router = ModuleRouter(frontends, backends,
                                           self.request_micro_services + self.response_micro_services)
 
+        self.state_store = load_state_store(self.config)
+
     def _link_micro_services(self, micro_services, finisher):
         if not micro_services:
             return
@@ -155,11 +159,12 @@ class SATOSABase(object):
         if user_id_to_attr:
             internal_response.attributes[user_id_to_attr] = [internal_response.subject_id]
 
-        hash_attributes(
-            self.config["INTERNAL_ATTRIBUTES"].get("hash", []),
-            internal_response.attributes,
-            self.config.get("USER_ID_HASH_SALT", ""),
-        )
+        if self.hash_attributes:
+            hash_attributes(
+                self.hash_attributes,
+                internal_response.attributes,
+                self.config.get("USER_ID_HASH_SALT", ""),
+            )
 
         # remove all session state unless CONTEXT_STATE_DELETE is False
         context.state.delete = self.config.get("CONTEXT_STATE_DELETE", True)
@@ -229,7 +234,7 @@ class SATOSABase(object):
             return spec(context)
         except SATOSAAuthenticationError as error:
             error.error_id = uuid.uuid4().urn
-            state = json.dumps(error.state.state_dict, indent=4)
+            state = json.dumps(error.state.data, indent=4)
             msg = "ERROR_ID [{err_id}]\nSTATE:\n{state}".format(
                 err_id=error.error_id, state=state
             )
@@ -241,6 +246,8 @@ class SATOSABase(object):
         """
         Load state from cookie to the context
 
+        The state is only decoded when it is accessed for the first time.
+
         :type context: satosa.context.Context
         :param context: Session context
         """
@@ -249,28 +256,37 @@ class SATOSABase(object):
                 context.cookie,
                 self.config["COOKIE_STATE_NAME"],
                 self.config["STATE_ENCRYPTION_KEY"],
+                self.state_store,
+                lazy=True,
             )
         except SATOSAStateError as e:
             state = State()
         finally:
             context.state = state
-            msg = "Loaded state {state} from cookie {cookie}".format(state=state, cookie=context.cookie)
-            logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
-            logger.info(logline)
+            if logger.isEnabledFor(logging.DEBUG):
+                msg = "Loaded state {state} from cookie {cookie}".format(state=state, cookie=context.cookie)
+                logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
+                logger.debug(logline)
 
     def _save_state(self, resp, context):
         """
         Saves a state from context to cookie
 
+        The cookie is left untouched if the state was not changed.
+
         :type resp: satosa.response.Response
         :type context: satosa.context.Context
 
         :param resp: The response
         :param context: Session context
         """
+        if not context.state.delete and not context.state.is_modified:
+            STATE_STATS["skipped"] += 1
+            return
 
         cookie = state_to_cookie(context.state, self.config["COOKIE_STATE_NAME"], "/",
-                                 self.config["STATE_ENCRYPTION_KEY"])
+                                 self.config["STATE_ENCRYPTION_KEY"],
+                                 self.config.get("STATE_CODEC"), self.state_store)
         resp.headers.append(tuple(cookie.output().split(": ", 1)))
 
     def run(self, context):
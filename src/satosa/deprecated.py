@@ -266,7 +266,6 @@ def hash_attributes(hash_attributes, internal_attributes, salt):
     for attribute in hash_attributes:
         # hash all attribute values individually
         if attribute in internal_attributes:
-            hashed_values = [
-                util.hash_data(salt, v) for v in internal_attributes[attribute]
-            ]
-            internal_attributes[attribute] = hashed_values
+            internal_attributes[attribute] = util.hash_values(
+                salt, internal_attributes[attribute]
+            )
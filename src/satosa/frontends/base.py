@@ -81,6 +81,8 @@ class FrontendModule(object):
                 return urls
 
         :return: A list with functions and args bound to a specific endpoint url,
-                 [(regexp, function), ...]
+                 [(regexp, function), ...]. An entry may carry a guard as third element,
+                 (regexp, function, guard), called with the match of the regexp and returning
+                 whether the frontend handles the path; if not, it is left to the other modules.
         """
         raise NotImplementedError()
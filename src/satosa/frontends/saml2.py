@@ -5,7 +5,8 @@ import copy
 import functools
 import json
 import logging
-import re
+import sys
+import threading
 from base64 import urlsafe_b64decode
 from base64 import urlsafe_b64encode
 from urllib.parse import quote
@@ -31,6 +32,13 @@ from satosa.base import SAMLBaseModule
 from satosa.context import Context
 from .base import FrontendModule
 from ..logging_util import satosa_logging
+from ..metadata_index import MetadataIndexSource
+from ..metadata_index import add_metadata_index
+from ..metadata_index import close_replaced_indexes
+from ..metadata_refresh import create_metadata_sources
+from ..metadata_refresh import metadata_store_lock
+from ..metadata_refresh import create_metadata_refreshers
+from ..metadata_refresh import start_metadata_refreshers
 from ..response import Response
 from ..response import ServiceError
 from ..saml_util import make_saml_response
@@ -59,6 +67,34 @@ def subject_type_to_saml_nameid_format(subject_type):
     return subject_type_map.get(subject_type, NAMEID_FORMAT_PERSISTENT)
 
 
+def _approximate_size(obj, exclude=()):
+    """
+    Approximates the memory used by an object graph, not counting the
+    excluded objects and anything only reachable through them.
+
+    :type obj: Any
+    :type exclude: Iterable[Any]
+    :rtype: int
+    """
+    seen = {id(o) for o in exclude}
+    size = 0
+    pending = [obj]
+    while pending:
+        current = pending.pop()
+        if id(current) in seen or isinstance(current, type):
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        if isinstance(current, dict):
+            pending.extend(current.keys())
+            pending.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            pending.extend(current)
+        elif hasattr(current, "__dict__"):
+            pending.append(vars(current))
+    return size
+
+
 class SAMLFrontend(FrontendModule, SAMLBaseModule):
     """
     A pysaml2 frontend module
@@ -66,6 +102,8 @@ class SAMLFrontend(FrontendModule, SAMLBaseModule):
     KEY_CUSTOM_ATTR_RELEASE = 'custom_attribute_release'
     KEY_ENDPOINTS = 'endpoints'
     KEY_IDP_CONFIG = 'idp_config'
+    KEY_METADATA_REFRESH = 'metadata_refresh'
+    KEY_METADATA_INDEX = 'metadata_index'
 
     def __init__(self, auth_req_callback_func, internal_attributes, config, base_url, name):
         self._validate_config(config)
@@ -77,6 +115,7 @@ class SAMLFrontend(FrontendModule, SAMLBaseModule):
         self.custom_attribute_release = config.get(
             self.KEY_CUSTOM_ATTR_RELEASE)
         self.idp = None
+        self.metadata_refreshers = []
 
     def handle_authn_response(self, context, internal_response):
         """
@@ -120,8 +159,66 @@ class SAMLFrontend(FrontendModule, SAMLBaseModule):
         # Create the idp
         idp_config = IdPConfig().load(copy.deepcopy(self.idp_config), metadata_construction=False)
         self.idp = Server(config=idp_config)
+        index_conf = self.config.get(self.KEY_METADATA_INDEX)
+        if index_conf:
+            add_metadata_index(self.idp.metadata, **index_conf)
+            self.idp.sourceid = self.idp.metadata.construct_source_id()
+        refresh_conf = self.config.get(self.KEY_METADATA_REFRESH)
+        if refresh_conf:
+            sources = create_metadata_sources(self.idp.metadata, self.idp_config["metadata"])
+            if index_conf:
+                sources.append(MetadataIndexSource(self.idp.metadata, **index_conf))
+            self.metadata_refreshers = create_metadata_refreshers(sources, refresh_conf, self._metadata_refreshed)
         return self._register_endpoints(backend_names)
 
+    def _metadata_refreshed(self):
+        self.idp.sourceid = self.idp.metadata.construct_source_id()
+
+    @property
+    def metadata_refresh_stats(self):
+        """
+        :rtype: dict[str, dict[str, int]]
+        :return: The refresh counters, duration and entity count of each refreshed metadata source
+        """
+        return {refresher.source.key: dict(refresher.stats) for refresher in self.metadata_refreshers}
+
+    def reload_metadata(self):
+        """
+        Reloads the metadata of the service providers from the configured sources.
+
+        :rtype: bool
+        :return: True if the metadata was reloaded
+        """
+        with metadata_store_lock(self.idp.metadata):
+            previous_metadata = self.idp.metadata.metadata
+            reloaded = self.idp.reload_metadata(self.idp_config["metadata"])
+            index_conf = self.config.get(self.KEY_METADATA_INDEX)
+            if reloaded and index_conf:
+                add_metadata_index(self.idp.metadata, **index_conf)
+                self._metadata_refreshed()
+                close_replaced_indexes(previous_metadata, self.idp.metadata)
+        return reloaded
+
+    def _create_idp_sharing_metadata(self, idp_conf):
+        """
+        Creates an idp server from a variant of the frontend idp config (e.g. with other endpoints
+        or entity id). The metadata, policy and security context of the frontend idp are reused
+        instead of being loaded again.
+
+        :type idp_conf: dict[str, Any]
+        :rtype: saml.server.Server
+
+        :param idp_conf: The idp config, the metadata config in it is ignored
+        :return: An idp server
+        """
+        idp_conf = {k: v for k, v in idp_conf.items() if k != "metadata"}
+        idp_config = IdPConfig().load(idp_conf, metadata_construction=False)
+        idp_config.metadata = self.idp.metadata
+        idp_config.setattr("idp", "policy", self.idp.config.getattr("policy", "idp"))
+        idp = Server(config=idp_config)
+        idp.sec = self.idp.sec
+        return idp
+
     def _create_state_data(self, context, resp_args, relay_state):
         """
         Returns a dict containing the state needed in the response flow.
@@ -188,6 +285,7 @@ class SAMLFrontend(FrontendModule, SAMLBaseModule):
         :param idp: The saml frontend idp server
         :return: response
         """
+        start_metadata_refreshers(self.metadata_refreshers)
         req_info = idp.parse_authn_request(context.request["SAMLRequest"], binding_in)
         authn_req = req_info.message
         satosa_logging(logger, logging.DEBUG, "%s" % authn_req, context.state)
@@ -299,6 +397,7 @@ class SAMLFrontend(FrontendModule, SAMLBaseModule):
         :param idp: The saml frontend idp server
         :return: A saml response
         """
+        start_metadata_refreshers(self.metadata_refreshers)
         request_state = self.load_state(context.state)
 
         resp_args = request_state["resp_args"]
@@ -562,7 +661,69 @@ class SAMLFrontend(FrontendModule, SAMLBaseModule):
 class SAMLMirrorFrontend(SAMLFrontend):
     """
     Frontend module that uses dynamic entity id and partially dynamic endpoints.
+
+    The dynamic idp servers are kept in a LRU cache and share the metadata, policy and security
+    context of the frontend idp.
     """
+    KEY_IDP_SERVER_CACHE_SIZE = 'idp_server_cache_size'
+    VALUE_IDP_SERVER_CACHE_SIZE_DEFAULT = 256
+
+    def __init__(self, auth_req_callback_func, internal_attributes, config, base_url, name):
+        super().__init__(auth_req_callback_func, internal_attributes, config, base_url, name)
+        cache_size = self.config.get(
+            self.KEY_IDP_SERVER_CACHE_SIZE, self.VALUE_IDP_SERVER_CACHE_SIZE_DEFAULT)
+        self._get_idp_server = functools.lru_cache(maxsize=cache_size)(self._create_dynamic_idp)
+
+    @property
+    def idp_server_cache_stats(self):
+        """
+        :rtype: dict[str, int | float]
+        :return: hits, misses, size and hit rate of the idp server cache
+        """
+        info = self._get_idp_server.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            "hits": info.hits,
+            "misses": info.misses,
+            "size": info.currsize,
+            "maxsize": info.maxsize,
+            "hit_rate": info.hits / lookups if lookups else 0.0,
+        }
+
+    def reload_metadata(self):
+        """
+        See super class satosa.frontends.saml2.SAMLFrontend#reload_metadata
+        """
+        reloaded = super().reload_metadata()
+        self._get_idp_server.cache_clear()
+        return reloaded
+
+    def _metadata_refreshed(self):
+        super()._metadata_refreshed()
+        # the cached idp servers derived state, e.g. the source id, from the previous metadata
+        self._get_idp_server.cache_clear()
+
+    def _create_dynamic_idp(self, provider, target_entity_id, dynamic_endpoints):
+        """
+        Creates an idp server for the target entity id.
+
+        :type provider: str
+        :type target_entity_id: str
+        :type dynamic_endpoints: bool
+        :rtype: saml.server.Server
+
+        :param provider: target backend name
+        :param target_entity_id: frontend target entity id
+        :param dynamic_endpoints: if True, the endpoints are made dynamic, else the entity id
+        :return: An idp server
+        """
+        idp_conf = {k: v for k, v in self.idp_config.items() if k != "metadata"}
+        if dynamic_endpoints:
+            idp_conf = self._load_endpoints_to_config(provider, target_entity_id, config=idp_conf)
+        else:
+            idp_conf = copy.deepcopy(idp_conf)
+            idp_conf["entityid"] = "{}/{}".format(self.idp_config["entityid"], target_entity_id)
+        return self._create_idp_sharing_metadata(idp_conf)
 
     def _load_endpoints_to_config(self, provider, target_entity_id, config=None):
         """
@@ -601,9 +762,7 @@ class SAMLMirrorFrontend(SAMLFrontend):
         :return: An idp server
         """
         target_entity_id = context.target_entity_id_from_path()
-        idp_conf_file = self._load_endpoints_to_config(context.target_backend, target_entity_id)
-        idp_config = IdPConfig().load(idp_conf_file, metadata_construction=False)
-        return Server(config=idp_config)
+        return self._get_idp_server(context.target_backend, target_entity_id, True)
 
     def _load_idp_dynamic_entity_id(self, state):
         """
@@ -616,10 +775,7 @@ class SAMLMirrorFrontend(SAMLFrontend):
         :return: An idp server
         """
         # Change the idp entity id dynamically
-        idp_config_file = copy.deepcopy(self.idp_config)
-        idp_config_file["entityid"] = "{}/{}".format(self.idp_config["entityid"], state[self.name]["target_entity_id"])
-        idp_config = IdPConfig().load(idp_config_file, metadata_construction=False)
-        return Server(config=idp_config)
+        return self._get_idp_server(None, state[self.name]["target_entity_id"], False)
 
     def handle_authn_request(self, context, binding_in):
         """
@@ -707,6 +863,57 @@ class SAMLVirtualCoFrontend(SAMLFrontend):
     KEY_ENCODEABLE_NAME = 'encodeable_name'
     KEY_ORGANIZATION = 'organization'
     KEY_ORGANIZATION_KEYS = ['display_name', 'name', 'url']
+    KEY_WARM_UP_CO_IDPS = 'warm_up_co_idps'
+
+    def __init__(self, auth_req_callback_func, internal_attributes, config, base_url, name):
+        super().__init__(auth_req_callback_func, internal_attributes, config, base_url, name)
+        self._co_configs = {co[self.KEY_ENCODEABLE_NAME]: co for co in self.config[self.KEY_CO]}
+        # Virtual IdPs by (CO name, backend name), created on first use
+        self._co_idps = {}
+        self._co_idp_sizes = {}
+        self._co_idps_lock = threading.Lock()
+
+    def register_endpoints(self, backend_names):
+        """
+        See super class satosa.frontends.base.FrontendModule#register_endpoints
+
+        Creates the virtual IdPs for all COs and backends up front if
+        warm_up_co_idps is set.
+        """
+        url_map = super().register_endpoints(backend_names)
+        if self.config.get(self.KEY_WARM_UP_CO_IDPS, False):
+            for co_name in self._co_names_from_config():
+                for backend_name in backend_names:
+                    self._get_co_idp(co_name, backend_name)
+            logger.info("Created {} virtual CO IdPs using {} bytes".format(
+                len(self._co_idps), sum(self._co_idp_sizes.values())))
+        return url_map
+
+    @property
+    def co_idp_stats(self):
+        """
+        :rtype: dict[(str, str), int]
+        :return: The approximate memory in bytes used by each cached virtual IdP, not counting
+        the metadata, policy and keys it shares with the other IdPs
+        """
+        return dict(self._co_idp_sizes)
+
+    def reload_metadata(self):
+        """
+        See super class satosa.frontends.saml2.SAMLFrontend#reload_metadata
+        """
+        reloaded = super().reload_metadata()
+        with self._co_idps_lock:
+            self._co_idps.clear()
+            self._co_idp_sizes.clear()
+        return reloaded
+
+    def _metadata_refreshed(self):
+        super()._metadata_refreshed()
+        # the virtual IdPs derived state, e.g. the source id, from the previous metadata
+        with self._co_idps_lock:
+            self._co_idps.clear()
+            self._co_idp_sizes.clear()
 
     def handle_authn_request(self, context, binding_in):
         """
@@ -794,9 +1001,7 @@ class SAMLVirtualCoFrontend(SAMLFrontend):
 
         """
         co_name = self._get_co_name(context)
-        for co in self.config[self.KEY_CO]:
-            if co[self.KEY_ENCODEABLE_NAME] == co_name:
-                return co
+        return self._co_configs.get(co_name)
 
     def _get_co_name_from_path(self, context):
         """
@@ -921,11 +1126,7 @@ class SAMLVirtualCoFrontend(SAMLFrontend):
 
         :return: config with updated details for SAML metadata
         """
-        all_co_configs = self.config[self.KEY_CO]
-        co_config = next(
-            item for item in all_co_configs
-            if item[self.KEY_ENCODEABLE_NAME] == co_name
-        )
+        co_config = self._co_configs[co_name]
 
         key = self.KEY_ORGANIZATION
         if key in co_config:
@@ -941,6 +1142,19 @@ class SAMLVirtualCoFrontend(SAMLFrontend):
 
         return config
 
+    def _is_configured_co(self, match):
+        """
+        Guard of the endpoints, only paths of configured COs are handled
+        by this frontend.
+
+        :type match: re.Match
+        :rtype: bool
+
+        :param match: The match of an endpoint regex on the request path
+        :return: True if the CO name in the path is one of a configured CO
+        """
+        return unquote_plus(match.group("co_name")) in self._co_configs
+
     def _co_names_from_config(self):
         """
         Parse the configuration for the names of the COs for which to
@@ -950,10 +1164,7 @@ class SAMLVirtualCoFrontend(SAMLFrontend):
 
         :return: list of CO names
         """
-        co_names = [co[self.KEY_ENCODEABLE_NAME] for
-                    co in self.config[self.KEY_CO]]
-
-        return co_names
+        return list(self._co_configs)
 
     def _create_co_virtual_idp(self, context):
         """
@@ -973,31 +1184,60 @@ class SAMLVirtualCoFrontend(SAMLFrontend):
         # SATOSA core code threw an exception before getting here, but we
         # include this check in case later the regex used to register the
         # endpoints is relaxed.
-        co_names = self._co_names_from_config()
-        if co_name not in co_names:
-            msg = "CO {} not in configured list of COs {}".format(co_name,
-                                                                  co_names)
+        if co_name not in self._co_configs:
+            msg = "CO {} not in configured list of COs".format(co_name)
             satosa_logging(logger, logging.WARN, msg, context.state)
             raise SATOSAError(msg)
 
+        server = self._get_co_idp(co_name, context.target_backend)
+        context.decorate(self.KEY_CO_ENTITY_ID, server.config.entityid)
+
+        return server
+
+    def _get_co_idp(self, co_name, backend_name):
+        """
+        Returns the virtual IdP for the CO and backend, creating it on
+        first use.
+
+        :type co_name: str
+        :type backend_name: str
+        :rtype: saml.server.Server
+
+        :param co_name: CO name
+        :param backend_name: The target backend name
+        :return: An idp server
+        """
+        key = (co_name, backend_name)
+        server = self._co_idps.get(key)
+        if server is not None:
+            return server
+
+        with self._co_idps_lock:
+            server = self._co_idps.get(key)
+            if server is None:
+                server = self._create_co_idp(co_name, backend_name)
+                self._co_idp_sizes[key] = _approximate_size(
+                    server, exclude=[self.idp.metadata, self.idp.sec,
+                                     self.idp.config.getattr("policy", "idp")])
+                self._co_idps[key] = server
+        return server
+
+    def _create_co_idp(self, co_name, backend_name):
         # Make a copy of the general IdP config that we will then overwrite
         # with mappings between SAML bindings and CO specific URL endpoints,
         # and the entityID for the CO virtual IdP.
-        backend_name = context.target_backend
-        idp_config = copy.deepcopy(self.idp_config)
+        idp_config = {k: v for k, v in self.idp_config.items()
+                      if k != "metadata"}
+        idp_config = copy.deepcopy(idp_config)
         idp_config = self._add_endpoints_to_config(idp_config,
                                                    co_name,
                                                    backend_name)
-        idp_config = self._add_entity_id(context, idp_config, co_name)
-
-        # Use the overwritten IdP config to generate a pysaml2 config object
-        # and from it a server object.
-        pysaml2_idp_config = IdPConfig().load(idp_config,
-                                              metadata_construction=False)
+        idp_config['entityid'] = "{}/{}".format(idp_config['entityid'],
+                                                quote_plus(co_name))
 
-        server = Server(config=pysaml2_idp_config)
-
-        return server
+        # Use the overwritten IdP config to generate a pysaml2 server
+        # object sharing the metadata with the frontend IdP.
+        return self._create_idp_sharing_metadata(idp_config)
 
     def _register_endpoints(self, backend_names):
         """
@@ -1012,22 +1252,15 @@ class SAMLVirtualCoFrontend(SAMLFrontend):
 
         {base}/{backend}/{co_name}/sso/redirect
 
+        The CO name segment matches any name, the guard of the endpoint
+        leaves the paths of unknown COs to the other modules.
+
         :type providers: list[str]
         :rtype list[(str, ((satosa.context.Context, Any) ->
-                    satosa.response.Response, Any))] |
-               list[(str, (satosa.context.Context) ->
-                    satosa.response.Response)]
+                    satosa.response.Response, Any), (re.Match) -> bool)]
         :param backend_names: A list of backend names
-        :return: A list of url and endpoint function pairs
+        :return: A list of url, endpoint function and guard tuples
         """
-        # Create a regex pattern that will match any of the CO names. We
-        # escape special characters like '+' and '.' that are valid
-        # characters in an URL encoded string.
-        co_names = self._co_names_from_config()
-        url_encoded_co_names = [re.escape(quote_plus(name)) for name in
-                                co_names]
-        co_name_pattern = "|".join(url_encoded_co_names)
-
         # Create a regex pattern that will match any of the backend names.
         backend_url_pattern = "|^".join(backend_names)
         logger.debug("Input backend names are {}".format(backend_names))
@@ -1055,9 +1288,8 @@ class SAMLVirtualCoFrontend(SAMLFrontend):
                 # Use the backend URL pattern and the endpoint path to create
                 # a regex that will match and that includes a pattern for
                 # matching the URL encoded CO name.
-                regex_pattern = "(^{})/({})/{}".format(
+                regex_pattern = "(^{})/(?P<co_name>[^/]+)/{}".format(
                                 backend_url_pattern,
-                                co_name_pattern,
                                 endpoint_path)
                 logger.debug("Created URL regex {}".format(regex_pattern))
 
@@ -1066,7 +1298,7 @@ class SAMLVirtualCoFrontend(SAMLFrontend):
                                                  binding_in=binding)
                 logger.debug("Created callable {}".format(the_callable))
 
-                mapping = (regex_pattern, the_callable)
+                mapping = (regex_pattern, the_callable, self._is_configured_co)
                 url_to_callable_mappings.append(mapping)
                 logger.debug("Adding mapping {}".format(mapping))
 
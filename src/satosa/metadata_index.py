@@ -0,0 +1,335 @@
+"""
+A compact, memory mapped index of SAML metadata shared by the worker processes.
+
+Every worker that loads a large metadata aggregate keeps its own parsed copy of every entity.
+The index is instead built once, by a loader process, into a file that the workers map
+read-only: the pages of the file are shared between the processes through the page cache, and
+an entity is only decoded when it is looked up.
+
+The file starts with a header and fixed width columns, sorted by the hash of the entity id:
+
+    magic | count | hashes (count * Q) | offsets (count * Q) | lengths (count * Q) | flags (count * Q)
+
+followed by one record per entity, the entity id and the pysaml2 representation of the entity
+as JSON, separated by a newline. The flags tell which descriptors, e.g. idpsso or spsso, an
+entity has, and whether it has an artifact resolution service, so that the entities are not
+decoded to find them.
+"""
+import bisect
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+from array import array
+from collections.abc import Mapping
+from functools import lru_cache
+
+from saml2.mdstore import InMemoryMetaData
+
+from .metadata_refresh import LocalMetadataSource
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"SATMDX2" + (b"<" if sys.byteorder == "little" else b">")
+HEADER = struct.Struct("=8sQ")
+DESCRIPTORS = [
+    "idpsso_descriptor",
+    "spsso_descriptor",
+    "attribute_authority_descriptor",
+    "authn_authority_descriptor",
+    "pdp_descriptor",
+    "role_descriptor",
+    "affiliation_descriptor",
+]
+# the flag of the entities with an artifact resolution service, which pysaml2 keeps in its source id
+ARTIFACT_RESOLUTION = 1 << len(DESCRIPTORS)
+# the signature is verified when the metadata is loaded, and not needed afterwards
+EXCLUDED_ELEMENTS = {"signature"}
+# seconds a replaced index is kept open for the requests which may still use it
+CLOSE_DELAY = 60
+
+
+def _hash(entity_id):
+    return int.from_bytes(hashlib.sha1(entity_id.encode("utf-8")).digest()[:8], "big")
+
+
+def _flags(entity):
+    flags = sum(1 << i for i, descriptor in enumerate(DESCRIPTORS) if descriptor in entity)
+    if any(
+        "artifact_resolution_service" in service
+        for descriptor in ["spsso_descriptor", "idpsso_descriptor"]
+        for service in entity.get(descriptor, [])
+    ):
+        flags |= ARTIFACT_RESOLUTION
+    return flags
+
+
+def write_metadata_index(entities, path):
+    """
+    Writes the index of the entities to a file. The file is replaced atomically, so the
+    workers never open a partially written index.
+
+    :type entities: collections.abc.Iterable[(str, dict)]
+    :type path: str
+    :rtype: int
+
+    :param entities: The entity ids and the pysaml2 representation of the entities, e.g. the
+    items of a saml2.mdstore.MetadataStore
+    :param path: Path of the index file
+    :return: The number of entities in the index
+    """
+    records = []
+    for entity_id, entity in entities:
+        entity = {key: value for key, value in entity.items() if key not in EXCLUDED_ELEMENTS}
+        body = entity_id.encode("utf-8") + b"\n" + json.dumps(entity, separators=(",", ":")).encode("utf-8")
+        records.append((_hash(entity_id), body, _flags(entity)))
+    records.sort(key=lambda record: record[0])
+
+    count = len(records)
+    offset = HEADER.size + 4 * 8 * count
+    hashes, offsets, lengths, flags = array("Q"), array("Q"), array("Q"), array("Q")
+    for entity_hash, body, entity_flags in records:
+        hashes.append(entity_hash)
+        offsets.append(offset)
+        lengths.append(len(body))
+        flags.append(entity_flags)
+        offset += len(body)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".metadata_index")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, count))
+            for column in [hashes, offsets, lengths, flags]:
+                column.tofile(f)
+            for _, body, _ in records:
+                f.write(body)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    return count
+
+
+def build_metadata_index(metadata_store, path):
+    """
+    Writes the index of all the entities loaded in a metadata store.
+
+    :type metadata_store: saml2.mdstore.MetadataStore
+    :type path: str
+    :rtype: int
+
+    :param metadata_store: The loaded metadata
+    :param path: Path of the index file
+    :return: The number of entities in the index
+    """
+    return write_metadata_index(metadata_store.items(), path)
+
+
+class MetadataIndex(Mapping):
+    """
+    A read-only mapping from entity id to the pysaml2 representation of the entity, backed by
+    a memory mapped index file.
+
+    The most recently looked up entities are kept decoded, up to `cache_size` entities.
+    """
+
+    def __init__(self, path, cache_size=1024):
+        """
+        :type path: str
+        :type cache_size: int
+
+        :param path: Path of the index file
+        :param cache_size: The number of decoded entities to keep
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError("{} is not a metadata index of this version and platform".format(path))
+
+        self._columns = columns = memoryview(self._mmap)[HEADER.size:HEADER.size + 4 * 8 * self._count].cast("Q")
+        self._hashes = columns[:self._count]
+        self._offsets = columns[self._count:2 * self._count]
+        self._lengths = columns[2 * self._count:3 * self._count]
+        self._flags = columns[3 * self._count:]
+        self._entity = lru_cache(cache_size)(self._decode)
+
+    def _entity_id(self, i):
+        offset = self._offsets[i]
+        return self._mmap[offset:self._mmap.find(b"\n", offset)].decode("utf-8")
+
+    def _decode(self, i):
+        offset = self._offsets[i]
+        start = self._mmap.find(b"\n", offset) + 1
+        return json.loads(self._mmap[start:offset + self._lengths[i]])
+
+    def _position(self, entity_id):
+        entity_hash = _hash(entity_id)
+        i = bisect.bisect_left(self._hashes, entity_hash)
+        prefix = entity_id.encode("utf-8") + b"\n"
+        while i < self._count and self._hashes[i] == entity_hash:
+            offset = self._offsets[i]
+            if self._mmap[offset:offset + len(prefix)] == prefix:
+                return i
+            i += 1
+        return None
+
+    def __getitem__(self, entity_id):
+        i = self._position(entity_id)
+        if i is None:
+            raise KeyError(entity_id)
+        return self._entity(i)
+
+    def __contains__(self, entity_id):
+        return self._position(entity_id) is not None
+
+    def __iter__(self):
+        return (self._entity_id(i) for i in range(self._count))
+
+    def __len__(self):
+        return self._count
+
+    def entity_ids(self, flag):
+        """
+        :type flag: int
+        :rtype: list[str]
+
+        :param flag: The flag of a descriptor, or ARTIFACT_RESOLUTION
+        :return: The ids of the entities with the flag, no entity is decoded
+        """
+        return [self._entity_id(i) for i in range(self._count) if self._flags[i] & flag]
+
+    def with_descriptor(self, descriptor):
+        """
+        :type descriptor: str
+        :rtype: dict[str, dict]
+
+        :param descriptor: The type of descriptor, e.g. idpsso
+        :return: The entities with the descriptor, only they are decoded
+        """
+        descriptor = "{}_descriptor".format(descriptor)
+        if descriptor not in DESCRIPTORS:
+            return {entity_id: entity for entity_id, entity in self.items() if descriptor in entity}
+        flag = 1 << DESCRIPTORS.index(descriptor)
+        return {self._entity_id(i): self._decode(i) for i in range(self._count) if self._flags[i] & flag}
+
+    def close(self):
+        self._hashes.release()
+        self._offsets.release()
+        self._lengths.release()
+        self._flags.release()
+        self._columns.release()
+        self._entity.cache_clear()
+        self._mmap.close()
+
+
+class IndexedMetaData(InMemoryMetaData):
+    """
+    Metadata read from a metadata index file, to be added to a pysaml2 metadata store like the
+    metadata of any other source.
+    """
+
+    def __init__(self, attrc, path, cache_size=1024, **kwargs):
+        """
+        :type path: str
+        :type cache_size: int
+
+        :param path: Path of the index file
+        :param cache_size: The number of decoded entities to keep
+        """
+        super().__init__(attrc, **kwargs)
+        self.path = path
+        self.cache_size = cache_size
+
+    def load(self, *args, **kwargs):
+        self.entity = MetadataIndex(self.path, self.cache_size)
+        logger.info("Opened the metadata index {} of {} entities".format(self.path, len(self.entity)))
+        return True
+
+    def with_descriptor(self, descriptor):
+        return self.entity.with_descriptor(descriptor)
+
+    def entity_ids_with_descriptor(self, descriptor):
+        """
+        :type descriptor: str
+        :rtype: list[str]
+
+        :param descriptor: The type of descriptor, e.g. idpsso
+        :return: The ids of the entities with the descriptor, no entity is decoded
+        """
+        return self.entity.entity_ids(1 << DESCRIPTORS.index("{}_descriptor".format(descriptor)))
+
+    def construct_source_id(self):
+        return {
+            hashlib.sha1(entity_id.encode("utf-8")).digest(): self.entity[entity_id]
+            for entity_id in self.entity.entity_ids(ARTIFACT_RESOLUTION)
+        }
+
+    def close(self):
+        self.entity.close()
+
+
+def add_metadata_index(metadata_store, path, cache_size=1024):
+    """
+    Adds the entities of a metadata index file to a metadata store.
+
+    :type metadata_store: saml2.mdstore.MetadataStore
+    :type path: str
+    :type cache_size: int
+    :rtype: satosa.metadata_index.IndexedMetaData
+
+    :param metadata_store: The store to add the entities to
+    :param path: Path of the index file
+    :param cache_size: The number of decoded entities to keep
+    :return: The metadata of the index
+    """
+    metadata = IndexedMetaData(metadata_store.attrc, path, cache_size)
+    metadata.load()
+    metadata_store.metadata[path] = metadata
+    return metadata
+
+
+def close_replaced_indexes(previous_metadata, metadata_store):
+    """
+    Closes the metadata indexes which are no longer in a metadata store, after CLOSE_DELAY
+    seconds, when the requests which looked them up before they were replaced are done.
+
+    :type previous_metadata: dict[str, saml2.mdstore.InMemoryMetaData]
+    :type metadata_store: saml2.mdstore.MetadataStore
+
+    :param previous_metadata: The metadata of the store before it was replaced
+    :param metadata_store: The store
+    """
+    for key, metadata in previous_metadata.items():
+        if not isinstance(metadata, IndexedMetaData) or metadata_store.metadata.get(key) is metadata:
+            continue
+        if CLOSE_DELAY > 0:
+            timer = threading.Timer(CLOSE_DELAY, metadata.close)
+            timer.daemon = True
+            timer.start()
+        else:
+            metadata.close()
+
+
+class MetadataIndexSource(LocalMetadataSource):
+    """
+    A metadata index file, reopened when the loader process replaced it.
+    """
+
+    def __init__(self, metadata_store, path, cache_size=1024):
+        super().__init__(metadata_store, path)
+        self.cache_size = cache_size
+
+    def _load_file(self, path):
+        md = IndexedMetaData(self.metadata_store.attrc, path, self.cache_size)
+        md.load()
+        return md
+
+    def replaced(self, previous_metadata):
+        close_replaced_indexes(previous_metadata, self.metadata_store)
@@ -0,0 +1,338 @@
+"""
+Background refresh of the SAML metadata loaded by the frontends and backends.
+
+The metadata sources of a pysaml2 metadata store are refreshed by one thread per source. A
+source is fetched and parsed, and its signature verified, outside of the request path. The new
+metadata then replaces the previous one in a single assignment, so requests see either the old
+or the new metadata and never a partially loaded store. The refreshers of a store, and the
+reloads of its metadata, replace the metadata while holding the lock of the store, so that they
+don't undo each other's changes. When a refresh fails the previous metadata keeps being served
+and the refresh is retried with an increasing delay.
+
+Threads are not inherited by forked processes, e.g. the workers of a server preloading the
+proxy, so the refreshers are started by the first request in each process.
+"""
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+from saml2.mdstore import MetaDataExtern
+from saml2.mdstore import MetaDataFile
+
+logger = logging.getLogger(__name__)
+
+_store_locks_lock = threading.Lock()
+
+
+def metadata_store_lock(metadata_store):
+    """
+    Returns the lock to hold while the metadata of a store is replaced, the same lock for every
+    caller.
+
+    :type metadata_store: saml2.mdstore.MetadataStore
+    :rtype: threading.RLock
+
+    :param metadata_store: The metadata store
+    :return: The lock of the store
+    """
+    # a metadata store is not hashable, the lock is kept on the store itself
+    with _store_locks_lock:
+        lock = getattr(metadata_store, "satosa_lock", None)
+        if lock is None:
+            lock = metadata_store.satosa_lock = threading.RLock()
+        return lock
+
+
+class MetadataSource(object):
+    """
+    A metadata source of a metadata store, as configured in the 'metadata' section of a pysaml2
+    configuration.
+    """
+
+    def __init__(self, metadata_store, key):
+        """
+        :type metadata_store: saml2.mdstore.MetadataStore
+        :type key: str
+
+        :param metadata_store: The store the metadata is loaded in
+        :param key: The key of the source in the store, i.e. the file path or url
+        """
+        self.metadata_store = metadata_store
+        self.key = key
+        # the keys of the metadata of this source in the store
+        self.keys = {key}
+
+    def _loader_args(self):
+        if self.metadata_store.filter:
+            return {"filter": self.metadata_store.filter}
+        return {}
+
+    def load_if_modified(self):
+        """
+        Loads the metadata of the source if it changed since it was last loaded.
+
+        :rtype: dict[str, saml2.mdstore.InMemoryMetaData] | None
+        :return: The loaded metadata by key in the store, or None if the source did not change
+        """
+        raise NotImplementedError()
+
+    def replaced(self, previous_metadata):
+        """
+        Called after the metadata of the source was replaced in the store.
+
+        :type previous_metadata: dict[str, saml2.mdstore.InMemoryMetaData]
+        :param previous_metadata: The metadata of the store before it was replaced
+        """
+
+
+class LocalMetadataSource(MetadataSource):
+    """
+    A metadata file, or a directory of metadata files. It is reloaded when a file was modified,
+    added or removed.
+    """
+
+    def __init__(self, metadata_store, path):
+        super().__init__(metadata_store, path)
+        self._version = self._files_version()
+        self.keys = {path for path, *_ in self._version}
+
+    def _files(self):
+        if os.path.isdir(self.key):
+            return sorted(
+                entry.path for entry in os.scandir(self.key) if entry.is_file()
+            )
+        return [self.key]
+
+    def _files_version(self):
+        version = []
+        for path in self._files():
+            stat = os.stat(path)
+            version.append((path, stat.st_mtime_ns, stat.st_size, stat.st_ino))
+        return tuple(version)
+
+    def load_if_modified(self):
+        version = self._files_version()
+        if version == self._version:
+            return None
+
+        metadata = {path: self._load_file(path) for path, *_ in version}
+        self._version = version
+        return metadata
+
+    def _load_file(self, path):
+        md = MetaDataFile(self.metadata_store.attrc, path, **self._loader_args())
+        md.load()
+        return md
+
+
+class RemoteMetadataSource(MetadataSource):
+    """
+    Metadata fetched over HTTP. The request is conditional on the ETag and Last-Modified
+    headers of the previous response, so unchanged metadata is neither transferred nor parsed
+    again.
+    """
+
+    def __init__(self, metadata_store, url, cert=None, **kwargs):
+        """
+        :type url: str
+        :type cert: str | None
+
+        :param url: Location of the metadata
+        :param cert: The certificate the metadata must be signed with
+        :param kwargs: The other options of the source, e.g. node_name or check_validity
+        """
+        super().__init__(metadata_store, url)
+        self.cert = cert or ""
+        self.options = {key: kwargs[key] for key in ["node_name", "check_validity"] if key in kwargs}
+        self.etag = None
+        self.last_modified = None
+
+    def load_if_modified(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        response = self.metadata_store.http.send(self.key, headers=headers)
+        if response.status_code == 304:
+            return None
+        if response.status_code != 200:
+            raise ValueError("Fetching {} failed with status {}".format(self.key, response.status_code))
+
+        args = self._loader_args()
+        args.update(self.options)
+        md = MetaDataExtern(self.metadata_store.attrc, self.key, self.metadata_store.security, self.cert,
+                            self.metadata_store.http, **args)
+        md.parse_and_check_signature(response.content)
+        self.etag = response.headers.get("ETag")
+        self.last_modified = response.headers.get("Last-Modified")
+        return {self.key: md}
+
+
+def create_metadata_sources(metadata_store, metadata_conf):
+    """
+    Creates the refreshable sources of a metadata configuration: local files and directories,
+    and remote metadata. Inline metadata does not change and MDQ is queried on demand, so they
+    are not refreshed.
+
+    :type metadata_store: saml2.mdstore.MetadataStore
+    :type metadata_conf: dict[str, list]
+    :rtype: list[satosa.metadata_refresh.MetadataSource]
+
+    :param metadata_store: The store the metadata was loaded in
+    :param metadata_conf: The 'metadata' section of the pysaml2 configuration
+    :return: The sources
+    """
+    if not isinstance(metadata_conf, dict):
+        logger.warning("Only metadata configured by type (local, remote, ...) can be refreshed")
+        return []
+
+    sources = []
+    for path in metadata_conf.get("local", []):
+        if isinstance(path, str):
+            sources.append(LocalMetadataSource(metadata_store, path))
+    for remote in metadata_conf.get("remote", []):
+        sources.append(RemoteMetadataSource(metadata_store, **remote))
+    return sources
+
+
+class MetadataRefresher(object):
+    """
+    Refreshes a metadata source every `interval` seconds from a background thread.
+
+    After a failed refresh the previous metadata is kept and the refresh is retried after
+    `retry_interval` seconds, doubling the delay after each failure up to `interval`.
+
+    The number of refreshes, of unchanged sources and of failures, the duration of the last
+    refresh and the number of entities in the store are counted in `stats`.
+    """
+
+    def __init__(self, source, interval=3600, retry_interval=60, on_update=None):
+        """
+        :type source: satosa.metadata_refresh.MetadataSource
+        :type interval: float
+        :type retry_interval: float
+        :type on_update: () -> None
+
+        :param source: The metadata source to refresh
+        :param interval: Seconds between two refreshes
+        :param retry_interval: Seconds before the first retry of a failed refresh
+        :param on_update: Called after new metadata was put in the store
+        """
+        self.source = source
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.on_update = on_update
+        self.failures = 0
+        self.stats = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+        self._thread_pid = None
+        self._start_lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Loads the source if it changed, and replaces its previous metadata in the store.
+
+        :rtype: bool
+        :return: True if the source could be checked, whether it changed or not
+        """
+        store = self.source.metadata_store
+        started = time.monotonic()
+        try:
+            metadata = self.source.load_if_modified()
+        except Exception as err:
+            with metadata_store_lock(store):
+                self.failures += 1
+                self.stats["failures"] += 1
+                self.stats["last_duration_ms"] = int((time.monotonic() - started) * 1000)
+            logger.error("Refreshing the metadata from {} failed, keeping the previous metadata: {}".format(
+                self.source.key, err))
+            return False
+
+        with metadata_store_lock(store):
+            self.stats["last_duration_ms"] = int((time.monotonic() - started) * 1000)
+            self.failures = 0
+            if metadata is None:
+                self.stats["not_modified"] += 1
+                return True
+
+            # replaces all previous metadata of the source, e.g. of files removed from a directory
+            previous_metadata = store.metadata
+            new_metadata = {key: md for key, md in previous_metadata.items() if key not in self.source.keys}
+            new_metadata.update(metadata)
+            store.metadata = new_metadata
+            self.source.keys = set(metadata)
+            self.source.replaced(previous_metadata)
+            self.stats["refreshes"] += 1
+            self.stats["entities"] = sum(len(md) for md in new_metadata.values())
+        logger.info("Refreshed the metadata from {}, {} entities loaded".format(
+            self.source.key, self.stats["entities"]))
+
+        if self.on_update:
+            self.on_update()
+        return True
+
+    def next_delay(self):
+        """
+        :rtype: float
+        :return: The number of seconds until the next refresh
+        """
+        if not self.failures:
+            return self.interval
+        return min(self.interval, self.retry_interval * 2 ** (self.failures - 1))
+
+    def start(self):
+        """
+        Starts the refresh thread, unless it already runs in this process.
+        """
+        if self._thread_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="satosa-metadata-refresh", daemon=True)
+            self._thread.start()
+            self._thread_pid = os.getpid()
+
+    def stop(self):
+        self._stop.set()
+        # the thread of the forking process is not running in this one
+        if self._thread is not None and self._thread_pid == os.getpid():
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.next_delay()):
+            self.refresh()
+
+
+def create_metadata_refreshers(sources, refresh_conf, on_update=None):
+    """
+    Creates the refreshers of metadata sources, see start_metadata_refreshers.
+
+    :type sources: list[satosa.metadata_refresh.MetadataSource]
+    :type refresh_conf: dict[str, float]
+    :type on_update: () -> None
+    :rtype: list[satosa.metadata_refresh.MetadataRefresher]
+
+    :param sources: The sources to refresh, see create_metadata_sources
+    :param refresh_conf: The options of the refreshers, 'interval' and 'retry_interval'
+    :param on_update: Called after new metadata was put in the store
+    :return: The refreshers
+    """
+    return [MetadataRefresher(source, on_update=on_update, **refresh_conf) for source in sources]
+
+
+def start_metadata_refreshers(refreshers):
+    """
+    Starts refreshing metadata sources in the background in this process, if not done yet.
+
+    :type refreshers: list[satosa.metadata_refresh.MetadataRefresher]
+
+    :param refreshers: The refreshers, see create_metadata_refreshers
+    """
+    for refresher in refreshers:
+        refresher.start()
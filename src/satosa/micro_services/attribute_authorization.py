@@ -1,8 +1,6 @@
-import re
-
 from .base import ResponseMicroService
+from .rules import RuleSet, any_match
 from ..exception import SATOSAAuthenticationError
-from ..util import get_dict_defaults
 
 class AttributeAuthorization(ResponseMicroService):
 
@@ -41,22 +39,27 @@ perhaps best implemented via an allow rule in practice). Responses from
 target_provider1 bound for requester1 would be allowed through only if attr1
 contained foo:bar or kaka. Note that attribute filters (the leaves of the
 structure above) are ORed together - i.e any attribute match is sufficient.
+
+The filters are compiled once and the rules for a requester and provider are
+remembered, see satosa.micro_services.rules.
     """
 
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.attribute_allow = config.get("attribute_allow", {})
         self.attribute_deny = config.get("attribute_deny", {})
+        self.allow_rules = RuleSet(self.attribute_allow)
+        self.deny_rules = RuleSet(self.attribute_deny)
 
     def _check_authz(self, context, attributes, requester, provider):
-        for attribute_name, attribute_filters in get_dict_defaults(self.attribute_allow, requester, provider).items():
+        for attribute_name, attribute_filter in self.allow_rules.resolve(requester, provider).items():
             if attribute_name in attributes:
-                if not any([any(filter(re.compile(af).search, attributes[attribute_name])) for af in attribute_filters]):
+                if not any_match(attribute_filter, attributes[attribute_name]):
                     raise SATOSAAuthenticationError(context.state, "Permission denied")
 
-        for attribute_name, attribute_filters in get_dict_defaults(self.attribute_deny, requester, provider).items():
+        for attribute_name, attribute_filter in self.deny_rules.resolve(requester, provider).items():
             if attribute_name in attributes:
-                if any([any(filter(re.compile(af).search, attributes[attribute_name])) for af in attribute_filters]):
+                if any_match(attribute_filter, attributes[attribute_name]):
                     raise SATOSAAuthenticationError(context.state, "Permission denied")
 
     def process(self, context, data):
@@ -1,9 +1,39 @@
+import functools
 import re
 import pystache
 
 from .base import ResponseMicroService
+from .rules import RULE_CACHE_SIZE
 from ..util import get_dict_defaults
 
+# A mustache tag with the default delimiters: the tag type and the key
+_MUSTACHE_TAG = re.compile(r"\{\{\{?\s*([#^/&>=!]?)\s*(.*?)\s*\}?\}\}", re.DOTALL)
+
+
+def _referenced_attributes(template):
+    """
+    Finds the attribute names referenced by a template.
+
+    The names are read from the tags of the template source, so that no
+    internals of the pystache parser are needed.
+
+    :type template: str
+    :rtype: set[str] | None
+    :return: The referenced attribute names, or None if they can't be known
+    (partials or changed delimiters)
+    """
+    names = set()
+    for tag_type, key in _MUSTACHE_TAG.findall(template):
+        if tag_type in (">", "="):
+            return None
+        if tag_type in ("!", "/"):
+            continue
+        name = key.split(".")[0]
+        if name:
+            names.add(name)
+    return names
+
+
 class MustachAttrValue(object):
     def __init__(self, attr_name, values):
        self._attr_name = attr_name
@@ -115,22 +145,56 @@ sign. This is assumed to be single valued.
 The .first sub-context evalues to the first value of a context
 which may be safer to use if the attribute is multivalued but
 you don't care which value is used in a template.
+
+The templates are parsed once and only the attributes referenced by the
+templates for a requester and target provider are put into the context.
     """
 
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.synthetic_attributes = config["synthetic_attributes"]
+        self.parsed_templates = {
+            requester: {
+                provider: {attr_name: pystache.parse(fmt) for attr_name, fmt in recipes.items()}
+                for provider, recipes in providers.items()
+            }
+            for requester, providers in self.synthetic_attributes.items()
+        }
+        self.renderer = pystache.Renderer()
+        self._resolve_recipes = functools.lru_cache(maxsize=RULE_CACHE_SIZE)(self._recipes)
+
+    def _recipes(self, requester, provider):
+        """
+        :type requester: str
+        :type provider: str
+        :rtype: (dict[str, pystache.parsed.ParsedTemplate], frozenset[str] | None)
+        :return: The parsed template of each synthetic attribute and the attribute names
+        referenced by the templates, None if all attributes may be referenced
+        """
+        recipes = get_dict_defaults(self.parsed_templates, requester, provider)
+        templates = get_dict_defaults(self.synthetic_attributes, requester, provider)
+        names = set()
+        for template in templates.values():
+            template_names = _referenced_attributes(template)
+            if template_names is None:
+                return recipes, None
+            names.update(template_names)
+        return recipes, frozenset(names)
 
     def _synthesize(self, attributes, requester, provider):
         syn_attributes = dict()
         context = dict()
-        
-        for attr_name,values in attributes.items():
-           context[attr_name] = MustachAttrValue(attr_name, values)
 
-        recipes = get_dict_defaults(self.synthetic_attributes, requester, provider)
-        for attr_name, fmt in recipes.items():
-           syn_attributes[attr_name] = [v.strip().strip(';') for v in re.split("[;\n]+", pystache.render(fmt, context))]
+        recipes, names = self._resolve_recipes(requester, provider)
+        if names is None:
+            names = attributes.keys()
+        for attr_name in names:
+           values = attributes.get(attr_name)
+           if values is not None:
+              context[attr_name] = MustachAttrValue(attr_name, values)
+
+        for attr_name, parsed in recipes.items():
+           syn_attributes[attr_name] = [v.strip().strip(';') for v in re.split("[;\n]+", self.renderer.render(parsed, context))]
         return syn_attributes
 
     def process(self, context, data):
@@ -1,6 +1,7 @@
-import re
+import functools
 
 from .base import ResponseMicroService
+from .rules import RULE_CACHE_SIZE, compile_rules
 
 
 class AddStaticAttributes(ResponseMicroService):
@@ -25,32 +26,50 @@ class FilterAttributeValues(ResponseMicroService):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.attribute_filters = config["attribute_filters"]
+        self.compiled_filters = compile_rules(self.attribute_filters, 2)
+        self._resolve_filters = functools.lru_cache(maxsize=RULE_CACHE_SIZE)(self._merge_filters)
 
     def process(self, context, data):
-        # apply default filters
-        provider_filters = self.attribute_filters.get("", {})
-        self._apply_requester_filters(data.attributes, provider_filters, data.requester)
-
-        # apply target provider specific filters
-        target_provider = data.auth_info.issuer
-        provider_filters = self.attribute_filters.get(target_provider, {})
-        self._apply_requester_filters(data.attributes, provider_filters, data.requester)
+        attribute_filters, all_attributes_filters = self._resolve_filters(
+            data.requester, data.auth_info.issuer)
+        self._apply_filters(data.attributes, attribute_filters, all_attributes_filters)
         return super().process(context, data)
 
-    def _apply_requester_filters(self, attributes, provider_filters, requester):
-        # apply default requester filters
-        default_requester_filters = provider_filters.get("", {})
-        self._apply_filter(attributes, default_requester_filters)
-
-        # apply requester specific filters
-        requester_filters = provider_filters.get(requester, {})
-        self._apply_filter(attributes, requester_filters)
-
-    def _apply_filter(self, attributes, attribute_filters):
-        for attribute_name, attribute_filter in attribute_filters.items():
-            regex = re.compile(attribute_filter)
-            if attribute_name == "":  # default filter for all attributes
-                for attribute, values in attributes.items():
-                    attributes[attribute] = list(filter(regex.search, attributes[attribute]))
-            elif attribute_name in attributes:
-                attributes[attribute_name] = list(filter(regex.search, attributes[attribute_name]))
+    def _merge_filters(self, requester, target_provider):
+        """
+        Collects the filters applying to a requester and target provider: the default filters
+        ("" provider) and the target provider specific filters, each with the default ("")
+        requester filters and the requester specific filters.
+
+        A value is kept only if it matches all filters of its attribute, so the order in which
+        the filters are applied does not matter.
+
+        :type requester: str
+        :type target_provider: str
+        :rtype: (dict[str, tuple[re.Pattern]], tuple[re.Pattern])
+        :return: The filters of each attribute and the filters for all attributes
+        """
+        attribute_filters = {}
+        for provider in ["", target_provider]:
+            provider_filters = self.compiled_filters.get(provider, {})
+            for requester_key in ["", requester]:
+                for attribute_name, regex in provider_filters.get(requester_key, {}).items():
+                    regexes = attribute_filters.setdefault(attribute_name, [])
+                    if regex not in regexes:
+                        regexes.append(regex)
+
+        all_attributes_filters = tuple(attribute_filters.pop("", []))
+        return {name: tuple(regexes) for name, regexes in attribute_filters.items()}, all_attributes_filters
+
+    def _apply_filters(self, attributes, attribute_filters, all_attributes_filters):
+        if all_attributes_filters:
+            names = list(attributes)
+        else:
+            names = [name for name in attribute_filters if name in attributes]
+
+        for attribute_name in names:
+            regexes = attribute_filters.get(attribute_name, ()) + all_attributes_filters
+            attributes[attribute_name] = [
+                value for value in attributes[attribute_name]
+                if all(regex.search(value) for regex in regexes)
+            ]
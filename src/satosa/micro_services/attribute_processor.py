@@ -43,24 +43,51 @@ class AttributeProcessor(ResponseMicroService):
         super().__init__(*args, **kwargs)
         self.config = config
         self.processes = config[CONFIG_KEY_ROOT]
-
-    def process(self, context, data):
-        for process in self.processes:
+        self.pipeline = self._compile_pipeline(self.processes)
+
+    @staticmethod
+    def _compile_pipeline(processes):
+        """
+        Loads, instantiates and validates all configured processors.
+
+        :type processes: list[dict[str, Any]]
+        :rtype: list[((satosa.internal.InternalData, str, Any) -> None, str, dict[str, Any])]
+
+        :param processes: The configured attributes and their processors
+        :return: The process method, attribute and arguments of each processor, in the order in
+        which they are run
+        """
+        pipeline = []
+        for process in processes:
             attribute = process[CONFIG_KEY_ATTRIBUTE]
-            processors = process[CONFIG_KEY_PROCESSORS]
-            for processor in processors:
-                module = importlib.import_module(processor[CONFIG_KEY_MODULE])
-                module_cls = getattr(module, processor[CONFIG_KEY_CLASSNAME])
+            for processor in process[CONFIG_KEY_PROCESSORS]:
+                try:
+                    module = importlib.import_module(processor[CONFIG_KEY_MODULE])
+                    module_cls = getattr(module, processor[CONFIG_KEY_CLASSNAME])
+                except (ImportError, AttributeError) as err:
+                    raise AttributeProcessorError(
+                        "Can't load processor {}.{}: {}".format(
+                            processor[CONFIG_KEY_MODULE], processor[CONFIG_KEY_CLASSNAME], err)
+                    ) from err
                 instance = module_cls()
 
                 kwargs = processor.copy()
                 kwargs.pop(CONFIG_KEY_MODULE)
                 kwargs.pop(CONFIG_KEY_CLASSNAME)
 
-                try:
-                    instance.process(data, attribute, **kwargs)
-                except AttributeProcessorWarning as w:
-                    satosa_logging(logger, logging.WARNING, w, context.state)
+                # processors that don't derive from BaseProcessor may lack validate
+                validate = getattr(instance, "validate", None)
+                if validate is not None:
+                    validate(attribute, **kwargs)
+                pipeline.append((instance.process, attribute, kwargs))
+        return pipeline
+
+    def process(self, context, data):
+        for process, attribute, kwargs in self.pipeline:
+            try:
+                process(data, attribute, **kwargs)
+            except AttributeProcessorWarning as w:
+                satosa_logging(logger, logging.WARNING, w, context.state)
 
         return super().process(context, data)
 
@@ -4,91 +4,271 @@ SATOSA microservice that outputs log in custom format.
 
 from .base import ResponseMicroService
 from satosa.logging_util import satosa_logging
-from base64 import urlsafe_b64encode, urlsafe_b64decode
 
+from collections import Counter
+
+import atexit
+import fcntl
 import json
-import copy
 import logging
+import os
+import queue
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+
+class AuditLogWriter(object):
+    """
+    Writes log records as JSON lines to a file from a background thread.
+
+    Records are queued and written in batches through a file that is kept
+    open. The file is rotated when it grows larger than `max_bytes` or is
+    older than `rotate_interval` seconds. When the queue is full a record is
+    dropped and counted, or, with `block_when_full`, the caller waits up to
+    `block_timeout` seconds for room in the queue.
+
+    The worker processes may share the file: it is rotated by one of them
+    while holding a lock on `path`.lock, and the others reopen it when it
+    was replaced, as they do when it is rotated by an external tool. The
+    thread is started by the first write in a process, so that it also runs
+    in the workers forked after the writer was created.
+    """
+
+    def __init__(self, path, queue_size=10000, batch_size=100, flush_interval=1.0,
+                 max_bytes=0, rotate_interval=0, backup_count=5,
+                 block_when_full=False, block_timeout=None):
+        """
+        :type path: str
+        :type queue_size: int
+        :type batch_size: int
+        :type flush_interval: float
+        :type max_bytes: int
+        :type rotate_interval: float
+        :type backup_count: int
+        :type block_when_full: bool
+        :type block_timeout: float | None
+
+        :param path: The log file
+        :param queue_size: The maximum number of records waiting to be written
+        :param batch_size: The maximum number of records written at once
+        :param flush_interval: The maximum time in seconds a record waits to be written
+        :param max_bytes: Rotate the file when it is larger, 0 to not rotate on size
+        :param rotate_interval: Rotate the file after this many seconds, 0 to not rotate on time
+        :param backup_count: The number of rotated files to keep
+        :param block_when_full: Wait for room in a full queue instead of dropping the record
+        :param block_timeout: The maximum time in seconds to wait, None to wait without limit
+        """
+        self.path = path
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.block_when_full = block_when_full
+        self.block_timeout = block_timeout
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stream = None
+        self._opened_at = None
+        self._closed = False
+        self._thread = None
+        self._thread_pid = None
+        self._thread_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def write(self, record):
+        """
+        Queues a record to be written.
+
+        :type record: dict
+        :rtype: bool
+
+        :param record: A JSON serializable record
+        :return: False if the record was dropped
+        """
+        self._start_thread()
+        try:
+            if self.block_when_full:
+                self._queue.put(record, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(record)
+        except queue.Full:
+            with self._stats_lock:
+                self.stats["dropped"] += 1
+                dropped = self.stats["dropped"]
+            # do not flood the log while the writer is behind
+            if dropped & (dropped - 1) == 0:
+                logger.warning("Audit log {} is behind, {} records dropped".format(self.path, dropped))
+            return False
+        return True
+
+    def close(self):
+        """
+        Writes the queued records and stops the writer.
+        """
+        if self._closed or self._thread_pid != os.getpid():
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _start_thread(self):
+        if self._thread_pid == os.getpid():
+            return
+        with self._thread_lock:
+            if self._thread_pid == os.getpid():
+                return
+            if self._thread_pid is not None:
+                # Forked from a process that writes: the queued records and
+                # the open file belong to the parent.
+                self._queue = queue.Queue(maxsize=self.queue_size)
+                self._stream = None
+            self._thread = threading.Thread(target=self._run, name="AuditLogWriter", daemon=True)
+            self._thread.start()
+            self._thread_pid = os.getpid()
+
+    def _run(self):
+        while True:
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=self.flush_interval))
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            stop = None in batch
+            records = [record for record in batch if record is not None]
+            if records:
+                try:
+                    self._write_batch(records)
+                except Exception as err:
+                    with self._stats_lock:
+                        self.stats["failed"] += len(records)
+                    logger.error("Could not write to audit log {}: {}".format(self.path, err))
+                    self._close_stream()
+            if stop:
+                self._close_stream()
+                return
+
+    def _write_batch(self, records):
+        self._rotate_if_needed()
+        if self._stream is None:
+            self._stream = open(self.path, "a")
+            self._opened_at = time.time()
+        self._stream.write("".join(json.dumps(record) + "\n" for record in records))
+        self._stream.flush()
+        with self._stats_lock:
+            self.stats["written"] += len(records)
+            self.stats["batches"] += 1
+
+    def _rotate_if_needed(self):
+        if self._stream is None:
+            return
+        if not self._is_current_file():
+            # rotated by another process or an external tool
+            self._close_stream()
+            return
+        too_large = self.max_bytes and os.path.getsize(self.path) >= self.max_bytes
+        too_old = self.rotate_interval and time.time() - self._opened_at >= self.rotate_interval
+        if not (too_large or too_old):
+            return
+
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # another process may have rotated the file while we waited
+            if self._is_current_file():
+                if self.backup_count > 0:
+                    for i in range(self.backup_count - 1, 0, -1):
+                        source = "{}.{}".format(self.path, i)
+                        if os.path.exists(source):
+                            os.replace(source, "{}.{}".format(self.path, i + 1))
+                    os.replace(self.path, "{}.1".format(self.path))
+                else:
+                    os.remove(self.path)
+                with self._stats_lock:
+                    self.stats["rotations"] += 1
+        self._close_stream()
+
+    def _is_current_file(self):
+        try:
+            current = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        opened = os.fstat(self._stream.fileno())
+        return (current.st_dev, current.st_ino) == (opened.st_dev, opened.st_ino)
+
+    def _close_stream(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+
 class CustomLoggingService(ResponseMicroService):
     """
     Use context and data object to create custom log output
     """
     logprefix = "CUSTOM_LOGGING_SERVICE:"
 
+    WRITER_OPTIONS = ["queue_size", "batch_size", "flush_interval", "max_bytes",
+                      "rotate_interval", "backup_count", "block_when_full", "block_timeout"]
+
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.config = config
-        
-    def process(self, context, data):
-        logprefix = CustomLoggingService.logprefix
+        self.log_target = config["log_target"]
+        self.attrs = tuple(config["attrs"])
+        writer_options = {key: config[key] for key in self.WRITER_OPTIONS if key in config}
+        self.writer = AuditLogWriter(self.log_target, **writer_options)
 
-        # Initialize the configuration to use as the default configuration
-        # that is passed during initialization.
-        config = self.config
-        configClean = copy.deepcopy(config)
+    @property
+    def writer_stats(self):
+        """
+        :rtype: dict[str, int]
+        :return: The number of records written, dropped and failed, and of batches and rotations
+        """
+        return dict(self.writer.stats)
 
-        satosa_logging(logger, logging.DEBUG, "{} Using default configuration {}".format(logprefix, configClean), context.state)
+    def process(self, context, data):
+        logprefix = CustomLoggingService.logprefix
 
         # Find the entityID for the SP that initiated the flow and target IdP
         try:
-            spEntityID = context.state.state_dict['SATOSA_BASE']['requester']
+            state = context.state.view
+            spEntityID = state['SATOSA_BASE']['requester']
             idpEntityID = data.auth_info.issuer
         except KeyError as err:
             satosa_logging(logger, logging.ERROR, "{} Unable to determine the entityID's for the IdP or SP".format(logprefix), context.state)
             return super().process(context, data)
 
-        satosa_logging(logger, logging.DEBUG, "{} entityID for the SP requester is {}".format(logprefix, spEntityID), context.state)
-        satosa_logging(logger, logging.ERROR, "{} entityID for the target IdP is {}".format(logprefix, idpEntityID), context.state)
-
-        # Obtain configuration details from the per-SP configuration or the default configuration
-        try:
-            if 'log_target' in config:
-                log_target = config['log_target']
-            else:
-                log_target = self.config['log_target']
-
-            if 'attrs' in config:
-                attrs = config['attrs']
-            else:
-                attrs = self.config['attrs']
-
-
-        except KeyError as err:
-            satosa_logging(logger, logging.ERROR, "{} Configuration '{}' is missing".format(logprefix, err), context.state)
-            return super().process(context, data)
-
-        record = None
+        if logger.isEnabledFor(logging.DEBUG):
+            satosa_logging(logger, logging.DEBUG, "{} entityID for the SP requester is {}".format(logprefix, spEntityID), context.state)
+            satosa_logging(logger, logging.DEBUG, "{} entityID for the target IdP is {}".format(logprefix, idpEntityID), context.state)
 
         try:
-            satosa_logging(logger, logging.DEBUG, "{} Using context {}".format(logprefix, context), context.state)
-            satosa_logging(logger, logging.DEBUG, "{} Using data {}".format(logprefix, data.to_dict()), context.state)
-
-            # Open log_target file
-            satosa_logging(logger, logging.DEBUG, "{} Opening log_target file {}".format(logprefix, log_target), context.state)
-            loghandle = open(log_target,"a")
-
-            # This is where the logging magic happens
+            # This is where the logging magic happens. The record is written
+            # after the response is sent, copy the values that may still change.
+            attributes = data.attributes
             log = {}
-            log['router'] = context.state.state_dict['ROUTER']
+            log['router'] = state['ROUTER']
             log['timestamp'] = data.auth_info.timestamp
-            log['sessionid'] = context.state.state_dict['SESSION_ID']
+            log['sessionid'] = state['SESSION_ID']
             log['idp'] = idpEntityID
             log['sp'] = spEntityID
-            log['attr'] = { key: data.to_dict()['attr'].get(key) for key in attrs }
-            
-            print(json.dumps(log), file=loghandle, end="\n")
-
+            log['attr'] = {key: _copy_value(attributes.get(key)) for key in self.attrs}
         except Exception as err:
-            satosa_logging(logger, logging.ERROR, "{} Caught exception: {0}".format(logprefix, err), None)
+            satosa_logging(logger, logging.ERROR, "{} Caught exception: {}".format(logprefix, err), None)
             return super().process(context, data)
 
-        else:
-            satosa_logging(logger, logging.DEBUG, "{} Closing log_target file".format(logprefix), context.state)
+        self.writer.write(log)
+        return super().process(context, data)
 
-            # Close log_target file
-            loghandle.close()
 
-        return super().process(context, data)
+def _copy_value(value):
+    if isinstance(value, list):
+        return list(value)
+    return value
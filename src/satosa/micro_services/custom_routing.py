@@ -1,29 +1,157 @@
+import functools
 import logging
+import re
 from base64 import urlsafe_b64encode
 
 from satosa.context import Context
 
 from .base import RequestMicroService
+from .rules import RULE_CACHE_SIZE
+from .rules import has_backreference
 from ..exception import SATOSAConfigurationError
 from ..exception import SATOSAError
 
 logger = logging.getLogger(__name__)
 
 
+class PrefixTrie(object):
+    """
+    Maps string prefixes to values, finding the value of the longest prefix of
+    a string in time proportional to the length of the string.
+    """
+
+    _VALUE = None  # key of the value in a node, no character is None
+
+    def __init__(self, prefixes=None):
+        """
+        :type prefixes: dict[str, Any] | None
+        :param prefixes: The prefixes and their values
+        """
+        self._root = {}
+        self._size = 0
+        for prefix, value in (prefixes or {}).items():
+            self[prefix] = value
+
+    def __setitem__(self, prefix, value):
+        node = self._root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        if self._VALUE not in node:
+            self._size += 1
+        node[self._VALUE] = value
+
+    def __len__(self):
+        return self._size
+
+    def longest_prefix_value(self, string, default=None):
+        """
+        :type string: str
+        :param string: The string to look up
+        :param default: The value to return if no prefix matches
+        :return: The value of the longest prefix of the string
+        """
+        node = self._root
+        value = node.get(self._VALUE, default)
+        for char in string:
+            node = node.get(char)
+            if node is None:
+                break
+            value = node.get(self._VALUE, value)
+        return value
+
+
+class RegexMapping(object):
+    """
+    Maps regexes to values, finding the value of the first regex, in the
+    configured order, that matches the start of a string.
+
+    The regexes are combined into a single regex unless they contain
+    backreferences, named groups or global flags.
+    """
+
+    def __init__(self, regex_mapping):
+        """
+        :type regex_mapping: dict[str, Any]
+        :param regex_mapping: The regexes and their values
+        """
+        self.regexes = [(re.compile(regex), value) for regex, value in regex_mapping.items()]
+        self.combined = None
+        self.values = []
+        if self.regexes and not any(has_backreference(regex.pattern) or regex.groupindex
+                                    for regex, _ in self.regexes):
+            parts = []
+            self.values = [None]
+            for regex, value in self.regexes:
+                # the value is found by the index of the group enclosing the regex
+                parts.append("({})".format(regex.pattern))
+                self.values.append(value)
+                self.values.extend([None] * regex.groups)
+            try:
+                self.combined = re.compile("|".join(parts))
+            except re.error:
+                # e.g. global flags, only allowed at the start of a regex
+                self.combined = None
+
+    def match(self, string, default=None):
+        """
+        :type string: str
+        :param string: The string to look up
+        :param default: The value to return if no regex matches
+        :return: The value of the first regex matching the start of the string
+        """
+        if self.combined is not None:
+            match = self.combined.match(string)
+            return self.values[match.lastindex] if match else default
+        for regex, value in self.regexes:
+            if regex.match(string):
+                return value
+        return default
+
+
 class DecideBackendByRequester(RequestMicroService):
     """
     Select which backend should be used based on who the requester is.
+
+    A requester is routed by, in this order:
+      * its identifier in 'requester_mapping'
+      * the longest prefix of its identifier in 'requester_prefix_mapping'
+      * the first regex in 'requester_regex_mapping' matching the start of its identifier
+      * 'default_backend'
+    If none of them applies the backend selected by the frontend is kept.
     """
 
     def __init__(self, config, *args, **kwargs):
         """
         Constructor.
         :param config: mapping from requester identifier to
-        backend module name under the key 'requester_mapping'
+        backend module name under the key 'requester_mapping', and optionally
+        mappings from requester identifier prefixes and regexes to backend
+        module names under the keys 'requester_prefix_mapping' and
+        'requester_regex_mapping', and the backend for other requesters under
+        the key 'default_backend'
         :type config: Dict[str, Dict[str, str]]
         """
         super().__init__(*args, **kwargs)
-        self.requester_mapping = config['requester_mapping']
+        self.requester_mapping = config.get('requester_mapping', {})
+        self.prefix_mapping = PrefixTrie(config.get('requester_prefix_mapping', {}))
+        self.regex_mapping = RegexMapping(config.get('requester_regex_mapping', {}))
+        self.default_backend = config.get('default_backend')
+        self._route = functools.lru_cache(maxsize=RULE_CACHE_SIZE)(self._find_backend)
+
+    def _find_backend(self, requester):
+        """
+        :type requester: str
+        :rtype: str | None
+        :param requester: The requester identifier
+        :return: The backend module name for the requester
+        """
+        backend = self.requester_mapping.get(requester)
+        if backend is not None:
+            return backend
+        backend = self.prefix_mapping.longest_prefix_value(requester)
+        if backend is not None:
+            return backend
+        return self.regex_mapping.match(requester, self.default_backend)
 
     def process(self, context, data):
         """
@@ -31,10 +159,57 @@ class DecideBackendByRequester(RequestMicroService):
         :param context: request context
         :param data: the internal request
         """
-        context.target_backend = self.requester_mapping[data.requester]
+        backend = self._route(data.requester or "")
+        if backend is not None:
+            context.target_backend = backend
+        else:
+            logger.debug("No backend configured for requester '%s'", data.requester)
         return super().process(context, data)
 
 
+class RequesterMatcher(object):
+    """
+    Matches requesters against a set of identifiers and wildcard patterns.
+
+    A '*' in a pattern matches any string. Patterns ending with their only
+    '*' are prefixes, looked up in a trie; other patterns are combined into a
+    single regex. Identifiers given as a single string instead of a list
+    match every requester that is a substring of it.
+    """
+
+    def __init__(self, identifiers, patterns=()):
+        """
+        :type identifiers: list[str] | str
+        :type patterns: list[str]
+
+        :param identifiers: The requester identifiers
+        :param patterns: The requester patterns
+        """
+        self.substrings = identifiers if isinstance(identifiers, str) else None
+        if self.substrings is not None:
+            identifiers = []
+        self.identifiers = frozenset(identifiers).union(pattern for pattern in patterns if "*" not in pattern)
+        patterns = [pattern for pattern in patterns if "*" in pattern]
+        self.prefixes = PrefixTrie({
+            pattern[:-1]: True for pattern in patterns if pattern.index("*") == len(pattern) - 1
+        })
+        globs = [pattern for pattern in patterns if pattern.index("*") != len(pattern) - 1]
+        self.glob = None
+        if globs:
+            self.glob = re.compile("|".join(
+                "(?:{})".format(".*".join(re.escape(part) for part in glob.split("*")))
+                for glob in globs
+            ))
+
+    def __contains__(self, requester):
+        return (
+            requester in self.identifiers
+            or (self.substrings is not None and requester in self.substrings)
+            or self.prefixes.longest_prefix_value(requester, False)
+            or (self.glob is not None and self.glob.fullmatch(requester) is not None)
+        )
+
+
 class DecideIfRequesterIsAllowed(RequestMicroService):
     """
     Decide whether a requester is allowed to send an authentication request to the target entity.
@@ -42,12 +217,19 @@ class DecideIfRequesterIsAllowed(RequestMicroService):
     This micro service currently only works when a target entityid is set.
     Currently, a target entityid is set only when the `SAMLMirrorFrontend` is
     used.
+
+    The allow and deny rules of a target entity list requester identifiers,
+    and the allow_patterns and deny_patterns rules list requester patterns,
+    where '*' matches any string, e.g. 'https://sp.example.org/*'. A requester
+    is denied if it matches a deny rule, allowed if it matches an allow rule
+    or 'allow' contains '*', and denied otherwise. A single '*' in 'deny' only
+    documents the final deny all rule.
     """
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         for target_entity, rules in config["rules"].items():
-            conflicting_rules = set(rules.get("deny", [])).intersection(rules.get("allow", []))
+            conflicting_rules = self._rule_set(rules, "deny").intersection(self._rule_set(rules, "allow"))
             if conflicting_rules:
                 raise SATOSAConfigurationError("Conflicting requester rules for DecideIfRequesterIsAllowed,"
                                                "{} is both denied and allowed".format(conflicting_rules))
@@ -55,10 +237,50 @@ class DecideIfRequesterIsAllowed(RequestMicroService):
         # target entity id is base64 url encoded to make it usable in URLs,
         # so we convert the rules the use those encoded entity id's instead
         self.rules = {self._b64_url(k): v for k, v in config["rules"].items()}
+        self.compiled_rules = {
+            target_entity: self._compile_rules(rules) for target_entity, rules in self.rules.items() if rules
+        }
+        self._decide = functools.lru_cache(maxsize=RULE_CACHE_SIZE)(self._evaluate)
 
     def _b64_url(self, data):
         return urlsafe_b64encode(data.encode("utf-8")).decode("utf-8")
 
+    @staticmethod
+    def _rule_set(rules, key):
+        identifiers = rules.get(key, [])
+        if isinstance(identifiers, str):
+            identifiers = [identifiers]
+        return set(identifiers).union(rules.get(key + "_patterns", []))
+
+    def _compile_rules(self, rules):
+        allow_rules = rules.get("allow", [])
+        return {
+            "allow_all": "*" in allow_rules,
+            "allow": RequesterMatcher(allow_rules, rules.get("allow_patterns", [])),
+            "deny": RequesterMatcher(rules.get("deny", []), rules.get("deny_patterns", [])),
+        }
+
+    def _evaluate(self, target_entity_id, requester):
+        """
+        :type target_entity_id: str
+        :type requester: str
+        :rtype: (bool, str)
+        :return: Whether the requester is allowed, and which rule decided it
+        """
+        target_specific_rules = self.compiled_rules.get(target_entity_id)
+        # default to allowing everything if there are no specific rules
+        if not target_specific_rules:
+            return True, "no entity specific rules"
+
+        # deny rules takes precedence
+        if requester in target_specific_rules["deny"]:
+            return False, "deny rules"
+
+        if target_specific_rules["allow_all"] or requester in target_specific_rules["allow"]:
+            return True, "allow rules"
+
+        return False, "final deny all rule"
+
     def process(self, context, data):
         target_entity_id = context.get_decoration(Context.KEY_TARGET_ENTITYID)
         if None is target_entity_id:
@@ -67,27 +289,12 @@ class DecideIfRequesterIsAllowed(RequestMicroService):
             logger.error(msg)
             raise SATOSAError(msg)
 
-        target_specific_rules = self.rules.get(target_entity_id)
-        # default to allowing everything if there are no specific rules
-        if not target_specific_rules:
-            logging.debug("Requester '%s' allowed by default to target entity '%s' due to no entity specific rules",
-                          data.requester, target_entity_id)
-            return super().process(context, data)
-
-        # deny rules takes precedence
-        deny_rules = target_specific_rules.get("deny", [])
-        if data.requester in deny_rules:
-            logging.debug("Requester '%s' is not allowed by target entity '%s' due to deny rules '%s'", data.requester,
-                          target_entity_id, deny_rules)
-            raise SATOSAError("Requester is not allowed by target provider")
-
-        allow_rules = target_specific_rules.get("allow", [])
-        allow_all = "*" in allow_rules
-        if data.requester in allow_rules or allow_all:
-            logging.debug("Requester '%s' allowed by target entity '%s' due to allow rules '%s",
-                          data.requester, target_entity_id, allow_rules)
+        allowed, reason = self._decide(target_entity_id, data.requester or "")
+        if allowed:
+            logger.debug("Requester '%s' allowed by target entity '%s' due to %s",
+                         data.requester, target_entity_id, reason)
             return super().process(context, data)
 
-        logger.debug("Requester '%s' is not allowed by target entity '%s' due to final deny all rule in '%s'",
-                      data.requester, target_entity_id, deny_rules)
+        logger.debug("Requester '%s' is not allowed by target entity '%s' due to %s",
+                     data.requester, target_entity_id, reason)
         raise SATOSAError("Requester is not allowed by target provider")
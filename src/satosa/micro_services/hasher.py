@@ -1,12 +1,21 @@
+from collections import namedtuple
+
 import satosa.util as util
 from satosa.micro_services.base import ResponseMicroService
 
 
 CONFIG_KEY_SALT = "salt"
 CONFIG_KEY_ALG = "alg"
+CONFIG_KEY_HMAC = "hmac"
 CONFIG_KEY_SUBJID = "subject_id"
 CONFIG_KEY_ATTRS = "attributes"
 
+RequesterHashConfig = namedtuple("RequesterHashConfig", ["hasher", "subject_id", "attributes"])
+"""
+The resolved settings of a requester, with the hasher for its salt and
+algorithm.
+"""
+
 
 class Hasher(ResponseMicroService):
     """Hash subject_id and attributes.
@@ -34,6 +43,10 @@ class Hasher(ResponseMicroService):
           # the hash algorithm to use (default: sha512)
           alg: sha256
 
+          # compute an HMAC with the salt as key instead of hashing the
+          # value followed by the salt (default: no)
+          hmac: no
+
           # whether subject_id should be hashed (default: yes)
           subject_id: yes
 
@@ -67,10 +80,16 @@ class Hasher(ResponseMicroService):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.config = self._init_config(config)
+        self.requester_configs = {
+            requester: self._resolve_config(conf)
+            for requester, conf in self.config.items()
+        }
+        self.default_config = self.requester_configs[""]
 
     def _init_config(self, config):
         defaults = {
             CONFIG_KEY_ALG: "sha512",
+            CONFIG_KEY_HMAC: False,
             CONFIG_KEY_SUBJID: True,
             CONFIG_KEY_ATTRS: [],
         }
@@ -87,29 +106,31 @@ class Hasher(ResponseMicroService):
             config[requester] = defs
         return config
 
+    @staticmethod
+    def _resolve_config(config):
+        hasher = util.get_data_hasher(
+            config[CONFIG_KEY_SALT],
+            config[CONFIG_KEY_ALG],
+            config[CONFIG_KEY_HMAC],
+        )
+        return RequesterHashConfig(
+            hasher=hasher,
+            subject_id=bool(config[CONFIG_KEY_SUBJID]),
+            attributes=tuple(config[CONFIG_KEY_ATTRS]),
+        )
+
     def process(self, context, internal_data):
-        requester = internal_data.requester
-        config = self.config.get(requester, self.config[""])
-        if config[CONFIG_KEY_SUBJID]:
+        config = self.requester_configs.get(internal_data.requester, self.default_config)
+        if config.subject_id:
             self.hash_subject_id(config, internal_data)
-        if config[CONFIG_KEY_ATTRS]:
+        if config.attributes:
             self.hash_attributes(config, internal_data)
         return super().process(context, internal_data)
 
     def hash_subject_id(self, config, internal_data):
-        internal_data.subject_id = util.hash_data(
-            config[CONFIG_KEY_SALT],
-            internal_data.subject_id,
-            hash_alg=config[CONFIG_KEY_ALG],
-        )
+        internal_data.subject_id = config.hasher.hash(internal_data.subject_id)
 
     def hash_attributes(self, config, internal_data):
-        for attribute in config[CONFIG_KEY_ATTRS]:
-            internal_data.attributes[attribute] = [
-                util.hash_data(
-                    config[CONFIG_KEY_SALT],
-                    value,
-                    hash_alg=config[CONFIG_KEY_ALG],
-                )
-                for value in internal_data.attributes.get(attribute, [])
-            ]
+        attributes = internal_data.attributes
+        for attribute in config.attributes:
+            attributes[attribute] = config.hasher.hash_values(attributes.get(attribute, []))
@@ -5,13 +5,23 @@ directory for a record and then consume attributes from
 the record and assert them to the receiving SP.
 """
 
+import base64
 import copy
+import datetime
+import json
 import logging
+import os
+import sqlite3
+import threading
+import time
 import urllib
 
 import ldap3
 from ldap3.core.exceptions import LDAPException
+from ldap3.utils.ciDict import CaseInsensitiveDict
 
+from collections import Counter
+from collections import OrderedDict
 from collections import defaultdict
 
 from satosa.exception import SATOSAError
@@ -31,6 +41,158 @@ class LdapAttributeStoreError(SATOSAError):
     """
 
 
+def _encode_search_value(value):
+    """
+    JSON encoding of the values of LDAP records that JSON does not support.
+    """
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    if isinstance(value, datetime.datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, CaseInsensitiveDict):
+        return {"__case_insensitive_dict__": dict(value)}
+    raise TypeError("{} values can not be cached".format(type(value).__name__))
+
+
+def _decode_search_value(value):
+    if "__bytes__" in value:
+        return base64.b64decode(value["__bytes__"])
+    if "__datetime__" in value:
+        return datetime.datetime.fromisoformat(value["__datetime__"])
+    if "__case_insensitive_dict__" in value:
+        return CaseInsensitiveDict(value["__case_insensitive_dict__"])
+    return value
+
+
+class LdapSearchCache(object):
+    """
+    Cache of LDAP search results.
+
+    Results are kept in memory for `ttl` seconds, or `negative_ttl` seconds
+    if the search returned no record, and the least recently used result is
+    dropped when more than `max_entries` results are cached. If a
+    `sqlite_path` is configured the results are also stored in a SQLite
+    database, so that all worker processes on a host share them. Results
+    with values that can not be stored in the database are only cached in
+    memory.
+    """
+
+    def __init__(self, ttl=300, negative_ttl=60, max_entries=10000, sqlite_path=None):
+        """
+        :type ttl: int
+        :type negative_ttl: int
+        :type max_entries: int
+        :type sqlite_path: str | None
+
+        :param ttl: Lifetime in seconds of a search result with records
+        :param negative_ttl: Lifetime in seconds of a search result without records
+        :param max_entries: The maximum number of results to keep in memory
+        :param sqlite_path: Path of the shared database, or None to only cache in memory
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.sqlite_path = sqlite_path
+        self.stats = Counter()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connection(self):
+        # the thread local data of the forking thread is inherited by the child process
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.sqlite_path, timeout=10)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS ldap_search"
+                    " (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+                connection.execute(
+                    "CREATE INDEX IF NOT EXISTS ldap_search_expires_at ON ldap_search (expires_at)")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def get(self, key):
+        """
+        :type key: tuple
+        :rtype: list[dict] | None
+
+        :param key: The search, (ldap_url, search_base, bind_dn, search_filter, attributes)
+        :return: A copy of the cached records, or None if the search is not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, records = entry
+                if expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return copy.deepcopy(records)
+                del self._entries[key]
+                self.stats["evictions"] += 1
+
+        if self.sqlite_path:
+            try:
+                row = self._connection().execute(
+                    "SELECT value, expires_at FROM ldap_search WHERE key = ? AND expires_at > ?",
+                    (json.dumps(key), time.time()),
+                ).fetchone()
+            except sqlite3.Error as err:
+                msg = "Reading the LDAP search cache failed: {}".format(err)
+                satosa_logging(logger, logging.WARN, msg, None)
+                row = None
+            if row:
+                records = json.loads(row[0], object_hook=_decode_search_value)
+                self._set_in_memory(key, records, row[1])
+                self.stats["hits"] += 1
+                self.stats["shared_hits"] += 1
+                return copy.deepcopy(records)
+
+        self.stats["misses"] += 1
+        return None
+
+    def set(self, key, records):
+        """
+        :type key: tuple
+        :type records: list[dict]
+
+        :param key: The search, (ldap_url, search_base, bind_dn, search_filter, attributes)
+        :param records: The records returned by the search
+        """
+        expires_at = time.time() + (self.ttl if records else self.negative_ttl)
+        self._set_in_memory(key, copy.deepcopy(records), expires_at)
+
+        if self.sqlite_path:
+            try:
+                value = json.dumps(records, default=_encode_search_value)
+            except TypeError as err:
+                msg = "Not storing the LDAP search in the shared cache: {}".format(err)
+                satosa_logging(logger, logging.DEBUG, msg, None)
+                return
+            try:
+                with self._connection() as connection:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO ldap_search (key, value, expires_at) VALUES (?, ?, ?)",
+                        (json.dumps(key), value, expires_at))
+                    connection.execute("DELETE FROM ldap_search WHERE expires_at <= ?", (time.time(),))
+            except sqlite3.Error as err:
+                msg = "Writing the LDAP search cache failed: {}".format(err)
+                satosa_logging(logger, logging.WARN, msg, None)
+
+    def _set_in_memory(self, key, records, expires_at):
+        with self._lock:
+            self._entries[key] = (expires_at, records)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
 class LdapAttributeStore(ResponseMicroService):
     """
     Use identifier provided by the backend authentication service
@@ -42,6 +204,7 @@ class LdapAttributeStore(ResponseMicroService):
         "bind_dn": None,
         "bind_password": None,
         "clear_input_attributes": False,
+        "combined_search": False,
         "ignore": False,
         "ldap_identifier_attribute": None,
         "ldap_url": None,
@@ -55,6 +218,8 @@ class LdapAttributeStore(ResponseMicroService):
         "user_id_from_attrs": [],
         "read_only": True,
         "version": 3,
+        "search_cache": None,
+        "bypass_search_cache": False,
         "auto_bind": "AUTO_BIND_TLS_BEFORE_BIND",
         "client_strategy": "REUSABLE",
         "pool_size": 10,
@@ -78,12 +243,14 @@ class LdapAttributeStore(ResponseMicroService):
             raise LdapAttributeStoreError(msg)
 
         self.config = {}
+        self.stats = Counter()
 
         # Process the default configuration first then any per-SP overrides.
         sp_list = ["default"]
         sp_list.extend([key for key in config.keys() if key != "default"])
 
         connections = {}
+        caches = {}
 
         for sp in sp_list:
             if not isinstance(config[sp], dict):
@@ -129,6 +296,21 @@ class LdapAttributeStore(ResponseMicroService):
                         satosa_logging(logger, logging.ERROR, msg, None)
                         raise LdapAttributeStoreError(msg)
 
+            # SPs with the same search cache configuration share the cache.
+            cache_config = sp_config["search_cache"]
+            sp_config["cache"] = None
+            if cache_config:
+                cache_params = json.dumps(cache_config, sort_keys=True)
+                if cache_params not in caches:
+                    try:
+                        caches[cache_params] = LdapSearchCache(**cache_config)
+                    except (TypeError, sqlite3.Error) as err:
+                        msg = "Invalid search cache configuration for SP {}: {}"
+                        msg = msg.format(sp, err)
+                        satosa_logging(logger, logging.ERROR, msg, None)
+                        raise LdapAttributeStoreError(msg)
+                sp_config["cache"] = caches[cache_params]
+
             self.config[sp] = sp_config
 
         msg = "LDAP Attribute Store microservice initialized"
@@ -236,12 +418,62 @@ class LdapAttributeStore(ResponseMicroService):
 
         return value
 
+    @property
+    def search_stats(self):
+        """
+        :rtype: dict[str, float]
+        :return: The number of processed authentications and LDAP searches, the average number of
+        searches per authentication and the average latency of a search in seconds
+        """
+        authentications = self.stats["authentications"]
+        searches = self.stats["searches"]
+        return {
+            "authentications": authentications,
+            "searches": searches,
+            "searches_per_authentication": searches / authentications if authentications else 0.0,
+            "average_latency": self.stats["search_seconds"] / searches if searches else 0.0,
+        }
+
+    def _select_record(self, config, responses, filter_values):
+        """
+        Select the record matching the candidate with the highest priority
+        from the records returned by a combined search.
+
+        :type config: dict[str, Any]
+        :type responses: list
+        :type filter_values: list[str]
+        :rtype: dict
+
+        :param config: The configuration for the requester
+        :param responses: The records returned by the combined search
+        :param filter_values: The filter values in the order of the candidates
+        :return: The record to use
+        """
+        ldap_ident_attr = config["ldap_identifier_attribute"].lower()
+        records_by_value = {}
+        for response in responses:
+            for attr, values in response.get("attributes", {}).items():
+                if attr.lower() != ldap_ident_attr:
+                    continue
+                for value in values if isinstance(values, list) else [values]:
+                    records_by_value.setdefault(str(value).lower(), response)
+
+        for filter_val in filter_values:
+            record = records_by_value.get(filter_val.lower())
+            if record is not None:
+                return record
+
+        msg = "No record returned by the combined search has a value of {}, using the first record"
+        msg = msg.format(config["ldap_identifier_attribute"])
+        satosa_logging(logger, logging.WARN, msg, None)
+        return responses[0]
+
     def _filter_config(self, config, fields=None):
         """
         Filter sensitive details like passwords from a configuration
         dictionary.
         """
-        filter_fields_default = ["bind_password", "connection"]
+        filter_fields_default = ["bind_password", "connection", "cache"]
         filter_fields = fields or filter_fields_default
         result = {
             field: "<hidden>" if field in filter_fields else value
@@ -429,56 +661,114 @@ class LdapAttributeStore(ResponseMicroService):
         # Initialize an empty LDAP record. The first LDAP record found using
         # the ordered # list of search filter values will be the record used.
         record = None
-        results = None
         exp_msg = None
 
-        for filter_val in filter_values:
-            connection = config["connection"]
-            ldap_ident_attr = config["ldap_identifier_attribute"]
-            search_filter = "({0}={1})".format(ldap_ident_attr, filter_val)
+        connection = config["connection"]
+        ldap_ident_attr = config["ldap_identifier_attribute"]
+        attributes = (
+            config["query_return_attributes"]
+            if config["query_return_attributes"]
+            # Deprecated configuration. Will be removed in future.
+            else config["search_return_attributes"].keys()
+        )
+
+        # Search for one candidate after the other or, if so configured,
+        # for all candidates at once. The record of the candidate with the
+        # highest priority is then picked from the returned records, which
+        # needs the identifier attribute of the records.
+        if config["combined_search"] and len(filter_values) > 1:
+            searches = [filter_values]
+            if ldap_ident_attr not in attributes:
+                attributes = list(attributes) + [ldap_ident_attr]
+        else:
+            searches = [[filter_val] for filter_val in filter_values]
+
+        self.stats["authentications"] += 1
+        for search_values in searches:
+            filter_val = " or ".join(search_values)
+            search_filter = "".join(
+                "({0}={1})".format(ldap_ident_attr, value) for value in search_values
+            )
+            if len(search_values) > 1:
+                search_filter = "(|{})".format(search_filter)
             msg = {
                 "message": "LDAP query with constructed search filter",
                 "search filter": search_filter,
             }
             satosa_logging(logger, logging.DEBUG, msg, context.state)
 
-            attributes = (
-                config["query_return_attributes"]
-                if config["query_return_attributes"]
-                # Deprecated configuration. Will be removed in future.
-                else config["search_return_attributes"].keys()
+            cache = None if config["bypass_search_cache"] else config["cache"]
+            # SPs that share a cache may bind as different identities, which
+            # can see different records and attributes.
+            cache_key = (
+                config["ldap_url"],
+                config["search_base"],
+                config["bind_dn"],
+                search_filter,
+                tuple(sorted(attributes)),
             )
-            try:
-                results = connection.search(
-                    config["search_base"], search_filter, attributes=attributes
-                )
-            except LDAPException as err:
-                exp_msg = "Caught LDAP exception: {}".format(err)
-            except LdapAttributeStoreError as err:
-                exp_msg = "Caught LDAP Attribute Store exception: {}"
-                exp_msg = exp_msg.format(err)
-            except Exception as err:
-                exp_msg = "Caught unhandled exception: {}".format(err)
-
-            if exp_msg:
-                satosa_logging(logger, logging.ERROR, exp_msg, context.state)
-                return super().process(context, data)
-
-            if not results:
+            responses = cache.get(cache_key) if cache is not None else None
+            if responses is not None:
+                msg = "Found {} records in the search cache".format(len(responses))
+                satosa_logging(logger, logging.DEBUG, msg, context.state)
+            else:
+                self.stats["searches"] += 1
+                search_start = time.monotonic()
+                try:
+                    results = connection.search(
+                        config["search_base"], search_filter, attributes=attributes
+                    )
+                except LDAPException as err:
+                    exp_msg = "Caught LDAP exception: {}".format(err)
+                except LdapAttributeStoreError as err:
+                    exp_msg = "Caught LDAP Attribute Store exception: {}"
+                    exp_msg = exp_msg.format(err)
+                except Exception as err:
+                    exp_msg = "Caught unhandled exception: {}".format(err)
+                finally:
+                    self.stats["search_seconds"] += time.monotonic() - search_start
+
+                if exp_msg:
+                    satosa_logging(logger, logging.ERROR, exp_msg, context.state)
+                    return super().process(context, data)
+
+                if not results:
+                    responses = []
+                elif isinstance(results, bool):
+                    # This adapts records with different search and connection
+                    # strategy (sync without pool), it should be tested with
+                    # anonimous bind with message_id.
+                    responses = [
+                        {
+                            "dn": entry.entry_dn if hasattr(entry, "entry_dn") else "",
+                            "attributes": (
+                                entry.entry_attributes_as_dict
+                                if hasattr(entry, "entry_attributes_as_dict")
+                                else {}
+                            ),
+                        }
+                        for entry in connection.entries
+                    ]
+                else:
+                    responses = connection.get_response(results)[0]
+
+                if cache is not None:
+                    cache.set(cache_key, responses)
+
+                msg = "Done querying LDAP server"
+                satosa_logging(logger, logging.DEBUG, msg, context.state)
+                msg = "LDAP server returned {} records".format(len(responses))
+                satosa_logging(logger, logging.INFO, msg, context.state)
+
+            if not responses:
                 msg = "Querying LDAP server: No results for {}."
                 msg = msg.format(filter_val)
                 satosa_logging(logger, logging.DEBUG, msg, context.state)
                 continue
 
-            if isinstance(results, bool):
-                responses = connection.entries
-            else:
-                responses = connection.get_response(results)[0]
-
-            msg = "Done querying LDAP server"
-            satosa_logging(logger, logging.DEBUG, msg, context.state)
-            msg = "LDAP server returned {} records".format(len(responses))
-            satosa_logging(logger, logging.INFO, msg, context.state)
+            if len(responses) > 0 and len(search_values) > 1:
+                record = self._select_record(config, responses, search_values)
+                break
 
             # For now consider only the first record found (if any).
             if len(responses) > 0:
@@ -498,19 +788,6 @@ class LdapAttributeStore(ResponseMicroService):
             satosa_logging(logger, logging.DEBUG, msg, context.state)
             data.attributes = {}
 
-        # This adapts records with different search and connection strategy
-        # (sync without pool), it should be tested with anonimous bind with
-        # message_id.
-        if isinstance(results, bool):
-            record = {
-                "dn": record.entry_dn if hasattr(record, "entry_dn") else "",
-                "attributes": (
-                    record.entry_attributes_as_dict
-                    if hasattr(record, "entry_attributes_as_dict")
-                    else {}
-                ),
-            }
-
         # Use a found record, if any, to populate attributes and input for
         # NameID
         if record:
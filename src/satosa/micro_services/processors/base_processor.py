@@ -2,5 +2,14 @@ class BaseProcessor(object):
     def __init__(self):
         pass
 
+    def validate(self, attribute, **kwargs):
+        """
+        Checks the configuration of the processor once, when the
+        AttributeProcessor is created.
+
+        Raise AttributeProcessorError if the configuration is invalid.
+        """
+        pass
+
     def process(internal_data, attribute, **kwargs):
         pass
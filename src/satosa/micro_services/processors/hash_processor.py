@@ -11,6 +11,12 @@ CONFIG_DEFAULT_HASHALGO = 'sha256'
 
 
 class HashProcessor(BaseProcessor):
+    def validate(self, attribute, **kwargs):
+        hash_algo = kwargs.get(CONFIG_KEY_HASHALGO, CONFIG_DEFAULT_HASHALGO)
+        if hash_algo not in hashlib.algorithms_available:
+            raise AttributeProcessorError(
+                "Hash algorithm not supported: {}".format(hash_algo))
+
     def process(self, internal_data, attribute, **kwargs):
         salt = kwargs.get(CONFIG_KEY_HASHALGO, CONFIG_DEFAULT_SALT)
         hash_algo = kwargs.get(CONFIG_KEY_HASHALGO, CONFIG_DEFAULT_HASHALGO)
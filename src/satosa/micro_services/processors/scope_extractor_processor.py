@@ -22,6 +22,11 @@ class ScopeExtractorProcessor(BaseProcessor):
           module: satosa.micro_services.processors.scope_extractor_processor
           mapped_attribute: domain
     """
+    def validate(self, attribute, **kwargs):
+        mapped_attribute = kwargs.get(CONFIG_KEY_MAPPEDATTRIBUTE, CONFIG_DEFAULT_MAPPEDATTRIBUTE)
+        if mapped_attribute is None or mapped_attribute == '':
+            raise AttributeProcessorError("The mapped_attribute needs to be set")
+
     def process(self, internal_data, attribute, **kwargs):
         mapped_attribute = kwargs.get(CONFIG_KEY_MAPPEDATTRIBUTE, CONFIG_DEFAULT_MAPPEDATTRIBUTE)
         if mapped_attribute is None or mapped_attribute == '':
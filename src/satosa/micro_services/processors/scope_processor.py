@@ -7,6 +7,11 @@ CONFIG_DEFAULT_SCOPE = ''
 
 
 class ScopeProcessor(BaseProcessor):
+    def validate(self, attribute, **kwargs):
+        scope = kwargs.get(CONFIG_KEY_SCOPE, CONFIG_DEFAULT_SCOPE)
+        if scope is None or scope == '':
+            raise AttributeProcessorError("No scope set.")
+
     def process(self, internal_data, attribute, **kwargs):
         scope = kwargs.get(CONFIG_KEY_SCOPE, CONFIG_DEFAULT_SCOPE)
         if scope is None or scope == '':
@@ -0,0 +1,137 @@
+"""
+Precompiled regex rules for the attribute micro services.
+
+Rules are configured as nested dicts, e.g. per requester and per provider, with attribute names
+and regexes as the leaves. The regexes are compiled once and the rules applying to a requester
+and provider are resolved once and remembered.
+"""
+import functools
+import re
+
+from ..util import get_dict_defaults
+
+RULE_CACHE_SIZE = 1024
+
+_BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+
+
+def has_backreference(pattern):
+    """
+    :type pattern: str
+    :rtype: bool
+    :return: Whether the regex refers to one of its groups, which prevents combining it with
+    other regexes
+    """
+    return _BACKREFERENCE.search(pattern) is not None
+
+
+class _AnyPattern(object):
+    """
+    Matches if any of the patterns matches, for patterns that can't be combined into a single
+    regex.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+
+    def search(self, value):
+        for pattern in self.patterns:
+            match = pattern.search(value)
+            if match:
+                return match
+        return None
+
+
+def compile_any(patterns):
+    """
+    Compiles regexes into a single matcher, searching for any of them.
+
+    The regexes are combined into one alternation when possible, i.e. unless they contain
+    backreferences or global flags.
+
+    :type patterns: str | list[str]
+    :rtype: re.Pattern | satosa.micro_services.rules._AnyPattern
+
+    :param patterns: The regexes
+    :return: An object with a search method, returning a match if any of the regexes matches
+    """
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    patterns = list(dict.fromkeys(patterns))
+    if not patterns:
+        # an empty alternation would match everything, no regexes match nothing
+        return _AnyPattern(patterns)
+    if len(patterns) == 1:
+        return re.compile(patterns[0])
+    if any(has_backreference(pattern) for pattern in patterns):
+        return _AnyPattern(patterns)
+    try:
+        return re.compile("|".join("(?:{})".format(pattern) for pattern in patterns))
+    except re.error:
+        return _AnyPattern(patterns)
+
+
+def compile_rules(rules, depth):
+    """
+    Compiles the regexes of nested rules.
+
+    :type rules: dict[str, Any]
+    :type depth: int
+    :rtype: dict[str, Any]
+
+    :param rules: The rules, nested dicts with a dict of attribute names and regexes as leaves
+    :param depth: The number of levels above the attribute names
+    :return: The rules with a compiled matcher for each attribute
+    """
+    if depth == 0:
+        return {attribute: compile_any(patterns) for attribute, patterns in rules.items()}
+    return {key: compile_rules(value, depth - 1) for key, value in rules.items()}
+
+
+class RuleSet(object):
+    """
+    Regexes per attribute, configured for combinations of keys, e.g. a requester and a provider,
+    where "" or "default" is used for a key without rules of its own.
+    """
+
+    def __init__(self, rules, depth=2, cache_size=RULE_CACHE_SIZE):
+        """
+        :type rules: dict[str, Any]
+        :type depth: int
+        :type cache_size: int
+
+        :param rules: The rules, see compile_rules
+        :param depth: The number of keys to resolve the rules
+        :param cache_size: The number of key combinations for which the resolved rules are kept
+        """
+        self.rules = compile_rules(rules or {}, depth)
+        self.resolve = functools.lru_cache(maxsize=cache_size)(self._resolve)
+
+    def _resolve(self, *keys):
+        """
+        :type keys: str
+        :rtype: dict[str, re.Pattern]
+
+        :param keys: e.g. the requester and provider
+        :return: The matcher of each attribute
+        """
+        return get_dict_defaults(self.rules, *keys)
+
+    @property
+    def cache_stats(self):
+        """
+        :rtype: dict[str, int]
+        :return: The hits, misses and size of the cache of resolved rules
+        """
+        info = self.resolve.cache_info()
+        return {"hits": info.hits, "misses": info.misses, "size": info.currsize}
+
+
+def any_match(matcher, values):
+    """
+    :type matcher: re.Pattern
+    :type values: list[str]
+    :rtype: bool
+    :return: Whether any of the values matches, stops at the first match
+    """
+    return any(matcher.search(value) for value in values)
@@ -14,6 +14,8 @@ from .backends.base import BackendModule
 from .exception import SATOSAConfigurationError
 from .frontends.base import FrontendModule
 from .micro_services.base import (MicroService, RequestMicroService, ResponseMicroService)
+from .state import STATE_COOKIE_MAX_AGE
+from .state_store import StateStore
 
 logger = logging.getLogger(__name__)
 
@@ -280,3 +282,52 @@ def load_response_microservices(plugin_path, plugins, internal_attributes, base_
                                             base_url)
     logger.info("Loaded response micro services:{}".format([type(k).__name__ for k in response_services]))
     return response_services
+
+
+def load_state_store(config):
+    """
+    Loads the server side state store, if one is configured.
+
+    The store is configured with the `module` to load and its (optional) `config`, which is passed
+    as keyword arguments to the store. Unless given, the lifetime of the stored states is the
+    max-age of the state cookie.
+
+    :type config: satosa.satosa_config.SATOSAConfig
+    :rtype: satosa.state_store.StateStore | None
+
+    :param config: The configuration of the satosa proxy
+    :return: The state store, or None if the state is kept in the cookie
+    """
+    store_config = config.get("STATE_STORE")
+    if not store_config:
+        return None
+    state_store = load_store(store_config, STATE_COOKIE_MAX_AGE, "state store")
+    logger.info("Loaded state store: {}".format(type(state_store).__name__))
+    return state_store
+
+
+def load_store(store_config, ttl, description="store"):
+    """
+    Loads a store from its configuration, the `module` to load and its (optional) `config`, which
+    is passed as keyword arguments to the store.
+
+    :type store_config: dict[str, Any]
+    :type ttl: int
+    :type description: str
+    :rtype: satosa.state_store.StateStore
+
+    :param store_config: The configuration of the store
+    :param ttl: The lifetime of the stored entries, unless configured
+    :param description: What the store is used for, for error messages
+    :return: The store
+    """
+    if "module" not in store_config:
+        raise SATOSAConfigurationError("Missing mandatory {} configuration parameter: module".format(description))
+
+    store_class = locate(store_config["module"])
+    if not store_class or not issubclass(store_class, StateStore):
+        raise SATOSAConfigurationError("Can't find {} '{}'".format(description, store_config["module"]))
+
+    store_kwargs = dict(store_config.get("config") or {})
+    store_kwargs.setdefault("ttl", ttl)
+    return store_class(**store_kwargs)
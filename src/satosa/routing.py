@@ -1,6 +1,7 @@
 """
 Holds satosa routing logic
 """
+import functools
 import logging
 import re
 
@@ -14,6 +15,226 @@ logger = logging.getLogger(__name__)
 
 STATE_KEY = "ROUTER"
 
+ROUTE_CACHE_SIZE = 1024
+
+_REGEX_METACHARS = set(".^$*+?{}[]\\|()")
+_QUANTIFIERS = set("?*+{")
+_BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+
+
+def _log_debug(context, msg):
+    # formatting the log line decodes a lazily loaded state, avoid it unless the line is emitted
+    if logger.isEnabledFor(logging.DEBUG):
+        logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
+        logger.debug(logline)
+
+
+def _read_literal(pattern, pos):
+    """
+    Reads the literal characters of a regex, starting at pos.
+
+    :type pattern: str
+    :type pos: int
+    :rtype: (str, int)
+    :return: The mandatory literal string and the position of the first non literal character
+    """
+    literal = []
+    while pos < len(pattern):
+        char = pattern[pos]
+        if char == "\\":
+            if pos + 1 >= len(pattern) or pattern[pos + 1].isalnum():
+                break
+            literal.append(pattern[pos + 1])
+            pos += 2
+        elif char in _REGEX_METACHARS:
+            break
+        else:
+            literal.append(char)
+            pos += 1
+    if literal and pos < len(pattern) and pattern[pos] in _QUANTIFIERS:
+        # the quantifier applies to the last character, which is not mandatory
+        literal.pop()
+    return "".join(literal), pos
+
+
+def _split_alternatives(pattern, pos=0):
+    """
+    Splits a regex, starting at pos, into its top level alternatives. The scan stops at the
+    closing parenthesis of an enclosing group.
+
+    :type pattern: str
+    :type pos: int
+    :rtype: (list[str], int)
+    :return: The alternatives and the position where the scan stopped
+    """
+    alternatives = []
+    start = pos
+    depth = 0
+    in_class = False
+    while pos < len(pattern):
+        char = pattern[pos]
+        if char == "\\":
+            pos += 2
+            continue
+        if in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            if depth == 0:
+                break
+            depth -= 1
+        elif char == "|" and depth == 0:
+            alternatives.append(pattern[start:pos])
+            start = pos + 1
+        pos += 1
+    alternatives.append(pattern[start:pos])
+    return alternatives, pos
+
+
+def _unpack_endpoint(endpoint):
+    """
+    Splits a registered endpoint into its regex, spec and optional guard.
+
+    :type endpoint: (str, Any) | (str, Any, (re.Match) -> bool)
+    :rtype: (str, Any, ((re.Match) -> bool) | None)
+    """
+    regex, spec = endpoint[:2]
+    guard = endpoint[2] if len(endpoint) > 2 else None
+    return regex, spec, guard
+
+
+def _analyze_pattern(pattern):
+    """
+    Finds out how an endpoint regex can be dispatched without running it against every path.
+
+    :type pattern: str
+    :rtype: (bool, str | None, set[str] | None)
+
+    :param pattern: The endpoint regex
+    :return: Whether the regex can only match at the start of a path, the path if the regex only
+    matches that exact path and the possible first path segments (None if unknown)
+    """
+    alternatives, _ = _split_alternatives(pattern)
+    if len(alternatives) > 1:
+        results = [_analyze_pattern(alternative) for alternative in alternatives]
+        anchored = all(result[0] for result in results)
+        if not anchored or any(result[2] is None for result in results):
+            return anchored, None, None
+        return True, None, set().union(*(result[2] for result in results))
+
+    if pattern.startswith("^"):
+        literal, pos = _read_literal(pattern, 1)
+        if pattern[pos:] == "$":
+            return True, literal, {literal.split("/", 1)[0]}
+        if "/" in literal:
+            return True, None, {literal.split("/", 1)[0]}
+        return True, None, None
+
+    # a leading group of anchored literals, like '(^a|^b)/...'
+    if pattern.startswith("(?:"):
+        group_start = 3
+    elif pattern.startswith("(") and not pattern.startswith("(?"):
+        group_start = 1
+    else:
+        return False, None, None
+    alternatives, pos = _split_alternatives(pattern, group_start)
+    if pos >= len(pattern) or not all(alt.startswith("^") for alt in alternatives):
+        return False, None, None
+    if pattern[pos + 1:pos + 2] in ("?", "*", "{"):
+        # the group is optional
+        return False, None, None
+
+    segments = set()
+    for alternative in alternatives:
+        literal, end = _read_literal(alternative, 1)
+        if end != len(alternative) or "/" in literal:
+            return True, None, None
+        segments.add(literal)
+    if pattern[pos + 1:pos + 2] != "/":
+        return True, None, None
+    return True, None, segments
+
+
+class _RouteTable(object):
+    """
+    A set of endpoints, matched in the order of their priority.
+
+    Exact paths are looked up in a dict, regexes that can only match at the start of the path are
+    combined into a single alternation (the first alternative matching at the start is the one
+    with the highest priority) and all other regexes are tried one by one. So are the regexes
+    with a guard, which may reject a path the regex matches.
+    """
+
+    def __init__(self, routes):
+        """
+        :type routes: list[(int, str, (int, str, str, Any), ((re.Match) -> bool) | None)]
+        :param routes: (priority, regex, route, guard) tuples, route being (priority, kind, name,
+        spec)
+        """
+        self.literals = {}
+        self.routes = {}
+        self.combined = None
+        self.others = []
+
+        anchored = []
+        for priority, pattern, route, guard in sorted(routes, key=lambda r: r[0]):
+            is_anchored, literal_path, _ = _analyze_pattern(pattern)
+            compiled = re.compile(pattern)
+            if guard is not None:
+                self.others.append((compiled, route, guard))
+            elif literal_path is not None:
+                self.literals.setdefault(literal_path, route)
+            elif is_anchored and not compiled.flags & re.MULTILINE and not _BACKREFERENCE.search(pattern):
+                anchored.append((pattern, route))
+            else:
+                self.others.append((compiled, route, None))
+
+        if anchored:
+            alternation = []
+            for index, (pattern, route) in enumerate(anchored):
+                group = "_r{}".format(index)
+                self.routes[group] = route
+                alternation.append("(?P<{}>{})".format(group, pattern))
+            try:
+                self.combined = re.compile("|".join(alternation))
+            except re.error:
+                # e.g. duplicate group names, fall back to matching the regexes one by one
+                self.routes = {}
+                self.others.extend((re.compile(pattern), route, None) for pattern, route in anchored)
+                self.others.sort(key=lambda r: r[1][0])
+
+    def match(self, path, best=None):
+        """
+        :type path: str
+        :type best: (int, str, str, Any) | None
+        :rtype: (int, str, str, Any) | None
+
+        :param path: The path to match
+        :param best: The best route found so far
+        :return: The route with the highest priority matching the path
+        """
+        route = self.literals.get(path)
+        if route is not None and (best is None or route[0] < best[0]):
+            best = route
+
+        if self.combined is not None:
+            match = self.combined.match(path)
+            if match is not None:
+                route = self.routes[match.lastgroup]
+                if best is None or route[0] < best[0]:
+                    best = route
+
+        for compiled, route, guard in self.others:
+            if best is not None and route[0] > best[0]:
+                break
+            match = compiled.search(path)
+            if match and (guard is None or guard(match)):
+                return route
+        return best
+
 
 class SATOSANoBoundEndpointError(SATOSAError):
     """
@@ -30,19 +251,17 @@ class SATOSAUnknownTargetBackend(SATOSAError):
 
 
 class ModuleRouter(object):
-    class UnknownEndpoint(ValueError):
-        pass
-
     """
     Routes url paths to their bound functions
     and handles the internal routing between frontends and backends.
     """
 
-    def __init__(self, frontends, backends, micro_services):
+    def __init__(self, frontends, backends, micro_services, cache_size=ROUTE_CACHE_SIZE):
         """
         :type frontends: dict[str, satosa.frontends.base.FrontendModule]
         :type backends: dict[str, satosa.backends.base.BackendModule]
         :type micro_services: Sequence[satosa.micro_services.base.MicroService]
+        :type cache_size: int
 
         :param frontends: All available frontends used by the proxy. Key as frontend name, value as
         module
@@ -50,6 +269,7 @@ class ModuleRouter(object):
         module
         :param micro_services: All available micro services used by the proxy. Key as micro service name, value as
         module
+        :param cache_size: Number of paths for which the matched endpoint is remembered
         """
 
         if not frontends or not backends:
@@ -72,6 +292,68 @@ class ModuleRouter(object):
         logger.debug("Loaded frontends with endpoints: {}".format(frontends))
         logger.debug("Loaded micro services with endpoints: {}".format(micro_services))
 
+        self._compile_routes()
+        self._lookup = functools.lru_cache(maxsize=cache_size)(self._match_path)
+
+    def _compile_routes(self):
+        """
+        Builds the dispatch tables for all registered endpoints.
+
+        Endpoints keep their priority: frontends first, then micro services, each in the order of
+        registration, and backend endpoints last, which are only considered if the first path
+        segment is the name of the backend.
+
+        An endpoint is either (regex, spec) or (regex, spec, guard), guard being called with the
+        match object of the regex and returning whether the endpoint handles the path; if it
+        does not, the path is matched against the remaining endpoints.
+        """
+        routes = []
+        for kind, modules in [("frontend", self.frontends), ("micro_service", self.micro_services)]:
+            for module in modules.values():
+                for endpoint in module["endpoints"]:
+                    regex, spec, guard = _unpack_endpoint(endpoint)
+                    routes.append((regex, (len(routes), kind, module["instance"].name, spec), guard))
+
+        by_segment = {}
+        generic = []
+        for regex, route, guard in routes:
+            _, _, segments = _analyze_pattern(regex)
+            if segments is None:
+                generic.append((route[0], regex, route, guard))
+                continue
+            for segment in segments:
+                by_segment.setdefault(segment, []).append((route[0], regex, route, guard))
+
+        self._segment_routes = {segment: _RouteTable(table) for segment, table in by_segment.items()}
+        self._generic_routes = _RouteTable(generic)
+
+        self._backend_routes = {}
+        for name, module in self.backends.items():
+            table = []
+            for i, endpoint in enumerate(module["endpoints"]):
+                regex, spec, guard = _unpack_endpoint(endpoint)
+                priority = len(routes) + i
+                table.append((priority, regex, (priority, "backend", name, spec), guard))
+            self._backend_routes[name] = _RouteTable(table)
+
+    def _match_path(self, path):
+        """
+        :type path: str
+        :rtype: (int, str, str, Any) | None
+
+        :param path: The path to route
+        :return: The matching route, (priority, kind, module name, spec), or None
+        """
+        segment = path.split("/", 1)[0]
+        route = None
+        segment_routes = self._segment_routes.get(segment)
+        if segment_routes is not None:
+            route = segment_routes.match(path)
+        route = self._generic_routes.match(path, route)
+        if route is None and segment in self._backend_routes:
+            route = self._backend_routes[segment].match(path)
+        return route
+
     def backend_routing(self, context):
         """
         Returns the targeted backend and an updated state
@@ -83,8 +365,7 @@ class ModuleRouter(object):
         :return: backend
         """
         msg = "Routing to backend: {backend}".format(backend=context.target_backend)
-        logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
-        logger.debug(logline)
+        _log_debug(context, msg)
         backend = self.backends[context.target_backend]["instance"]
         context.state[STATE_KEY] = context.target_frontend
         return backend
@@ -102,38 +383,11 @@ class ModuleRouter(object):
 
         target_frontend = context.state[STATE_KEY]
         msg = "Routing to frontend: {frontend}".format(frontend=target_frontend)
-        logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
-        logger.debug(logline)
+        _log_debug(context, msg)
         context.target_frontend = target_frontend
         frontend = self.frontends[context.target_frontend]["instance"]
         return frontend
 
-    def _find_registered_endpoint_for_module(self, module, context):
-        for regex, spec in module["endpoints"]:
-            match = re.search(regex, context.path)
-            if match is not None:
-                msg = "Found registered endpoint: module name:'{name}', endpoint: {endpoint}".format(
-                    name=module["instance"].name, endpoint=context.path
-                )
-                logline = lu.LOG_FMT.format(
-                    id=lu.get_session_id(context.state), message=msg
-                )
-                logger.debug(logline)
-                return spec
-
-        return None
-
-    def _find_registered_backend_endpoint(self, context):
-        return self._find_registered_endpoint_for_module(self.backends[context.target_backend], context)
-
-    def _find_registered_endpoint(self, context, modules):
-        for module in modules.values():
-            matched = self._find_registered_endpoint_for_module(module, context)
-            if matched:
-                return module["instance"].name, matched
-
-        raise ModuleRouter.UnknownEndpoint(context.path)
-
     def endpoint_routing(self, context):
         """
         Finds and returns the endpoint function bound to the path
@@ -146,15 +400,11 @@ class ModuleRouter(object):
         """
         if context.path is None:
             msg = "Context did not contain a path!"
-            logline = lu.LOG_FMT.format(
-                id=lu.get_session_id(context.state), message=msg
-            )
-            logger.debug(logline)
+            _log_debug(context, msg)
             raise SATOSABadContextError("Context did not contain any path")
 
         msg = "Routing path: {path}".format(path=context.path)
-        logline = lu.LOG_FMT.format(id=lu.get_session_id(context.state), message=msg)
-        logger.debug(logline)
+        _log_debug(context, msg)
         path_split = context.path.split("/")
         backend = path_split[0]
 
@@ -162,30 +412,19 @@ class ModuleRouter(object):
             context.target_backend = backend
         else:
             msg = "Unknown backend {}".format(backend)
-            logline = lu.LOG_FMT.format(
-                id=lu.get_session_id(context.state), message=msg
-            )
-            logger.debug(logline)
-
-        try:
-            name, frontend_endpoint = self._find_registered_endpoint(context, self.frontends)
-        except ModuleRouter.UnknownEndpoint:
-            pass
-        else:
+            _log_debug(context, msg)
+
+        route = self._lookup(context.path)
+        if route is None:
+            raise SATOSANoBoundEndpointError("'{}' not bound to any function".format(context.path))
+
+        _, kind, name, spec = route
+        msg = "Found registered endpoint: module name:'{name}', endpoint: {endpoint}".format(
+            name=name, endpoint=context.path
+        )
+        _log_debug(context, msg)
+        if kind == "frontend":
             context.target_frontend = name
-            return frontend_endpoint
-
-        try:
-            name, micro_service_endpoint = self._find_registered_endpoint(context, self.micro_services)
-        except ModuleRouter.UnknownEndpoint:
-            pass
-        else:
+        elif kind == "micro_service":
             context.target_micro_service = name
-            return micro_service_endpoint
-
-        if backend in self.backends:
-            backend_endpoint = self._find_registered_backend_endpoint(context)
-            if backend_endpoint:
-                return backend_endpoint
-
-        raise SATOSANoBoundEndpointError("'{}' not bound to any function".format(context.path))
+        return spec
@@ -0,0 +1,26 @@
+import click
+import yaml
+from saml2.config import Config
+
+from ..metadata_index import build_metadata_index
+
+
+def create_metadata_index(metadata_conf, output):
+    """
+    Loads the metadata described by METADATA_CONF, as the 'metadata' section of a pysaml2
+    configuration, and writes its index to OUTPUT.
+    """
+    if not isinstance(metadata_conf, dict):
+        with open(metadata_conf) as f:
+            metadata_conf = yaml.safe_load(f)
+    conf = Config().load({"metadata": metadata_conf})
+    count = build_metadata_index(conf.metadata, output)
+    print("Wrote the index of {} entities to '{}'".format(count, output))
+    return count
+
+
+@click.command()
+@click.argument("metadata_conf")
+@click.argument("output")
+def construct_metadata_index(metadata_conf, output):
+    create_metadata_index(metadata_conf, output)
@@ -4,10 +4,15 @@ server.
 """
 import base64
 import copy
+import functools
 import hashlib
+import hmac
 import json
 import logging
-from collections import UserDict
+import secrets
+import zlib
+from collections import Counter, UserDict
+from collections.abc import Mapping
 from http.cookies import SimpleCookie
 from lzma import LZMADecompressor, LZMACompressor
 
@@ -23,8 +28,19 @@ logger = logging.getLogger(__name__)
 STATE_COOKIE_MAX_AGE = 1200
 STATE_COOKIE_SECURE = True
 
+# Separates the codec version from the encoded state, e.g. "v1.<payload>". The separator is not
+# part of the urlsafe base64 alphabet, so values without it are in the legacy (unversioned) format.
+STATE_CODEC_SEPARATOR = "."
+DEFAULT_STATE_CODEC = "v1"
 
-def state_to_cookie(state, name, path, encryption_key):
+# Number of states decoded, encoded and of unchanged states that were not saved again
+STATE_STATS = Counter()
+
+# Prefix of the cookie value when the state is kept in a server side store: "id.<state id>.<mac>"
+STATE_HANDLE_PREFIX = "id"
+
+
+def state_to_cookie(state, name, path, encryption_key, codec=None, store=None):
     """
     Saves a state to a cookie
 
@@ -32,16 +48,27 @@ def state_to_cookie(state, name, path, encryption_key):
     :type name: str
     :type path: str
     :type encryption_key: str
+    :type codec: str | None
+    :type store: satosa.state_store.StateStore | None
     :rtype: http.cookies.SimpleCookie
 
     :param state: The state to save
     :param name: Name identifier of the cookie
     :param path: Endpoint path the cookie will be associated to
     :param encryption_key: Key to encrypt the state information
+    :param codec: Name of the state codec to use, defaults to DEFAULT_STATE_CODEC
+    :param store: If given, the state is saved in the store and the cookie only holds its handle
     :return: A cookie
     """
 
-    cookie_data = "" if state.delete else state.urlstate(encryption_key)
+    if store is None:
+        cookie_data = "" if state.delete else state.urlstate(encryption_key, codec=codec)
+    elif state.delete:
+        if state.state_id:
+            store.delete(state.state_id)
+        cookie_data = ""
+    else:
+        cookie_data = _save_state_to_store(state, store, encryption_key)
     max_age = 0 if state.delete else STATE_COOKIE_MAX_AGE
 
     satosa_logging(logger, logging.DEBUG,
@@ -55,23 +82,30 @@ def state_to_cookie(state, name, path, encryption_key):
     return cookie
 
 
-def cookie_to_state(cookie_str, name, encryption_key):
+def cookie_to_state(cookie_str, name, encryption_key, store=None, lazy=False):
     """
     Loads a state from a cookie
 
     :type cookie_str: str
     :type name: str
     :type encryption_key: str
+    :type store: satosa.state_store.StateStore | None
     :rtype: satosa.state.State
 
     :param cookie_str: string representation of cookie/s
     :param name: Name identifier of the cookie
     :param encryption_key: Key to encrypt the state information
+    :param store: If given, cookies holding a state handle are resolved through the store
+    :param lazy: Postpone decoding of a state held in the cookie until it is accessed
     :return: A state
     """
     try:
         cookie = SimpleCookie(cookie_str)
-        state = State(cookie[name].value, encryption_key)
+        cookie_data = cookie[name].value
+        if store is not None and _is_state_handle(cookie_data):
+            state = _load_state_from_store(cookie_data, store, encryption_key)
+        else:
+            state = State(cookie_data, encryption_key, lazy=lazy)
     except KeyError as e:
         msg_tmpl = 'No cookie named {name} in {data}'
         msg = msg_tmpl.format(name=name, data=cookie_str)
@@ -84,6 +118,229 @@ def cookie_to_state(cookie_str, name, encryption_key):
         return state
 
 
+def _sign_state_id(state_id, encryption_key):
+    mac = hmac.new(_derive_mac_key(encryption_key), state_id.encode("ascii"), hashlib.sha256)
+    return base64.urlsafe_b64encode(mac.digest()).rstrip(b"=").decode("ascii")
+
+
+def _is_state_handle(cookie_data):
+    return cookie_data.startswith(STATE_HANDLE_PREFIX + STATE_CODEC_SEPARATOR)
+
+
+def _save_state_to_store(state, store, encryption_key):
+    if not state.state_id:
+        state.state_id = secrets.token_urlsafe(24)
+    STATE_STATS["encoded"] += 1
+    store.set(state.state_id, _serialize_state(state.data))
+    return STATE_CODEC_SEPARATOR.join(
+        [STATE_HANDLE_PREFIX, state.state_id, _sign_state_id(state.state_id, encryption_key)])
+
+
+def _load_state_from_store(cookie_data, store, encryption_key):
+    _, state_id, mac = cookie_data.split(STATE_CODEC_SEPARATOR, 2)
+    if not hmac.compare_digest(mac, _sign_state_id(state_id, encryption_key)):
+        raise ValueError("Invalid signature of state handle")
+    stored_data = store.get(state_id)
+    if stored_data is None:
+        raise ValueError("State {} is unknown or expired".format(state_id))
+    state = State()
+    state._load(json.loads(stored_data))
+    state.state_id = state_id
+    return state
+
+
+@functools.lru_cache(maxsize=16)
+def _derive_key(encryption_key):
+    """
+    Derives the 256 bit AES key from the configured encryption key.
+
+    The result is cached per process, since the same key is used for every request.
+
+    :type encryption_key: str
+    :rtype: bytes
+    """
+    return hashlib.sha256(encryption_key.encode()).digest()
+
+
+@functools.lru_cache(maxsize=16)
+def _derive_mac_key(encryption_key):
+    """
+    Derives the key signing the state handles from the configured encryption key, so that it is
+    a different key than the AES key.
+
+    :type encryption_key: str
+    :rtype: bytes
+    """
+    return hmac.new(_derive_key(encryption_key), b"satosa-state-id-mac", hashlib.sha256).digest()
+
+
+class StateCodec(object):
+    """
+    Base class for the serialization formats of the state.
+
+    A codec turns the state dictionary into an url safe string and back. Every codec is
+    registered under its version, which is used as prefix of the encoded value so that a
+    state can always be decoded by the codec that created it.
+    """
+
+    version = None
+
+    def encode(self, data, encryption_key):
+        """
+        :type data: dict[str, Any]
+        :type encryption_key: str
+        :rtype: str
+
+        :param data: The state dictionary
+        :param encryption_key: Key to encrypt the state information
+        :return: The encoded state, without version prefix
+        """
+        raise NotImplementedError()
+
+    def decode(self, payload, encryption_key):
+        """
+        :type payload: str
+        :type encryption_key: str
+        :rtype: dict[str, Any]
+
+        :param payload: The encoded state, without version prefix
+        :param encryption_key: Key to decrypt the state information
+        :return: The state dictionary
+        """
+        raise NotImplementedError()
+
+
+class LegacyStateCodec(StateCodec):
+    """
+    The original state format: LZMA compressed JSON, encrypted with AES-CBC and LZMA compressed
+    again. The encoded value carries no version prefix.
+
+    Only kept to decode cookies issued before the versioned codecs were introduced, or to keep
+    issuing them while older instances are still running.
+    """
+
+    version = "legacy"
+
+    def encode(self, data, encryption_key):
+        lzma = LZMACompressor()
+        urlstate_data = json.dumps(data)
+        urlstate_data = lzma.compress(urlstate_data.encode("UTF-8"))
+        urlstate_data += lzma.flush()
+        urlstate_data = _AESCipher(encryption_key).encrypt(urlstate_data)
+        lzma = LZMACompressor()
+        urlstate_data = lzma.compress(urlstate_data)
+        urlstate_data += lzma.flush()
+        urlstate_data = base64.urlsafe_b64encode(urlstate_data)
+        return urlstate_data.decode("utf-8")
+
+    def decode(self, payload, encryption_key):
+        urlstate_data = payload.encode("utf-8")
+        urlstate_data = base64.urlsafe_b64decode(urlstate_data)
+        lzma = LZMADecompressor()
+        urlstate_data = lzma.decompress(urlstate_data)
+        urlstate_data = _AESCipher(encryption_key).decrypt(urlstate_data)
+        lzma = LZMADecompressor()
+        urlstate_data = lzma.decompress(urlstate_data)
+        urlstate_data = urlstate_data.decode("UTF-8")
+        return json.loads(urlstate_data)
+
+
+class AESGCMStateCodec(StateCodec):
+    """
+    Single pass authenticated state format: compact JSON, zlib compressed and encrypted with
+    AES-GCM. The version is bound to the ciphertext as associated data.
+
+    Layout of the (unpadded urlsafe base64) payload: nonce (12 bytes) | tag (16 bytes) | ciphertext
+    """
+
+    version = "v1"
+    nonce_size = 12
+    tag_size = 16
+
+    def encode(self, data, encryption_key):
+        plaintext = zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+        nonce = Random.get_random_bytes(self.nonce_size)
+        cipher = AES.new(_derive_key(encryption_key), AES.MODE_GCM, nonce=nonce)
+        cipher.update(self.version.encode("ascii"))
+        ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+        encoded = base64.urlsafe_b64encode(nonce + tag + ciphertext)
+        return encoded.rstrip(b"=").decode("ascii")
+
+    def decode(self, payload, encryption_key):
+        raw = base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+        if len(raw) < self.nonce_size + self.tag_size:
+            raise ValueError("State payload is too short")
+        nonce = raw[:self.nonce_size]
+        tag = raw[self.nonce_size:self.nonce_size + self.tag_size]
+        cipher = AES.new(_derive_key(encryption_key), AES.MODE_GCM, nonce=nonce)
+        cipher.update(self.version.encode("ascii"))
+        plaintext = cipher.decrypt_and_verify(raw[self.nonce_size + self.tag_size:], tag)
+        try:
+            plaintext = zlib.decompress(plaintext)
+        except zlib.error as e:
+            raise ValueError("Could not decompress state") from e
+        return json.loads(plaintext.decode("utf-8"))
+
+
+_STATE_CODECS = {}
+
+
+def register_state_codec(codec):
+    """
+    Makes a codec available for encoding and decoding states.
+
+    :type codec: satosa.state.StateCodec
+    :param codec: The codec to register under its version
+    """
+    invalid_version = (
+        not codec.version
+        or STATE_CODEC_SEPARATOR in codec.version
+        or codec.version == STATE_HANDLE_PREFIX
+    )
+    if invalid_version:
+        raise ValueError("Invalid state codec version {!r}".format(codec.version))
+    _STATE_CODECS[codec.version] = codec
+
+
+def get_state_codec(version):
+    """
+    :type version: str
+    :rtype: satosa.state.StateCodec
+
+    :param version: The version of the codec
+    :return: The registered codec
+    """
+    try:
+        return _STATE_CODECS[version]
+    except KeyError as e:
+        raise ValueError("Unknown state codec {!r}".format(version)) from e
+
+
+register_state_codec(LegacyStateCodec())
+register_state_codec(AESGCMStateCodec())
+
+
+def _serialize_state(data):
+    return json.dumps(data, separators=(",", ":"))
+
+
+def _encode_state(data, encryption_key, codec=None):
+    STATE_STATS["encoded"] += 1
+    codec = get_state_codec(codec or DEFAULT_STATE_CODEC)
+    payload = codec.encode(data, encryption_key)
+    if isinstance(codec, LegacyStateCodec):
+        return payload
+    return "{version}{sep}{payload}".format(
+        version=codec.version, sep=STATE_CODEC_SEPARATOR, payload=payload)
+
+
+def _decode_state(urlstate_data, encryption_key):
+    version, sep, payload = urlstate_data.partition(STATE_CODEC_SEPARATOR)
+    if not sep:
+        return get_state_codec(LegacyStateCodec.version).decode(urlstate_data, encryption_key)
+    return get_state_codec(version).decode(payload, encryption_key)
+
+
 class _AESCipher(object):
     """
     This class will perform AES encryption/decryption with a keylength of 256.
@@ -100,7 +357,7 @@ class _AESCipher(object):
         :param key: The key used for encryption and decryption. The longer key the better.
         """
         self.bs = 32
-        self.key = hashlib.sha256(key.encode()).digest()
+        self.key = _derive_key(key)
 
     def encrypt(self, raw):
         """
@@ -153,13 +410,62 @@ class _AESCipher(object):
         return b[:-ord(b[len(b) - 1:])]
 
 
+def _freeze(value):
+    if isinstance(value, dict):
+        return StateView(value)
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+class StateView(Mapping):
+    """
+    Read-only view of (a part of) the state.
+
+    Nothing is copied: nested dictionaries are returned as views and lists as tuples, so the
+    underlying state can not be changed through the view.
+    """
+
+    __slots__ = ("_data",)
+
+    def __init__(self, data):
+        """
+        :type data: dict[str, Any]
+        :param data: The dictionary to provide a view of
+        """
+        self._data = data
+
+    def __getitem__(self, key):
+        return _freeze(self._data[key])
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self._data)
+
+
 class State(UserDict):
     """
     This class holds a state attribute object. A state object must be able to be converted to
     a json string, otherwise will an exception be raised.
+
+    A state created with `lazy=True` is only decoded on first access. The state keeps a
+    snapshot of the data it was loaded with, so `is_modified` also notices changes made to
+    nested values.
+
+    Copies of a state are copy-on-write: the values are shared until a value is accessed through
+    item access, which is when that value is copied. References to nested values obtained before
+    the copy was made are not protected. Use `view` to read the state without copying anything.
     """
 
-    def __init__(self, urlstate_data=None, encryption_key=None):
+    def __init__(self, urlstate_data=None, encryption_key=None, lazy=False):
         """
         If urlstate is empty a new empty state instance will be returned.
 
@@ -167,65 +473,141 @@ class State(UserDict):
         from the urlstate string.
         :type urlstate_data: str
         :type encryption_key: str
+        :type lazy: bool
         :rtype: State
 
         :param encryption_key: The key to be used for encryption.
         :param urlstate_data: A string created by the method urlstate in this class.
+        :param lazy: Postpone decoding of urlstate_data until the state is accessed. A state
+        that can not be decoded is then replaced by an empty state instead of raising an error.
         :return: An instance of this class.
         """
         self.delete = False
+        # Set when the state is kept in a server side store
+        self.state_id = None
+        self._modified = False
+        self._snapshot = None
+        self._pending = None
+        # Keys whose values may be shared with a copy of this state
+        self._shared_keys = set()
 
         if urlstate_data and not encryption_key:
             raise ValueError("If an 'urlstate_data' is supplied 'encrypt_key' must be specified.")
 
-        if urlstate_data:
-            urlstate_data = urlstate_data.encode("utf-8")
-            urlstate_data = base64.urlsafe_b64decode(urlstate_data)
-            lzma = LZMADecompressor()
-            urlstate_data = lzma.decompress(urlstate_data)
-            urlstate_data = _AESCipher(encryption_key).decrypt(urlstate_data)
-            lzma = LZMADecompressor()
-            urlstate_data = lzma.decompress(urlstate_data)
-            urlstate_data = urlstate_data.decode("UTF-8")
-            urlstate_data = json.loads(urlstate_data)
+        super().__init__()
+        if urlstate_data and lazy:
+            self._pending = (urlstate_data, encryption_key)
+        elif urlstate_data:
+            self._load(_decode_state(urlstate_data, encryption_key))
 
-        super().__init__(urlstate_data or {})
+    @property
+    def data(self):
+        if self._pending is not None:
+            self._decode_pending()
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._pending = None
+        self._data = data
+
+    def _load(self, data):
+        self.data = data
+        self._snapshot = _serialize_state(data)
+        self._modified = False
+        STATE_STATS["decoded"] += 1
+
+    def _decode_pending(self):
+        urlstate_data, encryption_key = self._pending
+        self._pending = None
+        try:
+            self._load(_decode_state(urlstate_data, encryption_key))
+        except Exception as e:
+            msg = "Discarding state that could not be decoded: {}".format(e)
+            satosa_logging(logger, logging.WARNING, msg, None)
+            self._data = {}
+            self._modified = True
+
+    @property
+    def is_decoded(self):
+        """
+        :rtype: bool
+        :return: False if the state was created lazily and has not been accessed yet
+        """
+        return self._pending is None
+
+    @property
+    def is_modified(self):
+        """
+        :rtype: bool
+        :return: True if the state differs from the data it was loaded with
+        """
+        if self._pending is not None:
+            return False
+        if self._modified:
+            return True
+        if self._snapshot is None:
+            return bool(self._data)
+        return _serialize_state(self._data) != self._snapshot
 
-    def urlstate(self, encryption_key):
+    @property
+    def view(self):
+        """
+        :rtype: satosa.state.StateView
+        :return: A read-only view of the state
+        """
+        return StateView(self.data)
+
+    def __getitem__(self, key):
+        if key in self._shared_keys:
+            self._shared_keys.discard(key)
+            if key in self.data:
+                self.data[key] = copy.deepcopy(self.data[key])
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, item):
+        self._modified = True
+        self._shared_keys.discard(key)
+        super().__setitem__(key, item)
+
+    def __delitem__(self, key):
+        self._modified = True
+        self._shared_keys.discard(key)
+        super().__delitem__(key)
+
+    def urlstate(self, encryption_key, codec=None):
         """
         Will return a url safe representation of the state.
 
         :type encryption_key: Key used for encryption.
+        :type codec: str | None
         :rtype: str
 
+        :param codec: Name of the state codec to use, defaults to DEFAULT_STATE_CODEC
         :return: Url representation av of the state.
         """
-        lzma = LZMACompressor()
-        urlstate_data = json.dumps(self.data)
-        urlstate_data = lzma.compress(urlstate_data.encode("UTF-8"))
-        urlstate_data += lzma.flush()
-        urlstate_data = _AESCipher(encryption_key).encrypt(urlstate_data)
-        lzma = LZMACompressor()
-        urlstate_data = lzma.compress(urlstate_data)
-        urlstate_data += lzma.flush()
-        urlstate_data = base64.urlsafe_b64encode(urlstate_data)
-        return urlstate_data.decode("utf-8")
+        return _encode_state(self.data, encryption_key, codec)
 
     def copy(self):
         """
-        Returns a deepcopy of the state
+        Returns a copy-on-write copy of the state
 
         :rtype: satosa.state.State
 
         :return: A copy of the state
         """
         state_copy = State()
-        state_copy.data = copy.deepcopy(self.data)
+        state_copy.data = dict(self.data)
+        shared_keys = set(self.data)
+        state_copy._shared_keys = set(shared_keys)
+        self._shared_keys |= shared_keys
         return state_copy
 
     @property
     def state_dict(self):
         """
+        Prefer `view` when the state is only read.
+
         :rtype: dict[str, any]
         :return: A copy of the state as dictionary.
         """
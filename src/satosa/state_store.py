@@ -0,0 +1,342 @@
+"""
+Server side storage of the state.
+
+When a state store is configured, the state cookie only carries a signed, random handle and the
+state itself is kept in one of the stores below.
+"""
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class StateStore(object):
+    """
+    Base class for state stores.
+
+    A store maps a state id to the serialized state and forgets entries that were not written
+    for `ttl` seconds. Expired entries are removed by a background thread every
+    `eviction_interval` seconds, and are never returned by `get`. The thread is started by the
+    first use of the store in a process, so that it also runs in the workers forked after the
+    store was created. The number of expired entries
+    removed is counted in `stats`.
+
+    The stores are not specific to the state, they also keep e.g. the outstanding requests of
+    the SAML backend.
+    """
+
+    def __init__(self, ttl, eviction_interval=60):
+        """
+        :type ttl: int
+        :type eviction_interval: int
+
+        :param ttl: Lifetime in seconds of a stored state
+        :param eviction_interval: Seconds between two runs of the background eviction, or 0 to
+        disable it
+        """
+        self.ttl = ttl
+        self.eviction_interval = eviction_interval
+        self.stats = Counter()
+        self._eviction_pid = None
+        self._eviction_lock = threading.Lock()
+
+    def get(self, state_id):
+        """
+        :type state_id: str
+        :rtype: str | None
+
+        :param state_id: The id of the state
+        :return: The serialized state, or None if it is unknown or expired
+        """
+        raise NotImplementedError()
+
+    def set(self, state_id, value):
+        """
+        Stores the state and (re)starts its lifetime.
+
+        :type state_id: str
+        :type value: str
+
+        :param state_id: The id of the state
+        :param value: The serialized state
+        """
+        raise NotImplementedError()
+
+    def delete(self, state_id):
+        """
+        :type state_id: str
+        :param state_id: The id of the state
+        """
+        raise NotImplementedError()
+
+    def keys(self):
+        """
+        :rtype: list[str]
+        :return: The ids of the stored entries which are not expired
+        """
+        raise NotImplementedError()
+
+    def __len__(self):
+        """
+        :rtype: int
+        :return: The number of stored entries, expired entries may be included until evicted
+        """
+        raise NotImplementedError()
+
+    def evict_expired(self):
+        """
+        Removes all expired entries.
+
+        :rtype: int
+        :return: The number of removed entries
+        """
+        evicted = self._evict_expired()
+        self.stats["expired"] += evicted
+        return evicted
+
+    def _evict_expired(self):
+        raise NotImplementedError()
+
+    def _start_eviction_thread(self):
+        if not self.eviction_interval or self._eviction_pid == os.getpid():
+            return
+        with self._eviction_lock:
+            if self._eviction_pid == os.getpid():
+                return
+            threading.Thread(target=self._run_eviction, name="satosa-state-eviction", daemon=True).start()
+            self._eviction_pid = os.getpid()
+
+    def _run_eviction(self):
+        while True:
+            time.sleep(self.eviction_interval)
+            try:
+                evicted = self.evict_expired()
+            except Exception:
+                logger.exception("Eviction of expired states failed")
+            else:
+                logger.debug("Evicted {} expired states".format(evicted))
+
+
+class MemoryStateStore(StateStore):
+    """
+    In-process LRU store.
+
+    The state is only visible to the worker process that stored it, so this store is only suitable
+    for single process deployments (or sticky sessions).
+    """
+
+    def __init__(self, ttl, max_entries=10000, eviction_interval=60):
+        """
+        :type max_entries: int
+        :param max_entries: The maximum number of states to keep, the least recently used entry
+        is dropped when it is exceeded
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        super().__init__(ttl, eviction_interval)
+
+    def get(self, state_id):
+        self._start_eviction_thread()
+        with self._lock:
+            try:
+                expires_at, value = self._entries[state_id]
+            except KeyError:
+                return None
+            if expires_at <= time.monotonic():
+                del self._entries[state_id]
+                self.stats["expired"] += 1
+                return None
+            self._entries.move_to_end(state_id)
+            return value
+
+    def set(self, state_id, value):
+        self._start_eviction_thread()
+        with self._lock:
+            self._entries[state_id] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(state_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["dropped"] += 1
+
+    def delete(self, state_id):
+        with self._lock:
+            self._entries.pop(state_id, None)
+
+    def keys(self):
+        now = time.monotonic()
+        with self._lock:
+            return [key for key, (expires_at, _) in self._entries.items() if expires_at > now]
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (expires_at, _) in self._entries.items() if expires_at <= now]
+            for key in expired:
+                del self._entries[key]
+        return len(expired)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteStateStore(StateStore):
+    """
+    Store backed by a SQLite database in WAL mode, shared by all worker processes on one host.
+
+    Each thread of each process opens its own connection on first use, connections are never
+    shared with a forked process.
+    """
+
+    def __init__(self, ttl, path, eviction_interval=60):
+        """
+        :type path: str
+        :param path: Path of the database file
+        """
+        self.path = path
+        self._local = threading.local()
+        super().__init__(ttl, eviction_interval)
+
+    def _connection(self):
+        # the thread local data of the forking thread is inherited by the child process
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS state"
+                    " (id TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+                connection.execute("CREATE INDEX IF NOT EXISTS state_expires_at ON state (expires_at)")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+            self._start_eviction_thread()
+        return self._local.connection
+
+    def get(self, state_id):
+        row = self._connection().execute(
+            "SELECT value FROM state WHERE id = ? AND expires_at > ?", (state_id, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, state_id, value):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO state (id, value, expires_at) VALUES (?, ?, ?)",
+                (state_id, value, time.time() + self.ttl))
+
+    def delete(self, state_id):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM state WHERE id = ?", (state_id,))
+
+    def keys(self):
+        rows = self._connection().execute("SELECT id FROM state WHERE expires_at > ?", (time.time(),))
+        return [row[0] for row in rows]
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM state").fetchone()[0]
+
+    def _evict_expired(self):
+        with self._connection() as connection:
+            cursor = connection.execute("DELETE FROM state WHERE expires_at <= ?", (time.time(),))
+        return cursor.rowcount
+
+
+class FileStateStore(StateStore):
+    """
+    Store keeping one file per state in a directory, e.g. on a tmpfs or a shared file system.
+
+    The modification time of a file is the time it was last written. The id of a state is its
+    file name, so it may only contain the characters [A-Za-z0-9_-]: an id may come from a
+    request, e.g. the InResponseTo of a SAML response, and must not name a file outside the
+    directory. Other ids are never found and can't be stored.
+    """
+
+    STATE_ID = re.compile(r"[A-Za-z0-9_-]+")
+
+    def __init__(self, ttl, directory, eviction_interval=60):
+        """
+        :type directory: str
+        :param directory: Directory in which the state files are created
+        """
+        self.directory = directory
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        super().__init__(ttl, eviction_interval)
+
+    def _path(self, state_id):
+        """
+        :type state_id: str
+        :rtype: str | None
+        :return: The path of the state file, or None if the id is not a valid file name
+        """
+        if not isinstance(state_id, str) or not self.STATE_ID.fullmatch(state_id):
+            return None
+        return os.path.join(self.directory, state_id)
+
+    def get(self, state_id):
+        self._start_eviction_thread()
+        path = self._path(state_id)
+        if path is None:
+            return None
+        try:
+            if os.stat(path).st_mtime + self.ttl <= time.time():
+                return None
+            with open(path, encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, state_id, value):
+        self._start_eviction_thread()
+        path = self._path(state_id)
+        if path is None:
+            raise ValueError("Invalid state id {!r}".format(state_id))
+        tmp_path = "{path}.{pid}.{tid}.tmp".format(
+            path=path, pid=os.getpid(), tid=threading.get_ident())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+
+    def delete(self, state_id):
+        path = self._path(state_id)
+        if path is None:
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def keys(self):
+        deadline = time.time() - self.ttl
+        keys = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if not entry.name.endswith(".tmp") and entry.stat().st_mtime > deadline:
+                        keys.append(entry.name)
+                except FileNotFoundError:
+                    pass
+        return keys
+
+    def __len__(self):
+        with os.scandir(self.directory) as entries:
+            return sum(1 for entry in entries if not entry.name.endswith(".tmp"))
+
+    def _evict_expired(self):
+        deadline = time.time() - self.ttl
+        evicted = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime <= deadline:
+                        os.remove(entry.path)
+                        evicted += 1
+                except FileNotFoundError:
+                    pass
+        return evicted
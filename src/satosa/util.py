@@ -1,7 +1,9 @@
 """
 Python package file for util functions.
 """
+import functools
 import hashlib
+import hmac
 import logging
 import random
 import string
@@ -12,6 +14,77 @@ from satosa.logging_util import satosa_logging
 logger = logging.getLogger(__name__)
 
 
+class DataHasher(object):
+    """
+    Hashes values with a salt and a hash algorithm.
+
+    The hash state is prepared once and copied for every value. By default
+    the value is hashed followed by the salt. In HMAC mode the salt is used
+    as the key of an HMAC, which is keyed once.
+    """
+
+    def __init__(self, salt, hash_alg=None, use_hmac=False):
+        """
+        :type salt: str
+        :type hash_alg: str
+        :type use_hmac: bool
+
+        :param salt: hash salt, or the key in HMAC mode
+        :param hash_alg: the hash algorithm to use (default: SHA512)
+        :param use_hmac: compute an HMAC keyed with the salt
+        """
+        hash_alg = hash_alg or 'sha512'
+        salt = salt.encode('utf-8')
+        if use_hmac:
+            self._prototype = hmac.new(salt, digestmod=hash_alg)
+            self._salt = b''
+        else:
+            self._prototype = hashlib.new(hash_alg)
+            self._salt = salt
+
+    def hash(self, value):
+        """
+        :type value: str
+        :rtype: str
+
+        :param value: value to hash
+        :return: hashed value
+        """
+        hasher = self._prototype.copy()
+        hasher.update(value.encode('utf-8') + self._salt)
+        return hasher.hexdigest()
+
+    def hash_values(self, values):
+        """
+        :type values: list[str]
+        :rtype: list[str]
+
+        :param values: values to hash, e.g. all values of an attribute
+        :return: hashed values
+        """
+        prototype = self._prototype
+        salt = self._salt
+        hashed_values = []
+        for value in values:
+            hasher = prototype.copy()
+            hasher.update(value.encode('utf-8') + salt)
+            hashed_values.append(hasher.hexdigest())
+        return hashed_values
+
+
+@functools.lru_cache(maxsize=128)
+def get_data_hasher(salt, hash_alg=None, use_hmac=False):
+    """
+    Returns a shared hasher for a salt and hash algorithm.
+
+    :type salt: str
+    :type hash_alg: str
+    :type use_hmac: bool
+    :rtype: satosa.util.DataHasher
+    """
+    return DataHasher(salt, hash_alg, use_hmac)
+
+
 def hash_data(salt, value, hash_alg=None):
     """
     Hashes a value together with a salt with the given hash algorithm.
@@ -24,12 +97,22 @@ def hash_data(salt, value, hash_alg=None):
     :param value: value to hash together with the salt
     :return: hashed value
     """
-    hash_alg = hash_alg or 'sha512'
-    hasher = hashlib.new(hash_alg)
-    hasher.update(value.encode('utf-8'))
-    hasher.update(salt.encode('utf-8'))
-    value_hashed = hasher.hexdigest()
-    return value_hashed
+    return get_data_hasher(salt, hash_alg).hash(value)
+
+
+def hash_values(salt, values, hash_alg=None):
+    """
+    Hashes values together with a salt with the given hash algorithm.
+
+    :type salt: str
+    :type hash_alg: str
+    :type values: list[str]
+    :param salt: hash salt
+    :param hash_alg: the hash algorithm to use (default: SHA512)
+    :param values: values to hash together with the salt
+    :return: hashed values
+    """
+    return get_data_hasher(salt, hash_alg).hash_values(values)
 
 
 def check_set_dict_defaults(dic, spec):
@@ -0,0 +1,6 @@
+"""
+Micro benchmarks for the hot paths of the proxy.
+
+The benchmarks are plain scripts and are not collected by pytest, run them with e.g.
+`python -m tests.benchmarks.bench_state`.
+"""
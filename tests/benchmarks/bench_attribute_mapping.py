@@ -0,0 +1,73 @@
+"""
+Cost of AttributeMapper.to_internal and from_internal with a large attribute map, compared to
+looping over all configured attributes on every conversion.
+"""
+import timeit
+
+from satosa.attribute_mapping import AttributeMapper
+
+NUMBER = 5000
+NUM_ATTRIBUTES = 300
+
+
+def build_internal_attributes():
+    """
+    An eduPerson/SCHAC sized map: NUM_ATTRIBUTES attributes with a saml and an openid profile, a
+    few of them nested in openid.
+    """
+    attributes = {
+        "attr{}".format(i): {
+            "saml": ["urn:oid:1.3.6.1.4.1.{}".format(i), "attr{}".format(i)],
+            "openid": ["claim{}".format(i)],
+        }
+        for i in range(NUM_ATTRIBUTES)
+    }
+    for field in ["street_address", "locality", "region", "postal_code", "country"]:
+        attributes[field] = {"saml": [field], "openid": ["address.{}".format(field)]}
+    return {"attributes": attributes}
+
+
+def to_internal_all_attributes(internal_attributes, attribute_profile, external_dict):
+    # how AttributeMapper used to convert to the internal format
+    internal_dict = {}
+    for internal_attribute_name, mapping in internal_attributes["attributes"].items():
+        if attribute_profile not in mapping:
+            continue
+        values = []
+        for attr_name in mapping[attribute_profile]:
+            attr_val = external_dict
+            for key in attr_name.split("."):
+                attr_val = attr_val.get(key)
+                if attr_val is None:
+                    break
+            if isinstance(attr_val, list):
+                values.extend(attr_val)
+            elif attr_val:
+                values.append(attr_val)
+        if values:
+            internal_dict[internal_attribute_name] = values
+    return internal_dict
+
+
+def main():
+    internal_attributes = build_internal_attributes()
+    converter = AttributeMapper(internal_attributes)
+    # a typical response with a dozen attributes
+    saml_response = {"urn:oid:1.3.6.1.4.1.{}".format(i): ["value{}".format(i)] for i in range(0, 120, 10)}
+    internal = converter.to_internal("saml", saml_response)
+    internal.update({"locality": ["Hollywood"], "country": ["USA"]})
+
+    old = timeit.timeit(lambda: to_internal_all_attributes(internal_attributes, "saml", saml_response),
+                        number=NUMBER)
+    new = timeit.timeit(lambda: converter.to_internal("saml", saml_response), number=NUMBER)
+    from_internal = timeit.timeit(lambda: converter.from_internal("openid", internal), number=NUMBER)
+    print("{} configured attributes, {} in the response".format(len(internal_attributes["attributes"]),
+                                                                 len(saml_response)))
+    print("{:>26} {:>10}".format("", "us/call"))
+    print("{:>26} {:>10.1f}".format("to_internal all attributes", old / NUMBER * 1e6))
+    print("{:>26} {:>10.1f}".format("to_internal plan", new / NUMBER * 1e6))
+    print("{:>26} {:>10.1f}".format("from_internal plan", from_internal / NUMBER * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Per response overhead of AttributeProcessor with many configured processors, compared to loading
+and instantiating the processors on every response.
+"""
+import importlib
+import timeit
+
+from satosa.context import Context
+from satosa.internal import AuthenticationInformation
+from satosa.internal import InternalData
+from satosa.micro_services.attribute_processor import AttributeProcessor
+
+NUMBER = 5000
+NUM_ATTRIBUTES = 8
+PROCESSORS_MODULE = "satosa.micro_services.processors"
+
+
+def build_processes():
+    """
+    Three processors for each attribute, 24 in total.
+    """
+    return [
+        {"attribute": "attr{}".format(i), "processors": [
+            {"name": "ScopeRemoverProcessor", "module": PROCESSORS_MODULE + ".scope_remover_processor"},
+            {"name": "ScopeProcessor", "module": PROCESSORS_MODULE + ".scope_processor", "scope": "example.org"},
+            {"name": "HashProcessor", "module": PROCESSORS_MODULE + ".hash_processor", "hash_algo": "sha256"},
+        ]}
+        for i in range(NUM_ATTRIBUTES)
+    ]
+
+
+def process_per_response(processes, data):
+    # how AttributeProcessor used to run the processors
+    for process in processes:
+        attribute = process["attribute"]
+        for processor in process["processors"]:
+            module = importlib.import_module(processor["module"])
+            instance = getattr(module, processor["name"])()
+            kwargs = processor.copy()
+            kwargs.pop("module")
+            kwargs.pop("name")
+            instance.process(data, attribute, **kwargs)
+
+
+def new_data():
+    data = InternalData(auth_info=AuthenticationInformation())
+    data.attributes = {"attr{}".format(i): ["user@example.com"] for i in range(NUM_ATTRIBUTES)}
+    return data
+
+
+def main():
+    processes = build_processes()
+    service = AttributeProcessor(config={"process": processes}, name="bench", base_url="https://example.com")
+    service.next = lambda ctx, data: data
+    context = Context()
+    context.state = {}
+
+    per_response = timeit.timeit(lambda: process_per_response(processes, new_data()), number=NUMBER)
+    pipeline = timeit.timeit(lambda: service.process(context, new_data()), number=NUMBER)
+    print("{} processors".format(len(service.pipeline)))
+    print("{:>14} {:>12}".format("", "us/response"))
+    print("{:>14} {:>12.1f}".format("per response", per_response / NUMBER * 1e6))
+    print("{:>14} {:>12.1f}".format("pipeline", pipeline / NUMBER * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Cost of AttributeAuthorization and FilterAttributeValues per response as the number of configured
+rules grows, compared to compiling the regexes on every response.
+"""
+import re
+import timeit
+
+from satosa.context import Context
+from satosa.internal import AuthenticationInformation
+from satosa.internal import InternalData
+from satosa.micro_services.attribute_authorization import AttributeAuthorization
+from satosa.micro_services.attribute_modifications import FilterAttributeValues
+from satosa.util import get_dict_defaults
+
+NUMBER = 2000
+PATTERNS_PER_RULE = 20
+
+
+def build_allow_rules(num_rules):
+    """
+    num_rules requesters, each allowing PATTERNS_PER_RULE affiliations.
+    """
+    return {
+        "https://sp{}.example.com".format(i): {
+            "": {"affiliation": ["^(member|staff){}-{}@example.com$".format(i, j)
+                                 for j in range(PATTERNS_PER_RULE)]}
+        }
+        for i in range(num_rules)
+    }
+
+
+def build_filters(num_rules):
+    return {
+        "": {"https://sp{}.example.com".format(i): {"mail": "@example{}\\.com$".format(i)}
+             for i in range(num_rules)}
+    }
+
+
+def check_authz_per_response(attribute_allow, attributes, requester, provider):
+    # how AttributeAuthorization used to check the rules
+    for attribute_name, attribute_filters in get_dict_defaults(attribute_allow, requester, provider).items():
+        if attribute_name in attributes:
+            if not any([any(filter(re.compile(af).search, attributes[attribute_name]))
+                        for af in attribute_filters]):
+                raise ValueError("Permission denied")
+
+
+def new_data(requester_index):
+    data = InternalData(auth_info=AuthenticationInformation(issuer="https://idp.example.com"))
+    data.requester = "https://sp{}.example.com".format(requester_index)
+    data.attributes = {
+        "affiliation": ["staff{}-{}@example.com".format(requester_index, PATTERNS_PER_RULE - 1)],
+        "mail": ["user@example{}.com".format(requester_index), "user@other.org"],
+    }
+    return data
+
+
+def main():
+    context = Context()
+    context.state = {}
+    print("{:>8} {:>18} {:>18} {:>18}".format("rules", "authz old us/resp", "authz new us/resp",
+                                              "filter new us/resp"))
+    for num_rules in [10, 100, 1000, 5000]:
+        attribute_allow = build_allow_rules(num_rules)
+        authz = AttributeAuthorization(config={"attribute_allow": attribute_allow}, name="authz",
+                                       base_url="https://example.com")
+        authz.next = lambda ctx, data: data
+        attribute_filter = FilterAttributeValues(config={"attribute_filters": build_filters(num_rules)},
+                                                 name="filter", base_url="https://example.com")
+        attribute_filter.next = lambda ctx, data: data
+        # a working set of 500 requesters
+        requests = [new_data(i % min(num_rules, 500)) for i in range(NUMBER)]
+
+        old = timeit.timeit(lambda: [check_authz_per_response(attribute_allow, data.attributes, data.requester,
+                                                              data.auth_info.issuer) for data in requests],
+                            number=1)
+        new = timeit.timeit(lambda: [authz.process(context, data) for data in requests], number=1)
+        filtered = timeit.timeit(lambda: [attribute_filter.process(context, data) for data in requests], number=1)
+        print("{:>8} {:>18.1f} {:>18.1f} {:>18.1f}".format(
+            num_rules, old / NUMBER * 1e6, new / NUMBER * 1e6, filtered / NUMBER * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Memory per worker process and lookup latency of the metadata index, compared to the stock
+pysaml2 metadata store, for a generated aggregate of NUM_ENTITIES IdPs.
+
+Each store is loaded in its own process, as a worker would. The memory of a worker is its
+private memory: the pages of the index file are shared by all the workers. The private memory
+is read from /proc/self/smaps_rollup, so the memory column is only available on Linux.
+
+An IdP that is not in the cache of decoded entities is decoded from the index on lookup, which
+is slower than the stock store; the IdPs most requests go to stay decoded.
+"""
+import base64
+import multiprocessing
+import os
+import random
+import tempfile
+import timeit
+
+from saml2.config import SPConfig
+
+from satosa.metadata_index import add_metadata_index
+from satosa.metadata_index import build_metadata_index
+
+NUM_ENTITIES = 5000
+NUMBER = 20000
+# the number of IdPs most requests go to, kept decoded by the index
+HOT_ENTITIES = 500
+
+ENTITY = """<md:EntityDescriptor entityID="https://idp{i}.example.org/idp/shibboleth">
+<md:Extensions><mdattr:EntityAttributes><saml:Attribute Name="http://macedir.org/entity-category-support"
+ NameFormat="urn:oasis:names:tc:SAML:2.0:attrname-format:uri">
+<saml:AttributeValue>http://refeds.org/category/research-and-scholarship</saml:AttributeValue>
+</saml:Attribute></mdattr:EntityAttributes></md:Extensions>
+<md:IDPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+<md:Extensions><mdui:UIInfo><mdui:DisplayName xml:lang="en">IdP {i}</mdui:DisplayName>
+<mdui:Description xml:lang="en">Identity provider {i} of the example federation</mdui:Description>
+<mdui:Logo height="60" width="120">https://idp{i}.example.org/logo.png</mdui:Logo></mdui:UIInfo></md:Extensions>
+<md:KeyDescriptor use="signing"><ds:KeyInfo><ds:X509Data><ds:X509Certificate>{cert}</ds:X509Certificate>
+</ds:X509Data></ds:KeyInfo></md:KeyDescriptor>
+<md:KeyDescriptor use="encryption"><ds:KeyInfo><ds:X509Data><ds:X509Certificate>{cert}</ds:X509Certificate>
+</ds:X509Data></ds:KeyInfo></md:KeyDescriptor>
+<md:SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+ Location="https://idp{i}.example.org/idp/profile/SAML2/Redirect/SSO"/>
+<md:SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
+ Location="https://idp{i}.example.org/idp/profile/SAML2/POST/SSO"/>
+</md:IDPSSODescriptor>
+<md:Organization><md:OrganizationName xml:lang="en">Organization {i}</md:OrganizationName>
+<md:OrganizationDisplayName xml:lang="en">Organization {i}</md:OrganizationDisplayName>
+<md:OrganizationURL xml:lang="en">https://www{i}.example.org/</md:OrganizationURL></md:Organization>
+</md:EntityDescriptor>"""
+
+AGGREGATE = """<md:EntitiesDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"
+ xmlns:ds="http://www.w3.org/2000/09/xmldsig#" xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion"
+ xmlns:mdattr="urn:oasis:names:tc:SAML:metadata:attribute" xmlns:mdui="urn:oasis:names:tc:SAML:metadata:ui">
+{}
+</md:EntitiesDescriptor>"""
+
+SP_CONFIG = {
+    "entityid": "https://sp.example.com",
+    "service": {"sp": {"endpoints": {"assertion_consumer_service": [
+        ("https://sp.example.com/acs", "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST")]}}},
+}
+
+
+def write_aggregate(path):
+    entities = []
+    for i in range(NUM_ENTITIES):
+        cert = base64.b64encode(os.urandom(900)).decode("ascii")
+        entities.append(ENTITY.format(i=i, cert=cert))
+    with open(path, "w") as f:
+        f.write(AGGREGATE.format("\n".join(entities)))
+
+
+def private_memory_kb():
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    return sum(int(line.split()[1]) for line in lines if line.startswith(("Private_Clean", "Private_Dirty")))
+
+
+def load_store(metadata_conf):
+    return SPConfig().load(dict(SP_CONFIG, metadata=metadata_conf)).metadata
+
+
+def worker(kind, aggregate_path, index_path, results):
+    before = private_memory_kb()
+    if kind == "stock":
+        store = load_store({"local": [aggregate_path]})
+    else:
+        store = load_store({})
+        add_metadata_index(store, index_path)
+    after = private_memory_kb()
+
+    latencies = []
+    for num_entities in [NUM_ENTITIES, HOT_ENTITIES]:
+        lookups = iter(["https://idp{}.example.org/idp/shibboleth".format(random.randrange(num_entities))
+                        for _ in range(NUMBER)])
+        duration = timeit.timeit(lambda: store.single_sign_on_service(next(lookups)), number=NUMBER)
+        latencies.append(duration / NUMBER * 1e6)
+    memory = after - before if before is not None else None
+    results.put((kind, memory, latencies))
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        aggregate_path = os.path.join(tmp, "aggregate.xml")
+        index_path = os.path.join(tmp, "metadata.index")
+        write_aggregate(aggregate_path)
+        # the loader process
+        build_metadata_index(load_store({"local": [aggregate_path]}), index_path)
+
+        print("{} entities, aggregate {:.1f} MB, index {:.1f} MB".format(
+            NUM_ENTITIES, os.path.getsize(aggregate_path) / 1e6, os.path.getsize(index_path) / 1e6))
+        print("{:>8} {:>20} {:>16} {:>16}".format("store", "private MB/worker", "any IdP us", "hot IdP us"))
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        for kind in ["stock", "index"]:
+            process = context.Process(target=worker, args=(kind, aggregate_path, index_path, results))
+            process.start()
+            kind, memory, latencies = results.get()
+            process.join()
+            memory = "{:.1f}".format(memory / 1024) if memory is not None else "n/a"
+            print("{:>8} {:>20} {:>16.2f} {:>16.2f}".format(kind, memory, *latencies))
+
+
+if __name__ == "__main__":
+    main()
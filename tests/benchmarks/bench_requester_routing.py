@@ -0,0 +1,72 @@
+"""
+Cost of DecideBackendByRequester per request with 10k+ exact and prefix rules and NUM_REGEXES
+regex rules, compared to checking the prefix and regex rules one by one.
+
+The regex engine still tries the combined regexes one after the other, so the regex rules are
+meant for a few patterns; the memo makes repeated requesters cheap whatever the rule.
+"""
+import re
+import timeit
+
+from satosa.context import Context
+from satosa.internal import InternalData
+from satosa.micro_services.custom_routing import DecideBackendByRequester
+
+NUMBER = 20000
+NUM_REGEXES = 100
+
+
+def build_config(num_rules):
+    return {
+        "requester_mapping": {"https://sp{}.example.com/shibboleth".format(i): "exact{}".format(i % 10)
+                              for i in range(num_rules)},
+        "requester_prefix_mapping": {"https://federation{}.example.org/".format(i): "prefix{}".format(i % 10)
+                                     for i in range(num_rules)},
+        "requester_regex_mapping": {r"https://[a-z]+\.tenant{}\.example\.net/".format(i): "regex{}".format(i % 10)
+                                    for i in range(NUM_REGEXES)},
+        "default_backend": "default",
+    }
+
+
+def linear_route(config, compiled_regexes, requester):
+    # checking every prefix and regex rule
+    backend = config["requester_mapping"].get(requester)
+    if backend is not None:
+        return backend
+    prefixes = [prefix for prefix in config["requester_prefix_mapping"] if requester.startswith(prefix)]
+    if prefixes:
+        return config["requester_prefix_mapping"][max(prefixes, key=len)]
+    for regex, backend in compiled_regexes:
+        if regex.match(requester):
+            return backend
+    return config["default_backend"]
+
+
+def main():
+    print("{:>8} {:>8} {:>16} {:>16} {:>16}".format("rules", "kind", "linear us/req", "index us/req",
+                                                    "memo us/req"))
+    for num_rules in [1000, 10000, 20000]:
+        config = build_config(num_rules)
+        compiled_regexes = [(re.compile(regex), backend)
+                            for regex, backend in config["requester_regex_mapping"].items()]
+        router = DecideBackendByRequester(config=config, name="router", base_url="https://example.com")
+        router.next = lambda ctx, data: data
+        context = Context()
+        last = num_rules - 1
+        requesters = {
+            "exact": "https://sp{}.example.com/shibboleth".format(last),
+            "prefix": "https://federation{}.example.org/sp/metadata".format(last),
+            "regex": "https://sp.tenant{}.example.net/".format(NUM_REGEXES - 1),
+            "default": "https://unknown.example.com/",
+        }
+        for kind, requester in requesters.items():
+            data = InternalData(requester=requester)
+            linear = timeit.timeit(lambda: linear_route(config, compiled_regexes, requester), number=NUMBER // 20)
+            index = timeit.timeit(lambda: router._find_backend(requester), number=NUMBER)
+            memo = timeit.timeit(lambda: router.process(context, data), number=NUMBER)
+            print("{:>8} {:>8} {:>16.2f} {:>16.2f} {:>16.2f}".format(
+                num_rules, kind, linear / (NUMBER // 20) * 1e6, index / NUMBER * 1e6, memo / NUMBER * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Cost of DecideIfRequesterIsAllowed per request as the allow and deny lists of a target grow,
+compared to checking the requester against the YAML lists.
+"""
+import timeit
+from base64 import urlsafe_b64encode
+
+from satosa.context import Context
+from satosa.internal import InternalData
+from satosa.micro_services.custom_routing import DecideIfRequesterIsAllowed
+
+NUMBER = 2000
+TARGET_ENTITY = "https://idp.example.com"
+
+
+def build_rules(num_rules):
+    return {
+        TARGET_ENTITY: {
+            "allow": ["https://sp{}.example.com/shibboleth".format(i) for i in range(num_rules)],
+            "allow_patterns": ["https://federation{}.example.org/*".format(i) for i in range(num_rules)],
+            "deny": ["https://blocked{}.example.com/shibboleth".format(i) for i in range(num_rules)],
+        }
+    }
+
+
+def check_lists(rules, requester):
+    # how DecideIfRequesterIsAllowed used to check the rules
+    target_specific_rules = rules[TARGET_ENTITY]
+    if requester in target_specific_rules["deny"]:
+        return False
+    allow_rules = target_specific_rules["allow"]
+    return requester in allow_rules or "*" in allow_rules
+
+
+def main():
+    context = Context()
+    context.decorate(Context.KEY_TARGET_ENTITYID, urlsafe_b64encode(TARGET_ENTITY.encode("utf-8")).decode("utf-8"))
+    print("{:>8} {:>16} {:>16} {:>16} {:>16}".format("rules", "lists us/req", "sets us/req",
+                                                    "prefix us/req", "memo us/req"))
+    for num_rules in [100, 1000, 10000]:
+        rules = build_rules(num_rules)
+        decide_service = DecideIfRequesterIsAllowed(config={"rules": rules}, name="decide",
+                                                    base_url="https://example.com")
+        decide_service.next = lambda ctx, data: data
+        target_rules = decide_service.compiled_rules[decide_service._b64_url(TARGET_ENTITY)]
+        exact = "https://sp{}.example.com/shibboleth".format(num_rules - 1)
+        prefixed = "https://federation{}.example.org/sp".format(num_rules - 1)
+        data = InternalData(requester=exact)
+
+        lists = timeit.timeit(lambda: check_lists(rules, exact), number=NUMBER)
+        sets = timeit.timeit(lambda: exact in target_rules["allow"], number=NUMBER)
+        prefix = timeit.timeit(lambda: prefixed in target_rules["allow"], number=NUMBER)
+        memo = timeit.timeit(lambda: decide_service.process(context, data), number=NUMBER)
+        print("{:>8} {:>16.2f} {:>16.2f} {:>16.2f} {:>16.2f}".format(
+            num_rules, lists / NUMBER * 1e6, sets / NUMBER * 1e6, prefix / NUMBER * 1e6, memo / NUMBER * 1e6))
+
+
+if __name__ == "__main__":
+    main()
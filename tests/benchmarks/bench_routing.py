@@ -0,0 +1,83 @@
+"""
+Routing throughput of ModuleRouter.endpoint_routing as the number of registered routes grows.
+"""
+import random
+import re
+import timeit
+
+from satosa.context import Context
+from satosa.routing import ModuleRouter
+
+NUMBER = 20000
+BACKEND_NAMES = ["Saml2", "OIDC", "github", "orcid"]
+
+
+class BenchModule(object):
+    def __init__(self, name, endpoints):
+        self.name = name
+        self.endpoints = endpoints
+
+    def register_endpoints(self, *args):
+        return [(regex, self.name) for regex in self.endpoints]
+
+
+def build_modules(num_routes):
+    """
+    Builds a SAML frontend, a mirror frontend and a virtual CO frontend with num_routes COs.
+    """
+    providers = "|".join("^{}".format(name) for name in BACKEND_NAMES)
+    frontends = [
+        BenchModule("Saml2IDP", ["({})/sso/redirect$".format(providers), "({})/sso/post$".format(providers),
+                                 "^Saml2IDP/proxy.xml"]),
+        BenchModule("Saml2Mirror", ["({})/\\S+/sso/redirect".format(providers),
+                                    "({})/\\S+/sso/post".format(providers)]),
+        BenchModule("VirtualCo", ["(^{})/(co{})/sso/redirect".format(name, i)
+                                  for i in range(num_routes) for name in BACKEND_NAMES[:1]]),
+    ]
+    backends = [BenchModule(name, ["^{}/acs/post$".format(name), "^{}/disco$".format(name)])
+                for name in BACKEND_NAMES]
+    return frontends, backends
+
+
+def linear_routing(router, path):
+    for modules in [router.frontends, router.micro_services]:
+        for module in modules.values():
+            for regex, spec in module["endpoints"]:
+                if re.search(regex, path):
+                    return spec
+    backend = path.split("/")[0]
+    if backend in router.backends:
+        for regex, spec in router.backends[backend]["endpoints"]:
+            if re.search(regex, path):
+                return spec
+    return None
+
+
+def main():
+    print("{:>8} {:>16} {:>16} {:>16}".format("routes", "linear req/s", "compiled req/s", "memo req/s"))
+    for num_routes in [10, 100, 500, 1000]:
+        frontends, backends = build_modules(num_routes)
+        memo_router = ModuleRouter(frontends, backends, [])
+        router = ModuleRouter(frontends, backends, [], cache_size=0)
+        paths = ["Saml2/acs/post", "OIDC/disco", "Saml2/sso/redirect",
+                 "Saml2/co{}/sso/redirect".format(num_routes - 1)]
+        rng = random.Random(0)
+        requests = [rng.choice(paths) for _ in range(NUMBER)]
+
+        def run(route):
+            for path in requests:
+                context = Context()
+                context.path = path
+                route(context)
+
+        linear_number = max(1, NUMBER // num_routes)
+        linear = timeit.timeit(
+            lambda: [linear_routing(router, path) for path in requests[:linear_number]], number=1)
+        compiled = timeit.timeit(lambda: run(router.endpoint_routing), number=1)
+        memo = timeit.timeit(lambda: run(memo_router.endpoint_routing), number=1)
+        print("{:>8} {:>16.0f} {:>16.0f} {:>16.0f}".format(
+            num_routes, linear_number / linear, NUMBER / compiled, NUMBER / memo))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+Round trip benchmark of the state codecs over typical state sizes.
+"""
+import timeit
+
+from satosa.state import State
+
+from tests.satosa.test_state import get_dict, get_str
+
+ENCRYPTION_KEY = "Ireallyliketoencryptthisdictionary!"
+NUMBER = 2000
+
+
+def build_state(num_entries):
+    """
+    Builds a state resembling the one of a SAML-to-SAML flow with num_entries keys per module.
+
+    :type num_entries: int
+    :rtype: satosa.state.State
+    """
+    state = State()
+    state["SESSION_ID"] = "urn:uuid:" + get_str(36)
+    state["ROUTER"] = "Saml2IDP"
+    state["SATOSA_BASE"] = {"requester": "https://sp.example.com/" + get_str(20)}
+    state["Saml2IDP"] = get_dict(num_entries, get_str(10), get_str(40))
+    state["Saml2"] = get_dict(num_entries, get_str(10), get_str(20))
+    return state
+
+
+def main():
+    print("{:>8} {:>8} {:>8} {:>12}".format("entries", "codec", "size", "usec/trip"))
+    for num_entries in [1, 10, 50, 200]:
+        state = build_state(num_entries)
+        for codec in ["legacy", "v1"]:
+            urlstate = state.urlstate(ENCRYPTION_KEY, codec=codec)
+
+            def round_trip():
+                State(state.urlstate(ENCRYPTION_KEY, codec=codec), ENCRYPTION_KEY)
+
+            duration = timeit.timeit(round_trip, number=NUMBER)
+            print("{:>8} {:>8} {:>8} {:>12.1f}".format(
+                num_entries, codec, len(urlstate), duration / NUMBER * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Routing and CO config lookup cost of SAMLVirtualCoFrontend as the number of COs grows.
+"""
+import copy
+import os
+import tempfile
+import timeit
+
+from saml2 import BINDING_HTTP_POST, BINDING_HTTP_REDIRECT
+
+from satosa.context import Context
+from satosa.frontends.saml2 import SAMLVirtualCoFrontend
+from satosa.routing import ModuleRouter
+from tests.util import write_cert
+
+NUMBER = 20000
+BACKEND_NAME = "Saml2"
+BASE_URL = "https://proxy.example.com"
+ENDPOINTS = {"single_sign_on_service": {BINDING_HTTP_REDIRECT: "sso/redirect",
+                                        BINDING_HTTP_POST: "sso/post"}}
+
+
+class BenchBackend(object):
+    name = BACKEND_NAME
+
+    def register_endpoints(self):
+        return [("^{}/acs/post$".format(BACKEND_NAME), None)]
+
+
+def build_frontend(idp_conf, num_cos):
+    config = {
+        "idp_config": copy.deepcopy(idp_conf),
+        "endpoints": ENDPOINTS,
+        "collaborative_organizations": [{"encodeable_name": "co{}".format(i)} for i in range(num_cos)],
+    }
+    return SAMLVirtualCoFrontend(lambda ctx, req: None, {"attributes": {}}, config, BASE_URL, "VirtualCo")
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        cert_file, key_file = os.path.join(tmp, "cert.pem"), os.path.join(tmp, "key.pem")
+        write_cert(cert_file, key_file)
+        idp_conf = {
+            "entityid": "{}/VirtualCo/proxy.xml".format(BASE_URL),
+            "service": {"idp": {"endpoints": {"single_sign_on_service": []}}},
+            "cert_file": cert_file,
+            "key_file": key_file,
+            "metadata": {"inline": []},
+        }
+
+        print("{:>8} {:>8} {:>16} {:>16}".format("COs", "routes", "routing req/s", "co config/s"))
+        for num_cos in [10, 100, 1000, 5000]:
+            frontend = build_frontend(idp_conf, num_cos)
+            router = ModuleRouter([frontend], [BenchBackend()], [], cache_size=0)
+            path = "{}/co{}/sso/redirect".format(BACKEND_NAME, num_cos - 1)
+
+            def route():
+                for _ in range(NUMBER):
+                    context = Context()
+                    context.path = path
+                    router.endpoint_routing(context)
+
+            context = Context()
+            context.path = path
+            context.state = {}
+
+            def lookup():
+                for _ in range(NUMBER):
+                    frontend._get_co_config(context)
+
+            routing = timeit.timeit(route, number=1)
+            config_lookup = timeit.timeit(lookup, number=1)
+            print("{:>8} {:>8} {:>16.0f} {:>16.0f}".format(
+                num_cos, len(router.frontends["VirtualCo"]["endpoints"]),
+                NUMBER / routing, NUMBER / config_lookup))
+
+
+if __name__ == "__main__":
+    main()
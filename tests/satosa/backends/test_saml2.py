@@ -1,8 +1,10 @@
 """
 Tests for the SAML frontend module src/backends/saml2.py.
 """
+import json
 import os
 import re
+import threading
 from base64 import urlsafe_b64encode
 from collections import Counter
 from datetime import datetime
@@ -19,7 +21,10 @@ from saml2.s_utils import deflate_and_base64_encode
 
 from satosa.backends.saml2 import SAMLBackend
 from satosa.context import Context
+from satosa.exception import SATOSAAuthenticationError
 from satosa.internal import InternalData
+from satosa.metadata_index import build_metadata_index
+from satosa.metadata_refresh import metadata_store_lock
 from tests.users import USERS
 from tests.util import FakeIdP, create_metadata_from_config_dict, FakeSP
 
@@ -196,6 +201,166 @@ class TestSAMLBackend:
         assert_authn_response(internal_resp)
         assert self.samlbackend.name not in context.state
 
+    def test_outstanding_queries_are_shared_by_workers(self, context, idp_conf, sp_conf, tmpdir):
+        sp_conf["service"]["sp"]["allow_unsolicited"] = False
+        backend_config = {
+            "sp_config": sp_conf,
+            "outstanding_queries_store": {
+                "module": "satosa.state_store.SQLiteStateStore",
+                "config": {"path": str(tmpdir.join("outstanding.db")), "eviction_interval": 0},
+            },
+        }
+        request_worker = SAMLBackend(Mock(), INTERNAL_ATTRIBUTES, backend_config, "base_url", "samlbackend")
+        response_worker = SAMLBackend(Mock(), INTERNAL_ATTRIBUTES, backend_config, "base_url", "samlbackend")
+        fakeidp = FakeIdP(USERS, config=IdPConfig().load(idp_conf, metadata_construction=False))
+
+        resp = request_worker.authn_request(context, idp_conf["entityid"])
+        assert request_worker.outstanding_queries_stats["size"] == 1
+        req_params = dict(parse_qsl(urlparse(resp.message).query))
+        url, auth_resp = fakeidp.handle_auth_req(req_params["SAMLRequest"], req_params["RelayState"],
+                                                 BINDING_HTTP_REDIRECT, "testuser1",
+                                                 response_binding=BINDING_HTTP_REDIRECT)
+
+        response_context = Context()
+        response_context.request = auth_resp
+        response_context.state = context.state
+        response_worker.authn_response(response_context, BINDING_HTTP_REDIRECT)
+        context, internal_resp = response_worker.auth_callback_func.call_args[0]
+        assert_authn_response(internal_resp)
+        assert response_worker.outstanding_queries_stats == {"size": 0, "expired": 0, "dropped": 0}
+
+    def test_outstanding_queries_expire(self, context, idp_conf, sp_conf):
+        sp_conf["service"]["sp"]["allow_unsolicited"] = False
+        backend_config = {
+            "sp_config": sp_conf,
+            "outstanding_queries_store": {
+                "module": "satosa.state_store.MemoryStateStore",
+                "config": {"ttl": -1, "eviction_interval": 0},
+            },
+        }
+        samlbackend = SAMLBackend(Mock(), INTERNAL_ATTRIBUTES, backend_config, "base_url", "samlbackend")
+        samlbackend.authn_request(context, idp_conf["entityid"])
+        samlbackend.authn_request(context, idp_conf["entityid"])
+        assert samlbackend.outstanding_queries_stats["size"] == 2
+        samlbackend.outstanding_queries.store.evict_expired()
+        assert samlbackend.outstanding_queries_stats == {"size": 0, "expired": 2, "dropped": 0}
+
+    def test_blacklisted_idp_is_refused_and_blacklist_is_reloaded(self, context, idp_conf, sp_conf, tmpdir):
+        blacklist_file = tmpdir.join("blacklist.json")
+        blacklist_file.write(json.dumps({"blacklist": [idp_conf["entityid"]]}))
+        backend_config = {"sp_config": sp_conf, "idp_blacklist_file": str(blacklist_file),
+                          "idp_blacklist_check_interval": 0}
+        samlbackend = SAMLBackend(Mock(), INTERNAL_ATTRIBUTES, backend_config, "base_url", "samlbackend")
+
+        with pytest.raises(SATOSAAuthenticationError):
+            samlbackend.authn_request(context, idp_conf["entityid"])
+
+        # a broken file keeps the previous blacklist
+        blacklist_file.write("{")
+        with pytest.raises(SATOSAAuthenticationError):
+            samlbackend.authn_request(context, idp_conf["entityid"])
+
+        blacklist_file.write(json.dumps({"blacklist": ["https://other-idp.example.com"]}))
+        resp = samlbackend.authn_request(context, idp_conf["entityid"])
+        assert_redirect_to_idp(resp, idp_conf)
+
+    def test_idp_index(self, idp_conf):
+        idp_index = self.samlbackend.idp_index
+        assert idp_index.entity_ids == {idp_conf["entityid"], "just_an_extra_idp"}
+        assert idp_index.only_entity_id is None
+        sso = idp_conf["service"]["idp"]["endpoints"]["single_sign_on_service"]
+        assert set(idp_index.sso_endpoints[idp_conf["entityid"]]) == {(binding, location) for location, binding in sso}
+
+    def test_disco_response_with_unknown_idp(self, context):
+        context.request = {"entityID": "https://unknown-idp.example.com"}
+        with pytest.raises(SATOSAAuthenticationError):
+            self.samlbackend.disco_response(context)
+
+    def test_reload_metadata_updates_idp_index(self, sp_conf, idp_conf):
+        sp_conf["metadata"]["inline"] = [create_metadata_from_config_dict(idp_conf)]
+        assert self.samlbackend.reload_metadata()
+        assert self.samlbackend.idp_index.only_entity_id == idp_conf["entityid"]
+
+    def test_reload_metadata_waits_for_the_store_lock(self, sp_conf, idp_conf):
+        sp_conf["metadata"]["inline"] = [create_metadata_from_config_dict(idp_conf)]
+        with metadata_store_lock(self.samlbackend.sp.metadata):
+            # e.g. a background refresh of the metadata
+            thread = threading.Thread(target=self.samlbackend.reload_metadata)
+            thread.start()
+            thread.join(0.2)
+            assert thread.is_alive()
+        thread.join()
+        assert self.samlbackend.idp_index.only_entity_id == idp_conf["entityid"]
+
+    def test_metadata_refresh_updates_idp_index(self, sp_conf, idp_conf, tmpdir):
+        metadata_file = tmpdir.join("idp_metadata.xml")
+        metadata_file.write(create_metadata_from_config_dict(idp_conf))
+        sp_conf["metadata"] = {"local": [str(metadata_file)]}
+        backend_config = {"sp_config": sp_conf, "metadata_refresh": {"interval": 3600}}
+        samlbackend = SAMLBackend(Mock(), INTERNAL_ATTRIBUTES, backend_config, "base_url", "samlbackend")
+        assert samlbackend.idp_index.only_entity_id == idp_conf["entityid"]
+
+        idp_conf["entityid"] = "https://new-idp.example.com"
+        metadata_file.write(create_metadata_from_config_dict(idp_conf))
+        metadata_file.setmtime(0)
+        refresher, = samlbackend.metadata_refreshers
+        assert refresher.refresh()
+        assert samlbackend.idp_index.only_entity_id == "https://new-idp.example.com"
+        assert samlbackend.metadata_refresh_stats[str(metadata_file)]["refreshes"] == 1
+        refresher.stop()
+
+    def test_metadata_refreshers_are_started_by_the_first_request_of_each_process(
+            self, sp_conf, idp_conf, context, tmpdir, monkeypatch):
+        metadata_file = tmpdir.join("idp_metadata.xml")
+        metadata_file.write(create_metadata_from_config_dict(idp_conf))
+        sp_conf["metadata"] = {"local": [str(metadata_file)]}
+        backend_config = {"sp_config": sp_conf, "metadata_refresh": {"interval": 3600}}
+        samlbackend = SAMLBackend(Mock(), INTERNAL_ATTRIBUTES, backend_config, "base_url", "samlbackend")
+        refresher, = samlbackend.metadata_refreshers
+        assert refresher._thread is None
+
+        context.request = {"SAMLResponse": ""}
+        with pytest.raises(SATOSAAuthenticationError):
+            samlbackend.authn_response(context, BINDING_HTTP_REDIRECT)
+        thread = refresher._thread
+        assert thread.is_alive()
+
+        # e.g. a worker forked by a server preloading the proxy
+        pid = os.getpid()
+        monkeypatch.setattr(os, "getpid", lambda: pid + 1)
+        with pytest.raises(SATOSAAuthenticationError):
+            samlbackend.authn_response(context, BINDING_HTTP_REDIRECT)
+        assert refresher._thread is not thread
+        assert refresher._thread.is_alive()
+        refresher.stop()
+        thread.join()
+
+    def test_metadata_index(self, sp_conf, idp_conf, tmpdir, monkeypatch):
+        sp_conf["metadata"]["inline"] = [create_metadata_from_config_dict(idp_conf)]
+        index_path = str(tmpdir.join("metadata.index"))
+        build_metadata_index(SPConfig().load(sp_conf).metadata, index_path)
+
+        sp_conf["metadata"] = {}
+        backend_config = {"sp_config": sp_conf, "metadata_index": {"path": index_path}}
+        samlbackend = SAMLBackend(Mock(), INTERNAL_ATTRIBUTES, backend_config, "base_url", "samlbackend")
+        assert samlbackend.idp_index.only_entity_id == idp_conf["entityid"]
+        # the entities are only decoded when they are used
+        index = samlbackend.sp.metadata.metadata[index_path].entity
+        assert index._entity.cache_info().misses == 0
+        sso = idp_conf["service"]["idp"]["endpoints"]["single_sign_on_service"]
+        assert set(samlbackend.idp_index.endpoints(idp_conf["entityid"])) == {
+            (binding, location) for location, binding in sso}
+        assert samlbackend.idp_index.endpoints("https://unknown.example.com") == ()
+        assert index._entity.cache_info().misses == 1
+        entity_descriptions = samlbackend.get_metadata_desc()
+        assert len(entity_descriptions) == 1
+        assert entity_descriptions[0].to_dict()["organization"]["name"] == [("Test IdP Org.", "en")]
+
+        monkeypatch.setattr("satosa.metadata_index.CLOSE_DELAY", 0)
+        assert samlbackend.reload_metadata()
+        assert index._mmap.closed
+        assert samlbackend.idp_index.only_entity_id == idp_conf["entityid"]
+
     @pytest.mark.skipif(
             saml2.__version__ < '4.6.1',
             reason="Optional NameID needs pysaml2 v4.6.1 or higher")
@@ -29,6 +29,7 @@ from satosa.internal import AuthenticationInformation
 from satosa.internal import InternalData
 from satosa.state import State
 from satosa.context import Context
+from satosa.routing import ModuleRouter, SATOSANoBoundEndpointError
 from tests.users import USERS
 from tests.util import FakeSP, create_metadata_from_config_dict
 
@@ -138,7 +139,7 @@ class TestSAMLFrontend:
         providers = ["foo", "bar"]
         url_map = samlfrontend.register_endpoints(providers)
         all_idp_endpoints = [get_path_from_url(v[0][0]) for v in idp_conf["service"]["idp"]["endpoints"].values()]
-        compiled_regex = [re.compile(regex) for regex, _ in url_map]
+        compiled_regex = [re.compile(regex) for regex, *_ in url_map]
         for endp in all_idp_endpoints:
             assert any(p.match(endp) for p in compiled_regex)
 
@@ -404,6 +405,40 @@ class TestSAMLMirrorFrontend:
         idp = self.frontend._load_idp_dynamic_entity_id(state)
         assert idp.config.entityid == "{}/{}".format(idp_conf["entityid"], self.TARGET_ENTITY_ID)
 
+    def test_dynamic_idp_is_cached_and_shares_metadata(self, context):
+        context.path = "{}/{}/sso/redirect".format(self.BACKEND, self.TARGET_ENTITY_ID)
+        context.target_backend = self.BACKEND
+        idp = self.frontend._load_idp_dynamic_endpoints(context)
+        assert self.frontend._load_idp_dynamic_endpoints(context) is idp
+        assert idp.metadata is self.frontend.idp.metadata
+        assert idp.sec is self.frontend.idp.sec
+
+        state = State()
+        state[self.frontend.name] = {"target_entity_id": self.TARGET_ENTITY_ID}
+        assert self.frontend._load_idp_dynamic_entity_id(state) is not idp
+
+        stats = self.frontend.idp_server_cache_stats
+        assert stats["hits"] == 1
+        assert stats["misses"] == 2
+        assert stats["size"] == 2
+
+    def test_reload_metadata_clears_idp_cache(self, context):
+        context.path = "{}/{}/sso/redirect".format(self.BACKEND, self.TARGET_ENTITY_ID)
+        context.target_backend = self.BACKEND
+        idp = self.frontend._load_idp_dynamic_endpoints(context)
+        self.frontend.reload_metadata()
+        assert self.frontend.idp_server_cache_stats["size"] == 0
+        assert self.frontend._load_idp_dynamic_endpoints(context) is not idp
+
+    def test_metadata_refresh_clears_idp_cache(self, context):
+        context.path = "{}/{}/sso/redirect".format(self.BACKEND, self.TARGET_ENTITY_ID)
+        context.target_backend = self.BACKEND
+        idp = self.frontend._load_idp_dynamic_endpoints(context)
+        # called by the background refreshers after they replaced the metadata
+        self.frontend._metadata_refreshed()
+        assert self.frontend.idp_server_cache_stats["size"] == 0
+        assert self.frontend._load_idp_dynamic_endpoints(context) is not idp
+
 
 class TestSAMLVirtualCoFrontend(TestSAMLFrontend):
     BACKEND = "test_backend"
@@ -518,17 +553,72 @@ class TestSAMLVirtualCoFrontend(TestSAMLFrontend):
         assert idp_server.config.entityid == expected_entityid
         assert all(sso in sso_endpoints for sso in expected_endpoints)
 
+    def test_co_virtual_idp_is_cached_and_shares_metadata(self, frontend, context, idp_conf):
+        idp_server = frontend._create_co_virtual_idp(context)
+        assert frontend._create_co_virtual_idp(context) is idp_server
+        assert idp_server.metadata is frontend.idp.metadata
+        assert idp_server.sec is frontend.idp.sec
+        assert context.get_decoration(frontend.KEY_CO_ENTITY_ID) == "{}/{}".format(
+            idp_conf['entityid'], self.CO)
+
+        stats = frontend.co_idp_stats
+        assert list(stats) == [(self.CO, self.BACKEND)]
+        assert stats[(self.CO, self.BACKEND)] > 0
+
+        frontend.reload_metadata()
+        assert frontend.co_idp_stats == {}
+        assert frontend._create_co_virtual_idp(context) is not idp_server
+
+    def test_metadata_refresh_clears_co_virtual_idps(self, frontend, context):
+        idp_server = frontend._create_co_virtual_idp(context)
+        # called by the background refreshers after they replaced the metadata
+        frontend._metadata_refreshed()
+        assert frontend.co_idp_stats == {}
+        assert frontend._create_co_virtual_idp(context) is not idp_server
+
+    def test_warm_up_co_idps(self, frontend, context):
+        frontend.config[frontend.KEY_WARM_UP_CO_IDPS] = True
+        frontend.register_endpoints([self.BACKEND, "other_backend"])
+        assert set(frontend.co_idp_stats) == {(self.CO, self.BACKEND), (self.CO, "other_backend")}
+
+        idp_server = frontend._get_co_idp(self.CO, self.BACKEND)
+        assert frontend._create_co_virtual_idp(context) is idp_server
+
     def test_register_endpoints(self, frontend, context):
         idp_server = frontend._create_co_virtual_idp(context)
         url_map = frontend.register_endpoints([self.BACKEND])
         all_idp_endpoints = [urlparse(endpoint[0]).path[1:] for
                              endpoint in
                              idp_server.config._idp_endpoints[self.KEY_SSO]]
-        compiled_regex = [re.compile(regex) for regex, _ in url_map]
+        compiled_regex = [re.compile(regex) for regex, *_ in url_map]
 
         for endpoint in all_idp_endpoints:
             assert any(pat.match(endpoint) for pat in compiled_regex)
 
+    def test_register_endpoints_only_route_configured_cos(self, frontend):
+        class Backend(object):
+            name = self.BACKEND
+
+            def register_endpoints(self):
+                return []
+
+        router = ModuleRouter([frontend], [Backend()], [])
+        context = Context()
+        context.path = "{}/{}/sso/redirect".format(self.BACKEND, self.CO)
+        router.endpoint_routing(context)
+        assert context.target_frontend == frontend.name
+
+        # paths of other COs are left to the other modules
+        context = Context()
+        context.path = "{}/unknown/sso/redirect".format(self.BACKEND)
+        with pytest.raises(SATOSANoBoundEndpointError):
+            router.endpoint_routing(context)
+
+    def test_get_co_config(self, frontend, context):
+        co_config = frontend._get_co_config(context)
+        assert co_config[frontend.KEY_ENCODEABLE_NAME] == self.CO
+        assert frontend._co_names_from_config() == [self.CO]
+
     def test_co_static_attributes(self, frontend, context, internal_response,
                                   idp_conf, sp_conf):
         # Use the frontend and context fixtures to dynamically create the
@@ -97,3 +97,38 @@ class TestAttributeAuthorization:
            authz_service.process(ctx, resp)
         except SATOSAAuthenticationError as ex:
            assert False
+
+    def test_authz_empty_allow_fail(self):
+        attribute_allow = {
+           "": { "default": {"a0": []} }
+        }
+        attribute_deny = {}
+        authz_service = self.create_authz_service(attribute_allow, attribute_deny)
+        resp = InternalData(auth_info=AuthenticationInformation())
+        resp.attributes = {
+            "a0": ["foo1"],
+        }
+        try:
+           ctx = Context()
+           ctx.state = dict()
+           authz_service.process(ctx, resp)
+           assert False
+        except SATOSAAuthenticationError as ex:
+           assert True
+
+    def test_authz_empty_deny_success(self):
+        attribute_deny = {
+           "": { "default": {"a0": []} }
+        }
+        attribute_allow = {}
+        authz_service = self.create_authz_service(attribute_allow, attribute_deny)
+        resp = InternalData(auth_info=AuthenticationInformation())
+        resp.attributes = {
+            "a0": ["foo1"],
+        }
+        try:
+           ctx = Context()
+           ctx.state = dict()
+           authz_service.process(ctx, resp)
+        except SATOSAAuthenticationError as ex:
+           assert False
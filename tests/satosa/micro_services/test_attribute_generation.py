@@ -1,6 +1,9 @@
+import pytest
+
 from satosa.internal import AuthenticationInformation
 from satosa.internal import InternalData
 from satosa.micro_services.attribute_generation import AddSyntheticAttributes
+from satosa.micro_services.attribute_generation import _referenced_attributes
 from satosa.exception import SATOSAAuthenticationError
 from satosa.context import Context
 
@@ -63,3 +66,48 @@ class TestAddSyntheticAttributes:
         assert("kaka1" in resp.attributes['kaka'])
         assert("a@example.com" in resp.attributes['eppn'])
         assert("b@example.com" in resp.attributes['eppn'])
+
+    def test_only_referenced_attributes_are_put_in_the_context(self, monkeypatch):
+        synthetic_attributes = {
+           "": { "default": {"a0": "{{#a1.first}}{{a1.first}}{{/a1.first}}-{{^a3}}none{{/a3}}" }}
+        }
+        authz_service = self.create_syn_service(synthetic_attributes)
+        wrapped = []
+        monkeypatch.setattr("satosa.micro_services.attribute_generation.MustachAttrValue",
+                            lambda name, values: wrapped.append(name) or values[0])
+        resp = InternalData(auth_info=AuthenticationInformation())
+        resp.attributes = {
+            "a1": ["test@example.com"],
+            "a2": ["unused"],
+        }
+        ctx = Context()
+        ctx.state = dict()
+        authz_service.process(ctx, resp)
+        assert wrapped == ["a1"]
+
+    @pytest.mark.parametrize("template, names", [
+        ("static", set()),
+        ("{{a1}} {{{a2}}} {{& a3.first }}", {"a1", "a2", "a3"}),
+        ("{{#a1.values}}{{a1}}{{.}}{{/a1.values}}{{^a2}}-{{/a2}}{{! a3 }}", {"a1", "a2"}),
+        ("{{> partial}}", None),
+        ("{{=<% %>=}}<% a1 %>", None),
+    ])
+    def test_referenced_attributes(self, template, names):
+        assert _referenced_attributes(template) == names
+
+    def test_recipes_are_resolved_once(self):
+        synthetic_attributes = {
+           "requester1": { "default": {"a0": "{{a1}}" }},
+           "": { "default": {"a0": "static" }},
+        }
+        authz_service = self.create_syn_service(synthetic_attributes)
+        for requester in ["requester1", "requester1", "requester2"]:
+            resp = InternalData(auth_info=AuthenticationInformation(issuer="https://idp.example.com"))
+            resp.requester = requester
+            resp.attributes = {"a1": ["value1"]}
+            ctx = Context()
+            ctx.state = dict()
+            authz_service.process(ctx, resp)
+            expected = ["value1"] if requester == "requester1" else ["static"]
+            assert resp.attributes["a0"] == expected
+        assert authz_service._resolve_recipes.cache_info().hits == 1
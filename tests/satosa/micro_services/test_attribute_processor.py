@@ -0,0 +1,73 @@
+import pytest
+
+from satosa.context import Context
+from satosa.internal import AuthenticationInformation
+from satosa.internal import InternalData
+from satosa.micro_services.attribute_processor import AttributeProcessor
+from satosa.micro_services.attribute_processor import AttributeProcessorError
+
+PROCESSORS_MODULE = "satosa.micro_services.processors"
+
+
+class TestAttributeProcessor:
+    def create_processor_service(self, processes):
+        service = AttributeProcessor(config={"process": processes},
+                                     name="test_processor",
+                                     base_url="https://satosa.example.com")
+        service.next = lambda ctx, data: data
+        return service
+
+    def process(self, service, attributes):
+        data = InternalData(auth_info=AuthenticationInformation())
+        data.attributes = attributes
+        context = Context()
+        context.state = dict()
+        return service.process(context, data)
+
+    def test_processors_are_run_in_order(self):
+        processes = [
+            {"attribute": "eppn", "processors": [
+                {"name": "ScopeRemoverProcessor",
+                 "module": PROCESSORS_MODULE + ".scope_remover_processor"},
+                {"name": "ScopeProcessor",
+                 "module": PROCESSORS_MODULE + ".scope_processor",
+                 "scope": "example.org"},
+            ]},
+            {"attribute": "gender", "processors": [
+                {"name": "GenderToSchacProcessor",
+                 "module": PROCESSORS_MODULE + ".gender_processor"},
+            ]},
+        ]
+        service = self.create_processor_service(processes)
+        assert len(service.pipeline) == 3
+
+        data = self.process(service, {"eppn": ["alice@example.com"], "gender": ["female"]})
+        assert data.attributes["eppn"] == ["alice@example.org"]
+        assert data.attributes["gender"] == ["2"]
+
+    def test_warnings_do_not_stop_the_pipeline(self):
+        processes = [
+            {"attribute": "eppn", "processors": [
+                {"name": "ScopeRemoverProcessor",
+                 "module": PROCESSORS_MODULE + ".scope_remover_processor"},
+            ]},
+            {"attribute": "gender", "processors": [
+                {"name": "GenderToSchacProcessor",
+                 "module": PROCESSORS_MODULE + ".gender_processor"},
+            ]},
+        ]
+        service = self.create_processor_service(processes)
+        data = self.process(service, {"gender": ["male"]})
+        assert data.attributes["gender"] == ["1"]
+
+    @pytest.mark.parametrize("processor", [
+        {"name": "HashProcessor", "module": PROCESSORS_MODULE + ".hash_processor",
+         "hash_algo": "no_such_algorithm"},
+        {"name": "ScopeProcessor", "module": PROCESSORS_MODULE + ".scope_processor"},
+        {"name": "ScopeExtractorProcessor", "module": PROCESSORS_MODULE + ".scope_extractor_processor"},
+        {"name": "NoSuchProcessor", "module": PROCESSORS_MODULE + ".scope_processor"},
+        {"name": "ScopeProcessor", "module": PROCESSORS_MODULE + ".no_such_module"},
+    ])
+    def test_invalid_config_is_rejected_at_init(self, processor):
+        with pytest.raises(AttributeProcessorError):
+            self.create_processor_service([{"attribute": "eppn", "processors": [processor]}])
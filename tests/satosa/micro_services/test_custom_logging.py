@@ -0,0 +1,150 @@
+import json
+import os
+import threading
+
+import pytest
+
+from satosa.context import Context
+from satosa.internal import AuthenticationInformation
+from satosa.internal import InternalData
+from satosa.micro_services.custom_logging import AuditLogWriter
+from satosa.micro_services.custom_logging import CustomLoggingService
+from satosa.state import State
+
+
+def read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+class TestCustomLoggingService:
+    def create_service(self, log_target, **options):
+        config = dict(log_target=str(log_target), attrs=["eppn", "mail"], **options)
+        service = CustomLoggingService(config=config, name="test_custom_logging",
+                                       base_url="https://satosa.example.com")
+        service.next = lambda ctx, data: data
+        return service
+
+    def process(self, service, attributes):
+        context = Context()
+        context.state = State()
+        context.state["ROUTER"] = "saml2_frontend"
+        context.state["SESSION_ID"] = "session1"
+        context.state["SATOSA_BASE"] = {"requester": "https://sp.example.com"}
+        data = InternalData(auth_info=AuthenticationInformation(
+            issuer="https://idp.example.com", timestamp="2020-01-01T00:00:00Z"))
+        data.attributes = attributes
+        return service.process(context, data)
+
+    def test_writes_record(self, tmpdir):
+        log_target = tmpdir.join("custom.log")
+        service = self.create_service(log_target)
+        data = self.process(service, {"eppn": ["alice@example.com"], "cn": ["Alice"]})
+        # the record holds a copy of the values
+        data.attributes["eppn"].append("bob@example.com")
+        service.writer.close()
+
+        assert read_records(str(log_target)) == [{
+            "router": "saml2_frontend",
+            "timestamp": "2020-01-01T00:00:00Z",
+            "sessionid": "session1",
+            "idp": "https://idp.example.com",
+            "sp": "https://sp.example.com",
+            "attr": {"eppn": ["alice@example.com"], "mail": None},
+        }]
+        assert service.writer_stats["written"] == 1
+
+
+class TestAuditLogWriter:
+    def test_records_are_written_in_batches(self, tmpdir):
+        path = str(tmpdir.join("audit.log"))
+        writer = AuditLogWriter(path, batch_size=10, flush_interval=0.01)
+        for i in range(25):
+            assert writer.write({"n": i})
+        writer.close()
+
+        assert [record["n"] for record in read_records(path)] == list(range(25))
+        assert writer.stats["written"] == 25
+        assert writer.stats["batches"] >= 3
+
+    def test_records_are_dropped_when_the_queue_is_full(self, tmpdir):
+        path = str(tmpdir.join("audit.log"))
+        writer = AuditLogWriter(path, queue_size=2)
+        # hold the writer thread inside a batch
+        writing = threading.Event()
+        release = threading.Event()
+        write_batch = writer._write_batch
+
+        def blocked_write_batch(records):
+            writing.set()
+            release.wait()
+            write_batch(records)
+
+        writer._write_batch = blocked_write_batch
+        writer.write({"n": 0})
+        writing.wait()
+        results = [writer.write({"n": i}) for i in range(1, 5)]
+        release.set()
+        writer.close()
+
+        assert results == [True, True, False, False]
+        assert writer.stats["dropped"] == 2
+        assert [record["n"] for record in read_records(path)] == [0, 1, 2]
+
+    def test_rotation_on_size(self, tmpdir):
+        path = str(tmpdir.join("audit.log"))
+        writer = AuditLogWriter(path, batch_size=1, flush_interval=0.01, max_bytes=1, backup_count=2)
+        for i in range(4):
+            writer.write({"n": i})
+        writer.close()
+
+        assert read_records(path) == [{"n": 3}]
+        assert read_records(path + ".1") == [{"n": 2}]
+        assert read_records(path + ".2") == [{"n": 1}]
+        assert not tmpdir.join("audit.log.3").exists()
+        assert writer.stats["rotations"] == 3
+
+    def test_rotation_by_another_process_is_followed(self, tmpdir):
+        path = str(tmpdir.join("audit.log"))
+        writer1 = AuditLogWriter(path, max_bytes=1)
+        writer2 = AuditLogWriter(path, max_bytes=1)
+        writer1._write_batch([{"n": 0}])
+        writer2._write_batch([{"n": 1}])
+        # writer1 rotates the file, writer2 reopens it instead of rotating it again
+        writer1._write_batch([{"n": 2}])
+        writer2._write_batch([{"n": 3}])
+        writer1._close_stream()
+        writer2._close_stream()
+
+        assert read_records(path) == [{"n": 2}, {"n": 3}]
+        assert read_records(path + ".1") == [{"n": 0}, {"n": 1}]
+        assert writer1.stats["rotations"] == 1
+        assert writer2.stats["rotations"] == 0
+
+    def test_thread_is_started_on_first_write(self, tmpdir):
+        path = str(tmpdir.join("audit.log"))
+        writer = AuditLogWriter(path, flush_interval=0.01)
+        assert writer._thread is None
+        writer.write({"n": 0})
+        assert writer._thread.is_alive()
+        writer.close()
+        assert read_records(path) == [{"n": 0}]
+
+    @pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+    def test_forked_process_starts_its_own_thread(self, tmpdir):
+        path = str(tmpdir.join("audit.log"))
+        writer = AuditLogWriter(path, flush_interval=0.01)
+        writer.write({"n": "parent"})
+        parent_thread = writer._thread
+
+        pid = os.fork()
+        if pid == 0:
+            writer.write({"n": "child"})
+            ok = writer._thread is not parent_thread
+            writer.close()
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        writer.close()
+
+        assert os.WEXITSTATUS(status) == 0
+        assert sorted(record["n"] for record in read_records(path)) == ["child", "parent"]
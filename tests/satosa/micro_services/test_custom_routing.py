@@ -5,7 +5,10 @@ import pytest
 from satosa.context import Context
 from satosa.exception import SATOSAError, SATOSAConfigurationError
 from satosa.internal import InternalData
+from satosa.micro_services.custom_routing import DecideBackendByRequester
 from satosa.micro_services.custom_routing import DecideIfRequesterIsAllowed
+from satosa.micro_services.custom_routing import PrefixTrie
+from satosa.micro_services.custom_routing import RegexMapping
 
 TARGET_ENTITY = "entity1"
 
@@ -156,3 +159,135 @@ class TestDecideIfRequesterIsAllowed:
         req = InternalData(requester="test_requester")
         with pytest.raises(SATOSAError):
             decide_service.process(context, req)
+
+
+    @pytest.mark.parametrize("requester, allowed", [
+        ("https://sp.example.org/sp1", True),
+        ("https://sp.example.org/blocked/sp2", False),
+        ("https://sp1.example.com/shibboleth", True),
+        ("https://sp1.example.com/other", False),
+        ("https://sp.example.net/", False),
+    ])
+    def test_wildcard_rules(self, target_context, requester, allowed):
+        rules = {
+            TARGET_ENTITY: {
+                "allow_patterns": ["https://sp.example.org/*", "https://*.example.com/shibboleth"],
+                "deny_patterns": ["https://sp.example.org/blocked/*"],
+            }
+        }
+        decide_service = self.create_decide_service(rules)
+
+        req = InternalData(requester=requester)
+        if allowed:
+            assert decide_service.process(target_context, req)
+        else:
+            with pytest.raises(SATOSAError):
+                decide_service.process(target_context, req)
+
+    @pytest.mark.parametrize("requester, allowed", [
+        ("https://sp1.example.com", True),
+        ("https://sp2.example.com", True),
+        ("https://sp", True),
+        ("https://sp3.example.com", False),
+        ("https://blocked.example.com", False),
+        ("example.com", False),
+    ])
+    def test_string_rules_match_substrings(self, target_context, requester, allowed):
+        rules = {
+            TARGET_ENTITY: {
+                "allow": "https://sp1.example.com https://sp2.example.com",
+                "deny": "https://blocked.example.com",
+            }
+        }
+        decide_service = self.create_decide_service(rules)
+
+        req = InternalData(requester=requester)
+        if allowed:
+            assert decide_service.process(target_context, req)
+        else:
+            with pytest.raises(SATOSAError):
+                decide_service.process(target_context, req)
+
+    def test_string_rule_with_a_star_allows_all(self, target_context):
+        decide_service = self.create_decide_service({TARGET_ENTITY: {"allow": "https://sp.example.org/*"}})
+        assert decide_service.process(target_context, InternalData(requester="https://other.example.com"))
+
+    def test_star_in_a_listed_identifier_is_not_a_wildcard(self, target_context):
+        decide_service = self.create_decide_service({TARGET_ENTITY: {"allow": ["https://sp.example.org/*"]}})
+        assert decide_service.process(target_context, InternalData(requester="https://sp.example.org/*"))
+        with pytest.raises(SATOSAError):
+            decide_service.process(target_context, InternalData(requester="https://sp.example.org/sp1"))
+
+    def test_decisions_are_remembered(self, target_context):
+        decide_service = self.create_decide_service({TARGET_ENTITY: {"allow": ["test_requester"]}})
+        req = InternalData(requester="test_requester")
+        for _ in range(3):
+            decide_service.process(target_context, req)
+        assert decide_service._decide.cache_info().hits == 2
+
+
+class TestDecideBackendByRequester:
+    def create_router(self, config):
+        router = DecideBackendByRequester(config=config, name="test_router",
+                                          base_url="https://satosa.example.com")
+        router.next = lambda ctx, data: data
+        return router
+
+    @pytest.fixture
+    def router(self):
+        return self.create_router({
+            "requester_mapping": {"https://sp.example.org/special": "exact"},
+            "requester_prefix_mapping": {
+                "https://sp.example.org/": "prefix",
+                "https://sp.example.org/long/": "longer_prefix",
+            },
+            "requester_regex_mapping": {
+                r"https://sp\d+\.example\.com/": "regex1",
+                r"https://(sp|rp)\d+\.example\.com": "regex2",
+            },
+            "default_backend": "default",
+        })
+
+    @pytest.mark.parametrize("requester, backend", [
+        ("https://sp.example.org/special", "exact"),
+        ("https://sp.example.org/other", "prefix"),
+        ("https://sp.example.org/long/path", "longer_prefix"),
+        ("https://sp1.example.com/", "regex1"),
+        ("https://rp1.example.com/", "regex2"),
+        ("https://unknown.example.net/", "default"),
+    ])
+    def test_routing_order(self, context, router, requester, backend):
+        router.process(context, InternalData(requester=requester))
+        assert context.target_backend == backend
+
+    def test_backend_is_kept_without_a_matching_rule(self, context):
+        router = self.create_router({"requester_mapping": {"requester1": "backend1"}})
+        context.target_backend = "frontend_selected"
+        router.process(context, InternalData(requester="requester2"))
+        assert context.target_backend == "frontend_selected"
+
+    def test_routes_are_remembered(self, context, router):
+        for _ in range(3):
+            router.process(context, InternalData(requester="https://sp.example.org/other"))
+        assert router._route.cache_info().hits == 2
+
+
+def test_prefix_trie_longest_prefix():
+    trie = PrefixTrie({"ab": 1, "abcd": 2, "": 0})
+    assert len(trie) == 3
+    assert trie.longest_prefix_value("abc") == 1
+    assert trie.longest_prefix_value("abcde") == 2
+    assert trie.longest_prefix_value("x") == 0
+
+
+@pytest.mark.parametrize("regexes, combined", [
+    ({"(a)b": 1, "a(c)": 2, "a": 3}, True),
+    ({"(a)b": 1, "(x)\\1": 4, "a(c)": 2, "a": 3}, False),
+])
+def test_regex_mapping_first_match_wins(regexes, combined):
+    mapping = RegexMapping(regexes)
+    assert (mapping.combined is not None) == combined
+    assert mapping.match("ab") == 1
+    assert mapping.match("ac") == 2
+    assert mapping.match("aa") == 3
+    assert mapping.match("x", "default") == "default"
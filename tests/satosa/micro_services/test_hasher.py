@@ -0,0 +1,56 @@
+import hashlib
+import hmac
+
+from satosa.context import Context
+from satosa.internal import AuthenticationInformation
+from satosa.internal import InternalData
+from satosa.micro_services.hasher import Hasher
+from satosa import util
+
+
+def sha(alg, value, salt):
+    return hashlib.new(alg, (value + salt).encode("utf-8")).hexdigest()
+
+
+class TestHasher:
+    def create_hasher(self, config):
+        service = Hasher(config=config, name="test_hasher", base_url="https://satosa.example.com")
+        service.next = lambda ctx, data: data
+        return service
+
+    def process(self, service, requester, subject_id, attributes):
+        data = InternalData(auth_info=AuthenticationInformation())
+        data.requester = requester
+        data.subject_id = subject_id
+        data.attributes = attributes
+        return service.process(Context(), data)
+
+    def test_hash_per_requester(self):
+        service = self.create_hasher({
+            "": {"salt": "abc", "alg": "sha256", "attributes": ["mail"]},
+            "https://sp.example.com": {"alg": "sha1", "subject_id": False, "attributes": ["eppn"]},
+        })
+
+        data = self.process(service, "https://other.example.com", "user",
+                            {"mail": ["a@example.com", "b@example.com"], "eppn": ["a@example.com"]})
+        assert data.subject_id == sha("sha256", "user", "abc")
+        assert data.attributes == {
+            "mail": [sha("sha256", "a@example.com", "abc"), sha("sha256", "b@example.com", "abc")],
+            "eppn": ["a@example.com"],
+        }
+
+        data = self.process(service, "https://sp.example.com", "user",
+                            {"mail": ["a@example.com"], "eppn": ["a@example.com"]})
+        assert data.subject_id == "user"
+        assert data.attributes == {"mail": ["a@example.com"], "eppn": [sha("sha1", "a@example.com", "abc")]}
+
+    def test_hmac(self):
+        service = self.create_hasher({"": {"salt": "key", "alg": "sha256", "hmac": True}})
+        data = self.process(service, "https://sp.example.com", "user", {})
+        assert data.subject_id == hmac.new(b"key", b"user", "sha256").hexdigest()
+
+
+def test_hash_data_is_unchanged():
+    assert util.hash_data("salt", "value") == sha("sha512", "value", "salt")
+    assert util.hash_values("salt", ["v1", "v2"], hash_alg="md5") == [sha("md5", "v1", "salt"),
+                                                                      sha("md5", "v2", "salt")]
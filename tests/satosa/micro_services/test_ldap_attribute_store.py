@@ -0,0 +1,202 @@
+import copy
+import datetime
+import os
+
+import ldap3
+import pytest
+from ldap3.utils.ciDict import CaseInsensitiveDict
+
+from satosa.context import Context
+from satosa.internal import AuthenticationInformation
+from satosa.internal import InternalData
+from satosa.micro_services.ldap_attribute_store import KEY_FOUND_LDAP_RECORD
+from satosa.micro_services.ldap_attribute_store import LdapAttributeStore
+from satosa.micro_services.ldap_attribute_store import LdapSearchCache
+
+SEARCH_BASE = "ou=People,dc=example,dc=com"
+LDAP_RECORDS = {
+    "uid=alice," + SEARCH_BASE: {
+        "objectClass": ["person"],
+        "employeeNumber": ["1001", "alice@example.com"],
+        "mail": ["alice@example.com"],
+        "givenName": ["Alice"],
+        "jpegPhoto": [b"\xff\xd8"],
+    },
+    "uid=bob," + SEARCH_BASE: {
+        "objectClass": ["person"],
+        "employeeNumber": ["1002", "bob@example.com"],
+        "mail": ["bob@example.com"],
+        "givenName": ["Bob"],
+    },
+}
+
+
+class MockLdapAttributeStore(LdapAttributeStore):
+    def _ldap_connection_factory(self, config):
+        server = ldap3.Server("mock_server")
+        connection = ldap3.Connection(server, user="cn=admin,dc=example,dc=com", password="secret",
+                                      client_strategy=ldap3.MOCK_SYNC)
+        connection.strategy.add_entry("cn=admin,dc=example,dc=com", {"userPassword": "secret"})
+        for dn, attributes in LDAP_RECORDS.items():
+            connection.strategy.add_entry(dn, attributes)
+        connection.bind()
+        return connection
+
+
+class TestLdapAttributeStore:
+    def create_ldap_service(self, **options):
+        config = {
+            "ldap_url": "ldap://ldap.example.com",
+            "bind_dn": "cn=admin,dc=example,dc=com",
+            "bind_password": "secret",
+            "search_base": SEARCH_BASE,
+            "ldap_identifier_attribute": "employeeNumber",
+            "ordered_identifier_candidates": [
+                {"attribute_names": ["employeenumber"]},
+                {"attribute_names": ["mail"]},
+            ],
+            "query_return_attributes": ["givenName", "mail"],
+            "ldap_to_internal_map": {"givenName": "givenname", "mail": "mail"},
+        }
+        config.update(options)
+        ldap_service = MockLdapAttributeStore(config={"default": config}, name="test_ldap",
+                                              base_url="https://satosa.example.com")
+        ldap_service.next = lambda ctx, data: data
+        return ldap_service
+
+    def process(self, ldap_service, attributes, requester="https://sp.example.com"):
+        data = InternalData(auth_info=AuthenticationInformation(issuer="https://idp.example.com"))
+        data.requester = requester
+        data.attributes = attributes
+        context = Context()
+        context.state = dict()
+        ldap_service.process(context, data)
+        return context, data
+
+    @pytest.mark.parametrize("combined_search", [False, True])
+    def test_candidates_are_searched_in_order(self, combined_search):
+        ldap_service = self.create_ldap_service(combined_search=combined_search)
+        _, data = self.process(ldap_service, {"employeenumber": ["unknown"], "mail": ["alice@example.com"]})
+        assert data.attributes["givenname"] == ["Alice"]
+        assert ldap_service.search_stats["searches"] == (1 if combined_search else 2)
+        assert ldap_service.search_stats["authentications"] == 1
+
+    @pytest.mark.parametrize("combined_search", [False, True])
+    def test_first_candidate_wins(self, combined_search):
+        # the first candidate identifies bob, the second alice
+        ldap_service = self.create_ldap_service(combined_search=combined_search)
+        context, data = self.process(ldap_service,
+                                     {"employeenumber": ["1002"], "mail": ["alice@example.com"]})
+        assert data.attributes["givenname"] == ["Bob"]
+        assert context.get_decoration(KEY_FOUND_LDAP_RECORD)["dn"] == "uid=bob," + SEARCH_BASE
+
+    def test_no_record_found(self):
+        ldap_service = self.create_ldap_service(combined_search=True)
+        _, data = self.process(ldap_service, {"employeenumber": ["unknown"], "mail": ["unknown"]})
+        assert "givenname" not in data.attributes
+        stats = ldap_service.search_stats
+        assert stats["searches_per_authentication"] == 1
+        assert stats["average_latency"] >= 0
+
+    def test_search_results_are_cached(self):
+        ldap_service = self.create_ldap_service(search_cache={"ttl": 60, "negative_ttl": 60})
+        for _ in range(2):
+            _, data = self.process(ldap_service, {"employeenumber": ["unknown"], "mail": ["alice@example.com"]})
+            assert data.attributes["givenname"] == ["Alice"]
+        # the negative result for the first candidate is cached as well
+        assert ldap_service.search_stats["searches"] == 2
+        cache = ldap_service.config["default"]["cache"]
+        assert cache.stats["hits"] == 2
+        assert cache.stats["misses"] == 2
+
+    def test_expired_search_results_are_not_used(self):
+        ldap_service = self.create_ldap_service(search_cache={"ttl": 60, "negative_ttl": -1})
+        for _ in range(2):
+            self.process(ldap_service, {"employeenumber": ["unknown"], "mail": ["alice@example.com"]})
+        assert ldap_service.search_stats["searches"] == 3
+        assert ldap_service.config["default"]["cache"].stats["evictions"] == 1
+
+    def test_bypass_search_cache(self):
+        ldap_service = self.create_ldap_service(search_cache={"ttl": 60}, bypass_search_cache=True)
+        for _ in range(2):
+            self.process(ldap_service, {"employeenumber": ["1001"]})
+        assert ldap_service.search_stats["searches"] == 2
+        assert len(ldap_service.config["default"]["cache"]) == 0
+
+    def test_search_cache_is_bounded(self):
+        cache = LdapSearchCache(max_entries=2)
+        for i in range(3):
+            cache.set(("search", i), [])
+        assert len(cache) == 2
+        assert cache.get(("search", 0)) is None
+        assert cache.get(("search", 2)) == []
+        assert cache.stats["evictions"] == 1
+
+    def test_search_cache_is_shared_through_sqlite(self, tmpdir):
+        sqlite_path = str(tmpdir.join("ldap.sqlite"))
+        record = {"dn": "uid=alice," + SEARCH_BASE, "attributes": {"givenName": ["Alice"]}}
+        LdapSearchCache(sqlite_path=sqlite_path).set(("search",), [record])
+
+        cache = LdapSearchCache(sqlite_path=sqlite_path)
+        assert cache.get(("search",)) == [record]
+        assert cache.stats["shared_hits"] == 1
+
+    def test_search_cache_returns_the_same_values_from_both_tiers(self, tmpdir):
+        sqlite_path = str(tmpdir.join("ldap.sqlite"))
+        attributes = CaseInsensitiveDict({"jpegPhoto": [b"\xff\xd8"], "uidNumber": 1001,
+                                          "createTimestamp": datetime.datetime(2020, 1, 2, tzinfo=datetime.timezone.utc)})
+        record = {"dn": "uid=alice," + SEARCH_BASE, "attributes": attributes,
+                  "raw_attributes": {"jpegPhoto": [b"\xff\xd8"]}, "type": "searchResEntry"}
+        expected = copy.deepcopy(record)
+        writer = LdapSearchCache(sqlite_path=sqlite_path)
+        writer.set(("search",), [record])
+        assert record == expected
+        assert writer.get(("search",)) == [expected]
+
+        cache = LdapSearchCache(sqlite_path=sqlite_path)
+        cached = cache.get(("search",))
+        assert cached == [expected]
+        assert cache.stats["shared_hits"] == 1
+        assert cached[0]["attributes"]["jpegphoto"] == [b"\xff\xd8"]
+
+    def test_search_cache_connects_again_after_fork(self, tmpdir, monkeypatch):
+        cache = LdapSearchCache(sqlite_path=str(tmpdir.join("ldap.sqlite")))
+        connection = cache._connection()
+        assert cache._connection() is connection
+        monkeypatch.setattr(os, "getpid", lambda: -1)
+        assert cache._connection() is not connection
+
+    def test_unserializable_search_results_are_only_cached_in_memory(self, tmpdir):
+        sqlite_path = str(tmpdir.join("ldap.sqlite"))
+        record = {"dn": "uid=alice," + SEARCH_BASE, "attributes": {"lockoutDuration": [datetime.timedelta(1)]}}
+        writer = LdapSearchCache(sqlite_path=sqlite_path)
+        writer.set(("search",), [record])
+        assert writer.get(("search",)) == [record]
+        assert LdapSearchCache(sqlite_path=sqlite_path).get(("search",)) is None
+
+    def test_cached_search_returns_the_values_of_the_uncached_search(self):
+        ldap_service = self.create_ldap_service(
+            search_cache={"ttl": 60},
+            query_return_attributes=["givenName", "jpegPhoto"],
+            ldap_to_internal_map={"givenName": "givenname", "jpegPhoto": "jpegphoto"},
+        )
+        uncached_service = self.create_ldap_service(
+            query_return_attributes=["givenName", "jpegPhoto"],
+            ldap_to_internal_map={"givenName": "givenname", "jpegPhoto": "jpegphoto"},
+        )
+        _, uncached = self.process(uncached_service, {"employeenumber": ["1001"]})
+        assert uncached.attributes["jpegphoto"] == [b"\xff\xd8"]
+        for _ in range(2):
+            _, data = self.process(ldap_service, {"employeenumber": ["1001"]})
+            assert data.attributes == uncached.attributes
+        assert ldap_service.search_stats["searches"] == 1
+
+    def test_search_results_are_cached_per_bind_dn(self):
+        ldap_service = self.create_ldap_service(search_cache={"ttl": 60})
+        sp_config = dict(ldap_service.config["default"], bind_dn="cn=other,dc=example,dc=com")
+        ldap_service.config["https://other-sp.example.com"] = sp_config
+
+        self.process(ldap_service, {"employeenumber": ["1001"]})
+        _, data = self.process(ldap_service, {"employeenumber": ["1001"]}, requester="https://other-sp.example.com")
+        assert data.attributes["givenname"] == ["Alice"]
+        assert ldap_service.search_stats["searches"] == 2
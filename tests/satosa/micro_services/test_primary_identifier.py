@@ -0,0 +1,80 @@
+import pytest
+
+from satosa.context import Context
+from satosa.internal import AuthenticationInformation
+from satosa.internal import InternalData
+from satosa.micro_services.primary_identifier import PrimaryIdentifier
+from satosa.response import Redirect
+from satosa.state import State
+
+SP = "https://sp.example.com"
+IDP = "https://idp.example.com"
+PERSISTENT = "urn:oasis:names:tc:SAML:2.0:nameid-format:persistent"
+
+
+class TestPrimaryIdentifier:
+    def create_service(self, config):
+        service = PrimaryIdentifier(config=config, name="test_primary_identifier",
+                                    base_url="https://satosa.example.com")
+        service.next = lambda ctx, data: data
+        return service
+
+    def process(self, service, attributes, subject_id=None, subject_type=None, requester=SP):
+        context = Context()
+        context.state = State()
+        context.state["SATOSA_BASE"] = {"requester": requester}
+        data = InternalData(auth_info=AuthenticationInformation(issuer=IDP))
+        data.attributes = attributes
+        data.subject_id = subject_id
+        data.subject_type = subject_type
+        return service.process(context, data)
+
+    @pytest.fixture
+    def config(self):
+        return {
+            "primary_identifier": "uid",
+            "ordered_identifier_candidates": [
+                {"attribute_names": ["eppn"]},
+                {"attribute_names": ["givenname", "sn"], "add_scope": "issuer_entityid"},
+                {"attribute_names": ["name_id"], "name_id_format": PERSISTENT},
+            ],
+        }
+
+    def test_first_complete_candidate_is_used(self, config):
+        service = self.create_service(config)
+        data = self.process(service, {"eppn": ["alice@example.com"], "givenname": ["Alice"]})
+        assert data.attributes["uid"] == "alice@example.com"
+
+        data = self.process(service, {"givenname": ["Alice"], "sn": ["Smith"]})
+        assert data.attributes["uid"] == "AliceSmith" + IDP
+
+    def test_per_sp_configuration(self, config):
+        config[SP] = {"primary_identifier": "userid", "clear_input_attributes": True}
+        config["https://other-sp.example.com"] = {"ignore": True}
+        service = self.create_service(config)
+
+        data = self.process(service, {"eppn": ["alice@example.com"]})
+        assert data.attributes == {"userid": "alice@example.com"}
+
+        data = self.process(service, {"eppn": ["alice@example.com"]}, requester="https://other-sp.example.com")
+        assert data.attributes == {"eppn": ["alice@example.com"]}
+
+    def test_configuration_is_resolved_once_per_sp_and_idp(self, config):
+        service = self.create_service(config)
+        for _ in range(3):
+            self.process(service, {"eppn": ["alice@example.com"]})
+        cache_info = service._resolve_config.cache_info()
+        assert cache_info.misses == 1
+        assert cache_info.hits == 2
+
+    def test_redirect_on_error(self, config):
+        config["on_error"] = "https://error.example.com/"
+        service = self.create_service(config)
+        response = self.process(service, {"sn": ["Smith"]})
+        assert isinstance(response, Redirect)
+        assert response.message == "https://error.example.com/?sp=https%3A%2F%2Fsp.example.com&idp=https%3A%2F%2Fidp.example.com"
+
+    def test_missing_candidates_skip_the_service(self):
+        service = self.create_service({SP: {"primary_identifier": "uid"}})
+        data = self.process(service, {"eppn": ["alice@example.com"]})
+        assert data.attributes == {"eppn": ["alice@example.com"]}
@@ -0,0 +1,46 @@
+import re
+
+import pytest
+
+from satosa.micro_services.rules import RuleSet, compile_any, compile_rules
+
+
+class TestCompileAny:
+    @pytest.mark.parametrize("patterns, value, expected", [
+        (["^foo$", "^bar$"], "bar", True),
+        (["^foo$", "^bar$"], "foobar", False),
+        (["a|b", "^c$"], "xb", True),
+        ("^foo$", "foo", True),
+        # backreferences can't be combined into one alternation
+        (["(a)\\1", "^c$"], "aa", True),
+        (["(a)\\1", "^c$"], "ab", False),
+        # neither can global flags after the start
+        (["(?i)foo", "^bar$"], "FOO", True),
+        ([], "", False),
+        ([], "foo", False),
+    ])
+    def test_matches_any_pattern(self, patterns, value, expected):
+        assert bool(compile_any(patterns).search(value)) is expected
+
+    def test_patterns_are_combined(self):
+        assert isinstance(compile_any(["^foo$", "^bar$"]), re.Pattern)
+
+
+class TestRuleSet:
+    def test_resolve_with_defaults(self):
+        rules = RuleSet({
+            "requester1": {"provider1": {"attr1": ["^a$"]}, "default": {"attr2": ["^b$"]}},
+            "": {"": {"attr3": ["^c$"]}},
+        })
+        assert list(rules.resolve("requester1", "provider1")) == ["attr1"]
+        assert list(rules.resolve("requester1", "provider2")) == ["attr2"]
+        assert list(rules.resolve("requester2", "provider1")) == ["attr3"]
+
+    def test_resolved_rules_are_remembered(self):
+        rules = RuleSet({"": {"": {"attr1": ["^a$"]}}})
+        assert rules.resolve("requester", "provider") is rules.resolve("requester", "provider")
+        assert rules.cache_stats == {"hits": 1, "misses": 1, "size": 1}
+
+    def test_compile_rules(self):
+        compiled = compile_rules({"": {"": {"attr1": "^a$"}}}, 2)
+        assert compiled[""][""]["attr1"].search("a")
@@ -303,6 +303,63 @@ class TestAttributeMapper:
         external_repr = converter.from_internal("p2", internal_repr)
         assert external_repr["cn"][0] == "Valfrid Lindeman"
 
+    def test_from_internal_merges_nested_attributes(self):
+        mapping = {
+            "attributes": {
+                "locality": {"openid": ["address.locality"]},
+                "country": {"openid": ["address.country"]},
+                "mail": {"openid": ["email"]},
+            },
+        }
+        converter = AttributeMapper(mapping)
+        internal_repr = {"locality": ["Hollywood"], "country": ["USA"], "mail": ["bob@example.com"]}
+        external_repr = converter.from_internal("openid", internal_repr)
+        assert external_repr == {
+            "address": {"locality": ["Hollywood"], "country": ["USA"]},
+            "email": ["bob@example.com"],
+        }
+        assert converter.to_internal("openid", external_repr) == internal_repr
+
+    def test_to_internal_keeps_configured_order(self):
+        mapping = {
+            "attributes": {
+                "mail": {"saml": ["mail"]},
+                "name": {"saml": ["cn"]},
+                "other_mail": {"saml": ["email", "mail"]},
+            },
+        }
+        converter = AttributeMapper(mapping)
+        internal_repr = converter.to_internal("saml", {"cn": ["Bob"], "mail": ["bob@example.com"],
+                                                       "email": ["b@example.com"], "unknown": ["x"]})
+        assert list(internal_repr) == ["mail", "name", "other_mail"]
+        assert internal_repr["other_mail"] == ["b@example.com", "bob@example.com"]
+
+    def test_templates_are_compiled_once(self, monkeypatch):
+        mapping = {
+            "attributes": {"first_name": {"p1": ["givenName"]}},
+            "template_attributes": {"name": {"p1": ["Mr ${first_name[0]}"]}},
+        }
+        AttributeMapper(mapping)
+
+        def fail(*args, **kwargs):
+            raise AssertionError("the template was compiled again")
+
+        monkeypatch.setattr("satosa.attribute_mapping.Template", fail)
+        internal_repr = AttributeMapper(mapping).to_internal("p1", {"givenName": ["Valfrid"]})
+        assert internal_repr["name"] == ["Mr Valfrid"]
+
+    def test_template_module_directory(self, tmpdir, monkeypatch):
+        monkeypatch.setattr("satosa.attribute_mapping._TEMPLATE_CACHE", {})
+        mapping = {
+            "attributes": {"first_name": {"p1": ["givenName"]}},
+            "template_attributes": {"name": {"p1": ["Ms ${first_name[0]}"]}},
+            "template_module_directory": str(tmpdir),
+        }
+        converter = AttributeMapper(mapping)
+        assert any(f.ext == ".py" for f in tmpdir.listdir())
+        internal_repr = converter.to_internal("p1", {"givenName": ["Valfrid"]})
+        assert internal_repr["name"] == ["Ms Valfrid"]
+
     def test_scoped_template_mapping(self):
         mapping = {
             "attributes": {
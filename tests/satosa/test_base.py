@@ -13,7 +13,9 @@ from satosa.exception import SATOSAConfigurationError
 from satosa.internal import AuthenticationInformation
 from satosa.internal import InternalData
 from satosa.micro_services import consent
+from satosa.response import Response
 from satosa.satosa_config import SATOSAConfig
+from satosa.state import State, state_to_cookie
 
 
 class TestSATOSABase:
@@ -100,6 +102,24 @@ class TestSATOSABase:
         base._auth_resp_callback_func(context, internal_resp)
         assert internal_resp.attributes["user_id"] == [internal_resp.subject_id]
 
+    def test_unmodified_state_is_not_saved(self, context, satosa_config):
+        base = SATOSABase(satosa_config)
+        state = State()
+        state["foo"] = "bar"
+        cookie = state_to_cookie(state, satosa_config["COOKIE_STATE_NAME"], "/",
+                                 satosa_config["STATE_ENCRYPTION_KEY"])
+        context.cookie = cookie.output(header="")
+        base._load_state(context)
+        assert not context.state.is_decoded
+
+        resp = Response()
+        base._save_state(resp, context)
+        assert not any(header == "Set-Cookie" for header, _ in resp.headers)
+
+        context.state["foo"] = "baz"
+        base._save_state(resp, context)
+        assert any(header == "Set-Cookie" for header, _ in resp.headers)
+
     @pytest.mark.parametrize("micro_services", [
         [Mock()],
         [Mock(), Mock()],
@@ -0,0 +1,145 @@
+import copy
+
+import pytest
+import yaml
+from saml2.config import SPConfig
+
+from satosa.metadata_index import MetadataIndex
+from satosa.metadata_index import MetadataIndexSource
+from satosa.metadata_index import add_metadata_index
+from satosa.metadata_index import build_metadata_index
+from satosa.metadata_index import write_metadata_index
+from satosa.metadata_refresh import MetadataRefresher
+from satosa.scripts.satosa_metadata_index import create_metadata_index
+from tests.util import create_metadata_from_config_dict
+
+
+def load_store(sp_conf, metadata_conf):
+    conf = copy.deepcopy(sp_conf)
+    conf["metadata"] = metadata_conf
+    return SPConfig().load(conf).metadata
+
+
+@pytest.fixture
+def metadata_conf(sp_conf, idp_conf):
+    idps = []
+    for i in range(3):
+        conf = copy.deepcopy(idp_conf)
+        conf["entityid"] = "https://idp{}.example.com".format(i)
+        idps.append(create_metadata_from_config_dict(conf))
+    return {"inline": idps + [create_metadata_from_config_dict(sp_conf)]}
+
+
+@pytest.fixture
+def index_path(sp_conf, metadata_conf, tmpdir):
+    path = str(tmpdir.join("metadata.index"))
+    build_metadata_index(load_store(sp_conf, metadata_conf), path)
+    return path
+
+
+class TestMetadataIndex(object):
+    def test_lookup(self, sp_conf, metadata_conf, index_path):
+        store = load_store(sp_conf, metadata_conf)
+        index = MetadataIndex(index_path)
+
+        assert len(index) == 4
+        assert sorted(index) == sorted(store.keys())
+        for entity_id, entity in store.items():
+            assert entity_id in index
+            assert index[entity_id] == entity
+        assert "https://unknown.example.com" not in index
+        with pytest.raises(KeyError):
+            index["https://unknown.example.com"]
+        index.close()
+
+    def test_with_descriptor_only_decodes_matching_entities(self, sp_conf, index_path):
+        index = MetadataIndex(index_path)
+        assert sorted(index.with_descriptor("idpsso")) == ["https://idp{}.example.com".format(i) for i in range(3)]
+        assert list(index.with_descriptor("spsso")) == [sp_conf["entityid"]]
+        assert index.with_descriptor("pdp") == {}
+
+    def test_decoded_entities_are_cached(self, index_path):
+        index = MetadataIndex(index_path, cache_size=2)
+        for _ in range(3):
+            index["https://idp0.example.com"]
+        assert index._entity.cache_info().hits == 2
+        assert index._entity.cache_info().currsize == 1
+
+    def test_hash_collisions_are_resolved_by_entity_id(self, tmpdir, monkeypatch):
+        monkeypatch.setattr("satosa.metadata_index._hash", lambda entity_id: 1)
+        path = str(tmpdir.join("metadata.index"))
+        write_metadata_index([("https://a.example.com", {"a": 1}), ("https://b.example.com", {"b": 2})], path)
+        index = MetadataIndex(path)
+        assert index["https://a.example.com"] == {"a": 1}
+        assert index["https://b.example.com"] == {"b": 2}
+        assert "https://c.example.com" not in index
+
+    def test_not_an_index(self, tmpdir):
+        path = tmpdir.join("metadata.xml")
+        path.write("<EntitiesDescriptor/>")
+        with pytest.raises(ValueError):
+            MetadataIndex(str(path))
+
+
+class TestIndexedMetaData(object):
+    def test_metadata_store_queries(self, sp_conf, idp_conf, metadata_conf, index_path):
+        stock_store = load_store(sp_conf, metadata_conf)
+        indexed_store = load_store(sp_conf, {})
+        add_metadata_index(indexed_store, index_path)
+
+        idp = "https://idp1.example.com"
+        assert indexed_store.single_sign_on_service(idp) == stock_store.single_sign_on_service(idp)
+        assert indexed_store.certs(idp, "idpsso", "signing") == stock_store.certs(idp, "idpsso", "signing")
+        assert list(indexed_store.mdui_uiinfo_display_name(idp)) == list(stock_store.mdui_uiinfo_display_name(idp))
+        sp = sp_conf["entityid"]
+        acs = ("spsso_descriptor", "assertion_consumer_service")
+        assert indexed_store.service(sp, *acs) == stock_store.service(sp, *acs)
+        assert set(indexed_store.identity_providers()) == set(stock_store.identity_providers())
+
+    def test_replaced_index_is_reopened_and_closed(self, sp_conf, idp_conf, index_path, monkeypatch):
+        monkeypatch.setattr("satosa.metadata_index.CLOSE_DELAY", 0)
+        store = load_store(sp_conf, {})
+        previous = add_metadata_index(store, index_path)
+        refresher = MetadataRefresher(MetadataIndexSource(store, index_path))
+        assert refresher.refresh()
+        assert refresher.stats["not_modified"] == 1
+
+        idp_conf["entityid"] = "https://new-idp.example.com"
+        build_metadata_index(load_store(sp_conf, {"inline": [create_metadata_from_config_dict(idp_conf)]}),
+                             index_path)
+        assert refresher.refresh()
+        assert list(store.keys()) == ["https://new-idp.example.com"]
+        assert previous.entity._mmap.closed
+        assert not store.metadata[index_path].entity._mmap.closed
+
+    def test_loading_does_not_decode_the_entities(self, sp_conf, index_path, monkeypatch):
+        decoded = []
+        decode = MetadataIndex._decode
+        monkeypatch.setattr(MetadataIndex, "_decode", lambda self, i: decoded.append(i) or decode(self, i))
+        store = load_store(sp_conf, {})
+        metadata = add_metadata_index(store, index_path)
+        assert store.construct_source_id() == {}
+        assert sorted(metadata.entity_ids_with_descriptor("idpsso")) == [
+            "https://idp{}.example.com".format(i) for i in range(3)]
+        assert decoded == []
+
+    def test_source_id_only_decodes_entities_with_artifact_resolution(self, sp_conf, idp_conf, tmpdir):
+        idp_conf["entityid"] = "https://artifact-idp.example.com"
+        idp_conf["service"]["idp"]["endpoints"]["artifact_resolution_service"] = [
+            ("https://artifact-idp.example.com/ars", "urn:oasis:names:tc:SAML:2.0:bindings:SOAP")]
+        metadata_conf = {"inline": [create_metadata_from_config_dict(idp_conf), create_metadata_from_config_dict(sp_conf)]}
+        path = str(tmpdir.join("metadata.index"))
+        build_metadata_index(load_store(sp_conf, metadata_conf), path)
+
+        store = load_store(sp_conf, {})
+        metadata = add_metadata_index(store, path)
+        assert store.construct_source_id() == load_store(sp_conf, metadata_conf).construct_source_id()
+        assert metadata.entity._entity.cache_info().currsize == 1
+
+
+def test_create_metadata_index_from_yaml(metadata_conf, tmpdir):
+    conf_file = tmpdir.join("metadata.yaml")
+    conf_file.write(yaml.safe_dump(metadata_conf))
+    path = str(tmpdir.join("metadata.index"))
+    assert create_metadata_index(str(conf_file), path) == 4
+    assert len(MetadataIndex(path)) == 4
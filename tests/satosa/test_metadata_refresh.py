@@ -0,0 +1,228 @@
+import copy
+import os
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+
+import pytest
+from saml2.config import SPConfig
+
+from satosa.metadata_refresh import LocalMetadataSource
+from satosa.metadata_refresh import MetadataRefresher
+from satosa.metadata_refresh import RemoteMetadataSource
+from satosa.metadata_refresh import create_metadata_sources
+from satosa.metadata_refresh import metadata_store_lock
+from tests.util import create_metadata_from_config_dict
+
+
+def idp_metadata(idp_conf, entity_id):
+    conf = copy.deepcopy(idp_conf)
+    conf["entityid"] = entity_id
+    return create_metadata_from_config_dict(conf)
+
+
+class MetadataServer(object):
+    """
+    Serves one metadata document with an ETag, and answers conditional requests.
+    """
+
+    def __init__(self):
+        self.content = b""
+        self.etag = '"0"'
+        self.status = 200
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append(dict(self.headers))
+                if server.status != 200:
+                    self.send_response(server.status)
+                    self.end_headers()
+                elif self.headers.get("If-None-Match") == server.etag:
+                    self.send_response(304)
+                    self.end_headers()
+                else:
+                    self.send_response(200)
+                    self.send_header("ETag", server.etag)
+                    self.send_header("Content-Type", "application/samlmetadata+xml")
+                    self.send_header("Content-Length", str(len(server.content)))
+                    self.end_headers()
+                    self.wfile.write(server.content)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}/metadata.xml".format(self.httpd.server_port)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def publish(self, content, etag):
+        self.content = content.encode("utf-8")
+        self.etag = etag
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def metadata_server(idp_conf):
+    server = MetadataServer()
+    server.publish(idp_metadata(idp_conf, "https://idp1.example.com"), '"1"')
+    yield server
+    server.close()
+
+
+def load_store(sp_conf, metadata_conf):
+    conf = copy.deepcopy(sp_conf)
+    conf["metadata"] = metadata_conf
+    return SPConfig().load(conf).metadata
+
+
+class TestRemoteMetadataSource(object):
+    def test_conditional_refresh(self, sp_conf, idp_conf, metadata_server):
+        metadata_conf = {"remote": [{"url": metadata_server.url}]}
+        store = load_store(sp_conf, metadata_conf)
+        sources = create_metadata_sources(store, metadata_conf)
+        assert len(sources) == 1
+        assert isinstance(sources[0], RemoteMetadataSource)
+
+        refresher = MetadataRefresher(sources[0])
+        assert refresher.refresh()
+        assert refresher.stats["refreshes"] == 1
+        assert "If-None-Match" not in metadata_server.requests[-1]
+
+        # unchanged metadata is not sent again
+        assert refresher.refresh()
+        assert metadata_server.requests[-1]["If-None-Match"] == '"1"'
+        assert refresher.stats["not_modified"] == 1
+        assert refresher.stats["refreshes"] == 1
+
+        metadata_server.publish(idp_metadata(idp_conf, "https://idp2.example.com"), '"2"')
+        previous_metadata = store.metadata
+        assert refresher.refresh()
+        assert store.metadata is not previous_metadata
+        assert [eid for eid in store.keys()] == ["https://idp2.example.com"]
+        assert refresher.stats["refreshes"] == 2
+        assert refresher.stats["entities"] == 1
+
+    def test_failed_refresh_keeps_the_previous_metadata(self, sp_conf, metadata_server):
+        metadata_conf = {"remote": [{"url": metadata_server.url}]}
+        store = load_store(sp_conf, metadata_conf)
+        refresher = MetadataRefresher(create_metadata_sources(store, metadata_conf)[0],
+                                      interval=3600, retry_interval=10)
+
+        metadata_server.status = 500
+        for failures in range(1, 4):
+            assert not refresher.refresh()
+            assert refresher.next_delay() == 10 * 2 ** (failures - 1)
+        assert refresher.stats["failures"] == 3
+        assert list(store.keys()) == ["https://idp1.example.com"]
+
+        metadata_server.status = 200
+        assert refresher.refresh()
+        assert refresher.next_delay() == 3600
+
+    def test_backoff_is_capped_by_the_interval(self, sp_conf, metadata_server):
+        metadata_conf = {"remote": [{"url": metadata_server.url}]}
+        store = load_store(sp_conf, metadata_conf)
+        refresher = MetadataRefresher(create_metadata_sources(store, metadata_conf)[0],
+                                      interval=100, retry_interval=60)
+        refresher.failures = 5
+        assert refresher.next_delay() == 100
+
+
+class TestLocalMetadataSource(object):
+    def test_refresh_on_modification(self, sp_conf, idp_conf, tmpdir):
+        path = str(tmpdir.join("metadata.xml"))
+        with open(path, "w") as f:
+            f.write(idp_metadata(idp_conf, "https://idp1.example.com"))
+        metadata_conf = {"local": [path]}
+        store = load_store(sp_conf, metadata_conf)
+        updates = []
+        refresher = MetadataRefresher(create_metadata_sources(store, metadata_conf)[0],
+                                      on_update=lambda: updates.append(list(store.keys())))
+
+        assert refresher.refresh()
+        assert refresher.stats["not_modified"] == 1
+        assert not updates
+
+        with open(path, "w") as f:
+            f.write(idp_metadata(idp_conf, "https://idp2.example.com"))
+        os.utime(path, ns=(0, 0))
+        assert refresher.refresh()
+        assert updates == [["https://idp2.example.com"]]
+
+    def test_files_removed_from_a_directory_are_unloaded(self, sp_conf, idp_conf, tmpdir):
+        tmpdir = tmpdir.mkdir("metadata")
+        for name in ["idp1", "idp2"]:
+            tmpdir.join(name + ".xml").write(idp_metadata(idp_conf, "https://{}.example.com".format(name)))
+        metadata_conf = {"local": [str(tmpdir)]}
+        store = load_store(sp_conf, metadata_conf)
+        source = create_metadata_sources(store, metadata_conf)[0]
+        assert isinstance(source, LocalMetadataSource)
+        assert sorted(store.keys()) == ["https://idp1.example.com", "https://idp2.example.com"]
+
+        tmpdir.join("idp2.xml").remove()
+        refresher = MetadataRefresher(source)
+        assert refresher.refresh()
+        assert list(store.keys()) == ["https://idp1.example.com"]
+        assert refresher.stats["entities"] == 1
+
+    def test_refreshes_wait_for_the_store_lock(self, sp_conf, idp_conf, tmpdir):
+        paths = [str(tmpdir.join("idp{}.xml".format(i))) for i in range(2)]
+        for i, path in enumerate(paths):
+            with open(path, "w") as f:
+                f.write(idp_metadata(idp_conf, "https://idp{}.example.com".format(i)))
+        metadata_conf = {"local": paths}
+        store = load_store(sp_conf, metadata_conf)
+        refreshers = [MetadataRefresher(source) for source in create_metadata_sources(store, metadata_conf)]
+        assert metadata_store_lock(store) is metadata_store_lock(store)
+
+        for i, path in enumerate(paths):
+            with open(path, "w") as f:
+                f.write(idp_metadata(idp_conf, "https://new-idp{}.example.com".format(i)))
+            os.utime(path, ns=(0, 0))
+        with metadata_store_lock(store):
+            # e.g. a reload of the metadata
+            threads = [threading.Thread(target=refresher.refresh) for refresher in refreshers]
+            for thread in threads:
+                thread.start()
+            threads[0].join(0.2)
+            assert threads[0].is_alive()
+            assert sorted(store.keys()) == ["https://idp0.example.com", "https://idp1.example.com"]
+        for thread in threads:
+            thread.join()
+
+        # neither refresh undid the other one
+        assert sorted(store.keys()) == ["https://new-idp0.example.com", "https://new-idp1.example.com"]
+        assert [refresher.stats["refreshes"] for refresher in refreshers] == [1, 1]
+
+    def test_refresher_is_started_once_per_process(self, sp_conf, idp_conf, tmpdir, monkeypatch):
+        path = str(tmpdir.join("idp.xml"))
+        with open(path, "w") as f:
+            f.write(idp_metadata(idp_conf, "https://idp1.example.com"))
+        metadata_conf = {"local": [path]}
+        store = load_store(sp_conf, metadata_conf)
+        refresher = MetadataRefresher(create_metadata_sources(store, metadata_conf)[0])
+
+        refresher.start()
+        thread = refresher._thread
+        refresher.start()
+        assert refresher._thread is thread
+
+        # the thread of the parent process is not running in a forked process
+        pid = os.getpid()
+        monkeypatch.setattr(os, "getpid", lambda: pid + 1)
+        refresher.start()
+        assert refresher._thread is not thread
+        assert refresher._thread.is_alive()
+        refresher.stop()
+        thread.join()
+
+
+def test_inline_metadata_is_not_refreshed(sp_conf, idp_conf):
+    metadata_conf = {"inline": [idp_metadata(idp_conf, "https://idp1.example.com")]}
+    store = load_store(sp_conf, metadata_conf)
+    assert create_metadata_sources(store, metadata_conf) == []
@@ -1,3 +1,5 @@
+import re
+
 import pytest
 
 from satosa.context import Context
@@ -90,3 +92,130 @@ class TestModuleRouter:
     def test_bad_init(self, frontends, backends, micro_services):
         with pytest.raises(ValueError):
             ModuleRouter(frontends, backends, micro_services)
+
+
+class _Module(object):
+    def __init__(self, name, endpoints):
+        self.name = name
+        self.endpoints = endpoints
+
+    def register_endpoints(self, *args):
+        return [(regex, "{}:{}".format(self.name, regex)) for regex in self.endpoints]
+
+
+def _linear_routing(router, path):
+    """
+    The routing of the router before it was compiled: every endpoint is searched in order.
+    """
+    for modules in [router.frontends, router.micro_services]:
+        for module in modules.values():
+            for regex, spec in module["endpoints"]:
+                if re.search(regex, path):
+                    return spec
+    backend = path.split("/")[0]
+    if backend in router.backends:
+        for regex, spec in router.backends[backend]["endpoints"]:
+            if re.search(regex, path):
+                return spec
+    return None
+
+
+class TestCompiledRouting:
+    @pytest.fixture
+    def router(self):
+        frontends = [
+            _Module("Saml2IDP", ["^Saml2IDP/sso/redirect$", "(^Saml2|^OIDC)/sso/post$",
+                                 "^Saml2IDP/proxy.xml", "(^Saml2|^OIDC)/\\S+/sso/redirect"]),
+            _Module("OIDCOP", ["^.well-known/openid-configuration$", "^OIDCOP/jwks$", "^OIDCOP/token",
+                               "^Saml2IDP/sso/redirect$", "userinfo"]),
+            _Module("ping", ["^ping"]),
+            _Module("optional", ["^ab/?c$", "^a/?b", "^Saml2IDPx?/meta$", "(^x|^yz?)/q", "^d\\.?e/"]),
+        ]
+        backends = [
+            _Module("Saml2", ["^Saml2/acs/post$", "^Saml2/disco$", "sso/post$"]),
+            _Module("OIDC", ["^OIDC/redirect$", "^OIDC/.*"]),
+        ]
+        micro_services = [_Module("consent", ["^consent/handle_consent$", "^Saml2/acs/.*"])]
+        return ModuleRouter(frontends, backends, micro_services)
+
+    @pytest.mark.parametrize("path", [
+        "Saml2IDP/sso/redirect",
+        "Saml2/sso/post",
+        "OIDC/sso/post",
+        "Saml2IDP/proxy.xml",
+        "Saml2IDP/proxyAxml/more",
+        "Saml2/aHR0cHM6Ly9pZHAuZXhhbXBsZS5jb20=/sso/redirect",
+        ".well-known/openid-configuration",
+        "OIDCOP/jwks",
+        "OIDCOP/token/extra",
+        "anything/userinfo/x",
+        "ping",
+        "ping/again",
+        "consent/handle_consent",
+        "Saml2/acs/post",
+        "Saml2/acs/redirect",
+        "Saml2/disco",
+        "Saml2/other/sso/post",
+        "OIDC/redirect",
+        "OIDC/anything",
+        "unknown/path",
+        "Saml2IDP/sso/redirect/extra",
+        "abc",
+        "ab/c",
+        "a/b",
+        "ab",
+        "ab/x",
+        "Saml2IDP/meta",
+        "Saml2IDPx/meta",
+        "x/q",
+        "y/q",
+        "yz/q",
+        "de/f",
+        "d.e/f",
+    ])
+    def test_compiled_routing_matches_linear_routing(self, router, path):
+        context = Context()
+        context.path = path
+        expected = _linear_routing(router, path)
+        if expected is None:
+            with pytest.raises(SATOSANoBoundEndpointError):
+                router.endpoint_routing(context)
+        else:
+            assert router.endpoint_routing(context) == expected
+
+    def test_first_registered_endpoint_wins(self, router):
+        context = Context()
+        context.path = "Saml2IDP/sso/redirect"
+        router.endpoint_routing(context)
+        assert context.target_frontend == "Saml2IDP"
+
+    def test_frontend_endpoint_has_priority_over_backend_endpoint(self, router):
+        context = Context()
+        context.path = "Saml2/sso/post"
+        assert router.endpoint_routing(context) == "Saml2IDP:(^Saml2|^OIDC)/sso/post$"
+        assert context.target_frontend == "Saml2IDP"
+        assert context.target_backend == "Saml2"
+
+    def test_micro_service_endpoint_has_priority_over_backend_endpoint(self, router):
+        context = Context()
+        context.path = "Saml2/acs/post"
+        assert router.endpoint_routing(context) == "consent:^Saml2/acs/.*"
+        assert context.target_micro_service == "consent"
+
+    def test_guarded_endpoint_leaves_rejected_paths_to_other_endpoints(self):
+        class GuardedModule(_Module):
+            def register_endpoints(self, *args):
+                return [("^(?P<org>[^/]+)/sso/redirect$", "guarded",
+                         lambda match: match.group("org") == "known")]
+
+        router = ModuleRouter([GuardedModule("VirtualCo", []), _Module("Saml2IDP", ["sso/redirect$"])],
+                              [_Module("Saml2", [])], [])
+        context = Context()
+        context.path = "known/sso/redirect"
+        assert router.endpoint_routing(context) == "guarded"
+        assert context.target_frontend == "VirtualCo"
+
+        context = Context()
+        context.path = "unknown/sso/redirect"
+        assert router.endpoint_routing(context) == "Saml2IDP:sso/redirect$"
+        assert context.target_frontend == "Saml2IDP"
@@ -1,6 +1,7 @@
 """
 Tests for the state class.
 """
+import logging
 import random
 import string
 from http.cookies import SimpleCookie
@@ -8,7 +9,11 @@ from urllib.parse import quote_plus
 
 import pytest
 
+from satosa.logging_util import satosa_logging
 from satosa.state import State, state_to_cookie, cookie_to_state, SATOSAStateError
+from satosa.state import STATE_CODEC_SEPARATOR
+from satosa.state import _derive_key, _derive_mac_key
+from satosa.state_store import MemoryStateStore
 
 
 def get_dict(size, key_prefix, value_preix):
@@ -78,6 +83,125 @@ class TestState:
         assert state["my_dict_router"] == my_dict_router
         assert state["my_dict_backend"] == my_dict_backend
 
+    @pytest.mark.parametrize("codec", ["v1", "legacy"])
+    def test_urlstate_round_trip_with_codec(self, codec):
+        enc_key = "Ireallyliketoencryptthisdictionary!"
+        state = State()
+        state["my_dict"] = get_dict(10, get_str(10), get_str(10))
+        urlstate = state.urlstate(enc_key, codec=codec)
+        assert (STATE_CODEC_SEPARATOR in urlstate) == (codec != "legacy")
+        assert State(urlstate, enc_key).data == state.data
+
+    def test_default_codec_is_versioned(self):
+        state = State()
+        state["foo"] = "bar"
+        urlstate = state.urlstate("key")
+        assert urlstate.startswith("v1" + STATE_CODEC_SEPARATOR)
+
+    def test_tampered_urlstate_is_rejected(self):
+        enc_key = "Ireallyliketoencryptthisdictionary!"
+        state = State()
+        state["foo"] = "bar"
+        urlstate = state.urlstate(enc_key)
+        tampered = urlstate[:-2] + ("AA" if urlstate[-2:] != "AA" else "BB")
+        with pytest.raises(ValueError):
+            State(tampered, enc_key)
+
+    def test_unknown_codec_version_is_rejected(self):
+        with pytest.raises(ValueError):
+            State("v99" + STATE_CODEC_SEPARATOR + "abcd", "key")
+
+    def test_lazy_state_is_decoded_on_first_access(self):
+        enc_key = "Ireallyliketoencryptthisdictionary!"
+        state = State()
+        state["foo"] = {"bar": "baz"}
+        urlstate = state.urlstate(enc_key)
+
+        lazy_state = State(urlstate, enc_key, lazy=True)
+        assert not lazy_state.is_decoded
+        assert not lazy_state.is_modified
+        assert lazy_state["foo"] == {"bar": "baz"}
+        assert lazy_state.is_decoded
+        assert not lazy_state.is_modified
+
+    def test_disabled_log_levels_do_not_decode_a_lazy_state(self):
+        enc_key = "Ireallyliketoencryptthisdictionary!"
+        state = State()
+        state["foo"] = "bar"
+        lazy_state = State(state.urlstate(enc_key), enc_key, lazy=True)
+
+        logger = logging.getLogger("satosa.test_state")
+        logger.setLevel(logging.INFO)
+        satosa_logging(logger, logging.DEBUG, "not logged", lazy_state)
+        assert not lazy_state.is_decoded
+
+    def test_lazy_state_that_can_not_be_decoded_is_empty(self):
+        lazy_state = State("v1.broken", "key", lazy=True)
+        assert "foo" not in lazy_state
+        assert lazy_state.is_modified
+
+    @pytest.mark.parametrize("mutate", [
+        lambda s: s.__setitem__("foo", {"bar": "baz"}),
+        lambda s: s.__delitem__("foo"),
+        lambda s: s["foo"].__setitem__("bar", "other"),
+        lambda s: s.update({"new": 1}),
+        lambda s: s.setdefault("new", {}),
+    ])
+    def test_is_modified_tracks_mutations(self, mutate):
+        enc_key = "Ireallyliketoencryptthisdictionary!"
+        state = State()
+        state["foo"] = {"bar": "baz"}
+        loaded_state = State(state.urlstate(enc_key), enc_key)
+        assert not loaded_state.is_modified
+        mutate(loaded_state)
+        assert loaded_state.is_modified
+
+    def test_new_state_is_modified_only_if_not_empty(self):
+        state = State()
+        assert not state.is_modified
+        state["foo"] = "bar"
+        assert state.is_modified
+
+    def test_view_is_read_only(self):
+        state = State()
+        state["foo"] = {"bar": ["baz"]}
+        view = state.view
+        assert view["foo"]["bar"] == ("baz",)
+        assert "foo" in view
+        with pytest.raises(TypeError):
+            view["foo"]["bar"] = "other"
+        with pytest.raises(TypeError):
+            view["new"] = "value"
+
+    def test_view_reflects_state(self):
+        state = State()
+        view = state.view
+        state["foo"] = "bar"
+        assert view["foo"] == "bar"
+
+    def test_copy_is_copy_on_write(self):
+        state = State()
+        state["foo"] = {"bar": "baz"}
+        state["other"] = {"a": "b"}
+        state_copy = state.copy()
+        assert state_copy.data["foo"] is state.data["foo"]
+
+        state_copy["foo"]["bar"] = "changed"
+        state["other"]["a"] = "changed"
+        assert state["foo"] == {"bar": "baz"}
+        assert state_copy["foo"] == {"bar": "changed"}
+        assert state_copy["other"] == {"a": "b"}
+        assert state["other"] == {"a": "changed"}
+
+    def test_copy_is_independent_of_new_keys(self):
+        state = State()
+        state["foo"] = "bar"
+        state_copy = state.copy()
+        state["new"] = "value"
+        del state["foo"]
+        assert "new" not in state_copy
+        assert state_copy["foo"] == "bar"
+
     def test_contains(self):
         state = State()
         state["foo"] = "bar"
@@ -124,6 +248,47 @@ class TestStateAsCookie:
         assert not parsed_cookie[cookie_name].value
         assert parsed_cookie[cookie_name]["max-age"] == '0'
 
+    def test_encode_decode_of_state_in_store(self):
+        store = MemoryStateStore(ttl=60, eviction_interval=0)
+        state = State()
+        state["foo"] = "bar" * 1000
+
+        cookie = state_to_cookie(state, "state_cookie", "/", "2781y4hef90", store=store)
+        cookie_str = cookie["state_cookie"].OutputString()
+        assert len(cookie_str) < 200
+        assert len(store) == 1
+
+        loaded_state = cookie_to_state(cookie_str, "state_cookie", "2781y4hef90", store=store)
+        assert loaded_state.data == state.data
+        assert loaded_state.state_id == state.state_id
+
+        loaded_state.delete = True
+        state_to_cookie(loaded_state, "state_cookie", "/", "2781y4hef90", store=store)
+        assert len(store) == 0
+        with pytest.raises(SATOSAStateError):
+            cookie_to_state(cookie_str, "state_cookie", "2781y4hef90", store=store)
+
+    def test_state_handle_with_wrong_signature_is_rejected(self):
+        store = MemoryStateStore(ttl=60, eviction_interval=0)
+        state = State()
+        state["foo"] = "bar"
+        cookie = state_to_cookie(state, "state_cookie", "/", "2781y4hef90", store=store)
+        cookie_str = cookie["state_cookie"].OutputString()
+        with pytest.raises(SATOSAStateError):
+            cookie_to_state(cookie_str, "state_cookie", "wrong_encrypt_key", store=store)
+
+    def test_state_handle_is_not_signed_with_the_encryption_key(self):
+        assert _derive_mac_key("2781y4hef90") != _derive_key("2781y4hef90")
+
+    def test_state_in_cookie_is_accepted_with_store(self):
+        state = State()
+        state["foo"] = "bar"
+        cookie = state_to_cookie(state, "state_cookie", "/", "2781y4hef90")
+        cookie_str = cookie["state_cookie"].OutputString()
+        store = MemoryStateStore(ttl=60, eviction_interval=0)
+        loaded_state = cookie_to_state(cookie_str, "state_cookie", "2781y4hef90", store=store)
+        assert loaded_state["foo"] == "bar"
+
     @pytest.mark.parametrize("cookie_str, name, encryption_key, expected_exception", [
         (  # Test wrong encryption_key
                 'Set-Cookie: state_cookie="_Td6WFoAAATm1rRGAgAhARYAAAB0L-WjAQCXYWt4NU9ZLWF5amdVVDdSUjhWdnkyUHE5MFhJV0J4Uzg5di1EVW1nNTR0WHZKakFsaWJmN2JMOUtlNEltMkJ0dmxOakRyUDJXZE53d0dwSGNqYnBzVng5YjVVeUYyUzkwcWVSMU42U2VNNHZDQTktUXdCQWx0WUh6LVBPX1pBYnZ1M1RsV09Qc2lKS3VpelB5a0FsMG93PT0AmlSCX0Pk2WoAAbABmAEAAGRNyZ2xxGf7AgAAAAAEWVo="; Max-Age=600; Path=/; Secure',
@@ -0,0 +1,117 @@
+import os
+import time
+
+import pytest
+
+from satosa.backends.saml2 import OutstandingQueries
+from satosa.state_store import FileStateStore, MemoryStateStore, SQLiteStateStore
+
+
+@pytest.fixture(params=["memory", "sqlite", "file"])
+def store(request, tmpdir):
+    if request.param == "memory":
+        return MemoryStateStore(ttl=60, eviction_interval=0)
+    if request.param == "sqlite":
+        return SQLiteStateStore(ttl=60, path=str(tmpdir.join("state.db")), eviction_interval=0)
+    return FileStateStore(ttl=60, directory=str(tmpdir.join("states")), eviction_interval=0)
+
+
+class TestStateStore(object):
+    def test_set_get_delete(self, store):
+        store.set("abc", '{"foo": "bar"}')
+        assert store.get("abc") == '{"foo": "bar"}'
+        store.delete("abc")
+        assert store.get("abc") is None
+
+    def test_set_overwrites(self, store):
+        store.set("abc", "1")
+        store.set("abc", "2")
+        assert store.get("abc") == "2"
+
+    def test_unknown_state(self, store):
+        assert store.get("unknown") is None
+        store.delete("unknown")
+
+    def test_expired_state_is_not_returned_and_evicted(self, store):
+        store.ttl = -1
+        store.set("abc", "1")
+        store.set("def", "2")
+        assert store.get("abc") is None
+        assert store.evict_expired() >= 1
+        store.ttl = 60
+        assert store.get("def") is None
+
+    def test_keys_len_and_stats(self, store):
+        store.set("abc", "1")
+        store.set("def", "2")
+        assert sorted(store.keys()) == ["abc", "def"]
+        assert len(store) == 2
+        store.ttl = -1
+        store.set("ghi", "3")
+        assert "ghi" not in store.keys()
+        evicted = store.evict_expired()
+        assert evicted >= 1
+        assert store.stats["expired"] == evicted
+        assert len(store) == 3 - evicted
+
+
+class TestMemoryStateStore(object):
+    def test_least_recently_used_entry_is_dropped(self):
+        store = MemoryStateStore(ttl=60, max_entries=2, eviction_interval=0)
+        store.set("a", "1")
+        store.set("b", "2")
+        store.get("a")
+        store.set("c", "3")
+        assert store.get("b") is None
+        assert store.get("a") == "1"
+        assert store.get("c") == "3"
+        assert store.stats["dropped"] == 1
+
+    def test_background_eviction(self):
+        store = MemoryStateStore(ttl=0.01, eviction_interval=0.01)
+        store.set("a", "1")
+        time.sleep(0.2)
+        assert len(store) == 0
+
+
+@pytest.mark.parametrize("state_id", ["../victim", "/tmp/victim", "sub/victim", "victim.tmp", ""])
+def test_file_store_ids_can_not_name_other_files(tmpdir, state_id):
+    victim = tmpdir.join("victim")
+    victim.write("secret")
+    store = FileStateStore(ttl=60, directory=str(tmpdir.join("states")), eviction_interval=0)
+    # the InResponseTo of a SAML response is looked up in the outstanding queries
+    outstanding_queries = OutstandingQueries(store)
+
+    assert state_id not in outstanding_queries
+    assert store.get(state_id) is None
+    del outstanding_queries[state_id]
+    with pytest.raises(ValueError):
+        store.set(state_id, "1")
+    assert victim.read() == "secret"
+
+
+def test_sqlite_store_connects_on_first_use(tmpdir):
+    path = tmpdir.join("state.db")
+    store = SQLiteStateStore(ttl=60, path=str(path), eviction_interval=60)
+    assert not path.exists()
+    assert store._eviction_pid is None
+
+    store.set("abc", "1")
+    assert path.exists()
+    assert store._eviction_pid == os.getpid()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_sqlite_store_reconnects_after_fork(tmpdir):
+    store = SQLiteStateStore(ttl=60, path=str(tmpdir.join("state.db")), eviction_interval=0)
+    store.set("parent", "1")
+    parent_connection = store._connection()
+
+    pid = os.fork()
+    if pid == 0:
+        ok = store._connection() is not parent_connection and store.get("parent") == "1"
+        store.set("child", "2")
+        os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    assert store.get("child") == "2"